@@ -1,10 +1,10 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import, division
 from . import utils
+from .profiling import profile
 from flask.ext import components
 from importlib import import_module
 import flask
-import inspect
 import os
 import sys
 import sqlalchemy as sa
@@ -13,6 +13,14 @@ from sqlalchemy_utils import coercion_listener
 
 def configure(self, app):
 
+    # Track mutations of the configuration so settings views built over it
+    # can be cached until it changes.
+
+    from alchemist.conf import Config
+
+    if not isinstance(app.config, Config):
+        app.config = Config(app.root_path, app.config)
+
     # Detect if we are being invoked by a test runner.
     # Checks the first and second arguments to determine if we are being
     # run by a test runner.
@@ -27,50 +35,118 @@ def configure(self, app):
             app.config['TESTING'] = True
             break
 
+    # Use the frozen settings snapshot (see `alchemist settings --freeze`)
+    # when one exists and none of its sources have changed since it was
+    # written; this skips discovery and deferred resolution entirely.
+
+    from alchemist.conf import snapshot
+
+    with profile.phase('settings', 'snapshot'):
+        config = snapshot.load(app)
+
+    if config is not None:
+        app.config.update(config)
+
+    else:
+        self._gather_settings(app)
+
+    # Gather and import all models modules or packages of the
+    # registered components; or, with MODELS_LAZY, defer their import
+    # until the metadata, the registry, or a mapped class is first used.
+
+    with app.app_context():
+        from alchemist.db._loader import loader
+
+        loader.defer(app.config.get('COMPONENTS', []))
+        if not app.config.get('MODELS_LAZY'):
+            loader.load()
+
+            if profile.enabled:
+                # Mappers are otherwise configured on first use; do it now
+                # so the cost shows up in the profile.
+                with profile.phase('mappers'):
+                    sa.orm.configure_mappers()
+
+    # Register the coercion listener.
+    sa.event.listen(sa.orm.mapper, 'mapper_configured', coercion_listener)
+
+    profile.report('configure %s' % app.name)
+
+
+def _gather_settings(self, app):
+    """Gather and resolve the configuration of the application.
+
+    The path of every settings source that is read is recorded in
+    `app.extensions['alchemist']['settings_sources']` so a snapshot of
+    the result can later tell if it has gone stale.
+    """
+
+    sources = []
+
+    def record(module):
+        filename = getattr(module, '__file__', None)
+        if filename:
+            if filename.endswith(('.pyc', '.pyo')):
+                filename = filename[:-1]
+
+            sources.append(os.path.abspath(filename))
+
     # Gather configuration from the following places:
     #  1. alchemist.conf.default_settings
-    app.config.from_object('alchemist.conf.default_settings')
+    with profile.phase('settings', 'alchemist.conf.default_settings'):
+        app.config.from_object('alchemist.conf.default_settings')
+        record(sys.modules['alchemist.conf.default_settings'])
 
     #  2. <package>.settings
 
-    try:
-        app.config.from_object('%s.settings' % app.name)
+    with profile.phase('settings', '%s.settings' % app.name):
+        try:
+            app.config.from_object('%s.settings' % app.name)
+            record(sys.modules['%s.settings' % app.name])
 
-    except ImportError:
-        pass
+        except ImportError:
+            pass
 
     #  3. Gather configuration from each registered component.
 
     name = app.name
-    for component in components.find('settings', app, raw=True):
-        if component.__package__ != name or component.__name__ != name:
-            app.config.from_object(component)
+    for key in list(app.config.get('COMPONENTS', [])):
+        with profile.phase('settings', key):
+            for component in components.find(
+                    'settings', app, components=[key], raw=True):
+                if (component.__package__ != name
+                        or component.__name__ != name):
+                    app.config.from_object(component)
+                    record(component)
 
     #  4. $ALCHEMIST_SETTINGS_MODULE
-
-    app.config.from_envvar('ALCHEMIST_SETTINGS_MODULE', silent=True)
-
     #  5. $<package>_SETTINGS_MODULE
 
-    var = '%s_SETTINGS_MODULE' % app.name.replace('.', '_').upper()
-    app.config.from_envvar(var, silent=True)
+    for var in ('ALCHEMIST_SETTINGS_MODULE', self._settings_variable(app)):
+        with profile.phase('settings', '$%s' % var):
+            if app.config.from_envvar(var, silent=True):
+                sources.append(os.path.abspath(os.environ[var]))
 
     # Resolve deferred configuration.
 
     from alchemist.conf import defer
 
+    # Deferred values are resolved after those they reference.
+
     with app.app_context():
-        for name, value in app.config.items():
-            if isinstance(value, defer):
-                app.config[name] = value.resolve()
+        for name in defer.order(app.config):
+            with profile.phase('defer', name):
+                app.config[name] = app.config[name].resolve(app.config)
 
-    # Gather and import all models modules or packages of the
-    # registered components.
+    extension = app.extensions.setdefault('alchemist', {})
+    extension['settings_sources'] = sources
 
-    components.find('models', app, raw=True)
 
-    # Register the coercion listener.
-    sa.event.listen(sa.orm.mapper, 'mapper_configured', coercion_listener)
+def _settings_variable(self, app):
+    """Name of the environment variable for the project settings module.
+    """
+
+    return '%s_SETTINGS_MODULE' % app.name.replace('.', '_').upper()
 
 
 @utils.memoize
@@ -104,7 +180,7 @@ def _get_application_from_name(self, name):
     return self._get_application_from_name('.'.join(name.split('.')[:-1]))
 
 
-@utils.memoize
+@utils.pin
 def _find_application(self):
 
     # Check for an environment variable declaring where the central
@@ -116,17 +192,32 @@ def _find_application(self):
         if app:
             return app
 
-    # Inspect the stack to find the application.
+    # Walk the stack to find the application.
     # This is intended for ease during development and for production
     # to lock-in the application via the environment variable.
 
-    for frame in reversed(inspect.stack()[1:]):
-        name = frame[0].f_globals.get('__package__')
+    # Only the package of each frame is needed so walk the frame objects
+    # directly; `inspect.stack` would read the source of every frame.
+    # The outermost frames are still considered first.
+
+    names = []
+    frame = sys._getframe(1)
+    while frame is not None:
+        name = frame.f_globals.get('__package__')
         if (name and (not name.startswith('alchemist')
                       or name.startswith('alchemist.tests.a'))):
-            app = self._get_application_from_name(name)
-            if app:
-                return app
+            if name not in names:
+                names.append(name)
+
+        frame = frame.f_back
+
+    # Release the reference to the frame.
+    del frame
+
+    for name in reversed(names):
+        app = self._get_application_from_name(name)
+        if app:
+            return app
 
 
 @property
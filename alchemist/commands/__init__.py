@@ -1,17 +1,52 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import, division
-from .server import Server
-from .shell import Shell
-from .settings import Settings
-from .load import Load
-from .db import (Initialize, Clear, Flush, Shell as DBShell)
-from .test import Test
+from alchemist import utils
+from importlib import import_module
 
 __all__ = [
     'Server',
     'Shell',
-    'Initialize', 'Clear', 'Flush', 'DBShell',
+    'Initialize', 'Clear', 'Flush', 'DBShell', 'DBPool',
     'Settings',
     'Load',
     'Test'
 ]
+
+#! Commands provided by this component; keyed by the (namespaced) name of
+#! the command. The management utility only imports a command when it is
+#! invoked.
+__commands__ = {
+    'run': 'alchemist.commands.server.Server',
+    'shell': 'alchemist.commands.shell.Shell',
+    'settings': 'alchemist.commands.settings.Settings',
+    'load': 'alchemist.commands.load.Load',
+    'test': 'alchemist.commands.test.Test',
+    'db init': 'alchemist.commands.db.Initialize',
+    'db clear': 'alchemist.commands.db.Clear',
+    'db flush': 'alchemist.commands.db.Flush',
+    'db shell': 'alchemist.commands.db.Shell',
+    'db pool': 'alchemist.commands.db.Pool',
+}
+
+
+def _lazy(path):
+    """Property that imports the referenced command when it is accessed.
+    """
+
+    module, name = path.rsplit('.', 1)
+    return property(lambda self: getattr(import_module(module), name))
+
+
+Server = _lazy(__commands__['run'])
+Shell = _lazy(__commands__['shell'])
+Settings = _lazy(__commands__['settings'])
+Load = _lazy(__commands__['load'])
+Test = _lazy(__commands__['test'])
+Initialize = _lazy(__commands__['db init'])
+Clear = _lazy(__commands__['db clear'])
+Flush = _lazy(__commands__['db flush'])
+DBShell = _lazy(__commands__['db shell'])
+DBPool = _lazy(__commands__['db pool'])
+
+
+utils.make_module_class(__name__)
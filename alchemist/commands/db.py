@@ -84,3 +84,29 @@ class Shell(Command):
 
     def run(self, *args, **kwargs):
         db.shell(*args, **kwargs)
+
+
+class Pool(Command):
+    """Show the metrics of the connection pools of the server.
+    """
+
+    name = 'pool'
+
+    namespace = 'db'
+
+    option_list = [
+        Option(dest='databases', nargs='*',
+               help='The names of the databases to limit the scope to.'),
+        Option('--interval', '-i', dest='interval', type=float,
+               required=False, default=None,
+               help='Stream the metrics every number of seconds.'),
+        Option('--count', '-n', dest='count', type=int,
+               required=False, default=None,
+               help='Stop streaming after showing this many times.'),
+        Option('--json', dest='format', action='store_const', const='json',
+               required=False, default='text',
+               help='Print each snapshot as a line of JSON.'),
+    ]
+
+    def run(self, *args, **kwargs):
+        db.pool(*args, **kwargs)
@@ -1,18 +1,28 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import, division
 from flask.ext import script
-from werkzeug.serving import run_simple
+import os
 
 
 class Server(script.Server):
 
     name = 'run'
 
-    option_list = script.Server.option_list + (
+    options = (
         script.Option('--mode', '-m', dest='mode',
                       action='store', required=False, default="werkzeug"),
+        script.Option('--warmup', dest='warmup', action='store_true',
+                      required=False, default=None,
+                      help='Fill the connection pools before serving.'),
+        script.Option('--no-warmup', dest='warmup', action='store_false',
+                      required=False, default=None),
     )
 
+    def get_options(self):
+        # Those of the server are built by flask-script in `get_options`
+        # (its `option_list` is empty).
+        return tuple(super(Server, self).get_options()) + self.options
+
     def __init__(self, *args, **kwargs):
 
         # Set all defaults to None as they will be defaulted in handle
@@ -26,7 +36,7 @@ class Server(script.Server):
 
         super(Server, self).__init__(*args, **kwargs)
 
-    def __call__(self, app, **kwargs):
+    def handle(self, app, **kwargs):
 
         # Collect default server configuration from the application config.
         config = app.config
@@ -37,15 +47,38 @@ class Server(script.Server):
         kwargs.setdefault('use_reloader', config.get('SERVER_RELOAD'))
         kwargs.setdefault('threaded', config.get('SERVER_THREADED'))
         kwargs.setdefault('processes', config.get('SERVER_PROCESSES', 1))
+        kwargs.setdefault('warmup', config.get('DATABASE_WARMUP'))
+
+        # Only warm up the process that will serve (not the parent of the
+        # reloader).
+        serving = (not kwargs['use_reloader'] or
+                   os.environ.get('WERKZEUG_RUN_MAIN') == 'true')
+
+        # Import any deferred models in the background.
+        threads = config.get('MODELS_WARMUP')
+        if threads and serving:
+            from alchemist.db._loader import loader
+            loader.warm(threads)
+
+        # Open the connections to the databases before accepting traffic.
+        if kwargs['warmup'] and serving:
+            from alchemist import db
+            with app.app_context():
+                db.warmup(verbose=True)
 
         # Spin up the server.
         mode = kwargs.get("mode", "werkzeug")
         if mode == "werkzeug":
             processes = kwargs["processes"]
-            run_simple(kwargs["host"],
-                       kwargs["port"],
-                       app,
-                       use_debugger=kwargs["use_debugger"],
-                       use_reloader=kwargs["use_reloader"],
-                       threaded=kwargs["threaded"],
-                       processes=(False if processes == 1 else processes))
+            return super(Server, self).handle(
+                app,
+                host=kwargs["host"],
+                port=kwargs["port"],
+                use_debugger=kwargs["use_debugger"],
+                use_reloader=kwargs["use_reloader"],
+                threaded=kwargs["threaded"],
+                processes=processes,
+                passthrough_errors=kwargs.get("passthrough_errors", False))
+
+    # Called by versions of flask-script before 0.6.6.
+    __call__ = handle
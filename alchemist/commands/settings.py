@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import, division
 from flask.ext import script
+from alchemist import utils
+from alchemist.conf import snapshot
 import sys
 from pygments.formatters import TerminalFormatter
 from pygments.lexers import PythonLexer
@@ -14,7 +16,19 @@ class Settings(script.Command):
 
     name = 'settings'
 
-    def __call__(self, app, **kwargs):
+    option_list = [
+        script.Option('--freeze', action='store_true', required=False,
+                      default=False,
+                      help='Write a snapshot of the resolved settings that '
+                           'is loaded on start-up while it is fresh.'),
+    ]
+
+    def handle(self, app, freeze=False, **kwargs):
+
+        if freeze:
+            filename = snapshot.dump(app)
+            utils.print_('*', 'freeze', filename)
+            return
 
         text = pprint.pformat(dict(app.config))
 
@@ -23,3 +37,6 @@ class Settings(script.Command):
                 text, PythonLexer(), TerminalFormatter())
 
         print(text)
+
+    # Called by versions of flask-script before 0.6.6.
+    __call__ = handle
@@ -1,22 +1,123 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import, division
-from alchemist import app
+from alchemist import app, exceptions
+from flask import _app_ctx_stack
+import ast
 import collections
-import six
+import flask
+import threading
 
 __all__ = [
+    'Config',
     'settings',
     'defer'
 ]
 
 
+class Config(flask.Config):
+    """
+    Application configuration that counts its mutations; this lets a
+    settings view built over it know when it has gone stale.
+    """
+
+    #! Incremented on every mutation of the configuration.
+    version = 0
+
+    def __setitem__(self, name, value):
+        super(Config, self).__setitem__(name, value)
+        self.version += 1
+
+    def __delitem__(self, name):
+        super(Config, self).__delitem__(name)
+        self.version += 1
+
+    def clear(self):
+        super(Config, self).clear()
+        self.version += 1
+
+    def pop(self, *args):
+        self.version += 1
+        return super(Config, self).pop(*args)
+
+    def popitem(self):
+        self.version += 1
+        return super(Config, self).popitem()
+
+    def setdefault(self, name, default=None):
+        self.version += 1
+        return super(Config, self).setdefault(name, default)
+
+    def update(self, *args, **kwargs):
+        super(Config, self).update(*args, **kwargs)
+        self.version += 1
+
+
+def _current_config():
+    """The configuration of the current application or None.
+    """
+
+    # Read the application context stack directly instead of paying for
+    # the resolution of the `current_app` proxy.
+
+    context = _app_ctx_stack.top
+    if context is not None:
+        return context.app.config
+
+    try:
+        return app.application.config
+
+    except (AttributeError, RuntimeError):
+        return None
+
+
 class Settings(collections.Mapping):
     """
     A proxy dictionary-like object that proxies to the current app
     configuration; or, if not in an active application context, pretends
     to be an empty dictionary.
+
+    Reads go through a per-thread view of the configuration that is
+    rebuilt only when the configuration is mutated, replaced, or
+    explicitly invalidated.
     """
 
+    #! Incremented by `invalidate` to discard the views of every thread.
+    _generation = 0
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _view(self):
+        config = _current_config()
+        if config is None:
+            return {}
+
+        version = getattr(config, 'version', None)
+        if version is None:
+            # Not an alchemist configuration; its mutations cannot be
+            # tracked so read through to it.
+            return config
+
+        local = self._local
+        if (getattr(local, 'config', None) is not config
+                or local.version != version
+                or local.generation != Settings._generation):
+            local.view = dict(config)
+            local.config = config
+            local.version = version
+            local.generation = Settings._generation
+
+        return local.view
+
+    def invalidate(self):
+        """Discard the cached views of the configuration in every thread.
+
+        Only needed if the configuration is mutated behind the back of its
+        `Config` (eg. with `dict.__setitem__`).
+        """
+
+        Settings._generation += 1
+
     def __getattr__(self, name):
         try:
             return self[name]
@@ -25,32 +126,16 @@ class Settings(collections.Mapping):
             raise AttributeError
 
     def __getitem__(self, name):
-        try:
-            return app.application.config[name]
-
-        except (AttributeError, RuntimeError):
-            raise KeyError
+        return self._view()[name]
 
     def __contains__(self, name):
-        try:
-            return name in app.application.config
-
-        except (AttributeError, RuntimeError):
-            return False
+        return name in self._view()
 
     def __len__(self):
-        try:
-            return len(app.application.config)
-
-        except (AttributeError, RuntimeError):
-            return 0
+        return len(self._view())
 
     def __iter__(self):
-        try:
-            return iter(app.application.config)
-
-        except:
-            return iter(())
+        return iter(self._view())
 
 
 # Instantiate lazy-bound settings object.
@@ -59,13 +144,74 @@ settings = Settings()
 
 class defer(object):
     """Acts a proxy for a configuration setting.
+
+    The expression is compiled once; only the settings it references are
+    bound when it is evaluated.
     """
 
     def __init__(self, expression):
         self._expression = expression
 
-    def resolve(self):
-        from . import settings
-        locals().update(settings)
-        six.exec_('value = (%s)' % self._expression, locals(), globals())
-        return value  # noqa
+        tree = ast.parse(expression.strip(), mode='eval')
+        self._code = compile(tree, '<defer %s>' % expression, 'eval')
+
+        #! Names referenced by the expression.
+        self.names = frozenset(node.id for node in ast.walk(tree)
+                               if isinstance(node, ast.Name))
+
+    def __repr__(self):
+        return 'defer(%r)' % self._expression
+
+    def resolve(self, scope=None):
+        if scope is None:
+            scope = settings
+
+        namespace = {}
+        for name in self.names:
+            if name in scope:
+                namespace[name] = scope[name]
+
+            elif name in _globals:
+                namespace[name] = _globals[name]
+
+        return eval(self._code, namespace)
+
+    @staticmethod
+    def order(config):
+        """
+        Names of the deferred values in the passed configuration; ordered
+        such that each comes after every deferred value it references.
+        """
+
+        deferred = dict((name, value) for name, value in config.items()
+                        if isinstance(value, defer))
+
+        ordered = []
+        state = {}
+
+        def visit(name, trail):
+            if state.get(name) == 'done':
+                return
+
+            trail = trail + [name]
+            if state.get(name) == 'visiting':
+                raise exceptions.ImproperlyConfigured(
+                    'Deferred settings reference each other: %s' %
+                    ' -> '.join(trail))
+
+            state[name] = 'visiting'
+            for reference in sorted(deferred[name].names):
+                if reference in deferred:
+                    visit(reference, trail)
+
+            state[name] = 'done'
+            ordered.append(name)
+
+        for name in sorted(deferred):
+            visit(name, [])
+
+        return ordered
+
+
+# Module names available to deferred expressions.
+_globals = globals()
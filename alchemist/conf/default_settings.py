@@ -18,3 +18,24 @@ COMPONENTS = ['alchemist']
 
 # Default metaclass to use for the declarative extension with SQLAlchemist.
 MODEL_METACLASS = 'sqlalchemy.ext.declarative.api.DeclarativeMeta'
+
+# Defer importing the models of each component until they are first used.
+MODELS_LAZY = False
+
+# Number of threads importing deferred models once the server is started.
+MODELS_WARMUP = 0
+
+# Fill the connection pools of the databases before the server is started.
+DATABASE_WARMUP = False
+
+# Close the session of a request (returning its connections to the pools) as
+# soon as its view has returned the response; see `alchemist.db.release`.
+DATABASE_RELEASE_EARLY = False
+
+# Directory that each serving process publishes the metrics of its pools
+# to (at most every second, after a request); read by `alchemist db pool`.
+DATABASE_METRICS = None
+
+# Warn (or raise when testing) once the same lazy load of a relationship has
+# run more than this many times in a request; see `alchemist.db.nplusone`.
+DATABASE_LAZY_LOAD_LIMIT = None
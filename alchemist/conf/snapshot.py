@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import, division
+from alchemist import exceptions
+from alchemist._version import __version__
+from six.moves import cPickle as pickle
+import alchemist.app
+import os
+
+__all__ = [
+    'path',
+    'dump',
+    'load',
+]
+
+#! Environment variable that overrides the location of the snapshot.
+VARIABLE = 'ALCHEMIST_SETTINGS_SNAPSHOT'
+
+
+def path(app):
+    """Location of the settings snapshot for the passed application.
+
+    Defaults to `settings.snapshot` in the instance folder of the
+    application; overridden by $ALCHEMIST_SETTINGS_SNAPSHOT.
+    """
+
+    filename = os.environ.get(VARIABLE)
+    if filename:
+        return os.path.abspath(filename)
+
+    return os.path.join(app.instance_path, 'settings.snapshot')
+
+
+def _fingerprint(app, sources):
+    """
+    Build a fingerprint of everything that went into the configuration; if
+    any of this changes the snapshot is considered stale.
+    """
+
+    variables = ('ALCHEMIST_SETTINGS_MODULE',
+                 alchemist.app._settings_variable(app))
+
+    stamps = []
+    for source in sources:
+        try:
+            stamps.append((source, os.stat(source).st_mtime))
+
+        except OSError:
+            stamps.append((source, None))
+
+    return {
+        'version': __version__,
+        'name': app.name,
+        'testing': app.config['TESTING'],
+        'environ': [(v, os.environ.get(v)) for v in variables],
+        'sources': stamps,
+    }
+
+
+def dump(app, filename=None):
+    """Write the resolved configuration of the application to a snapshot.
+
+    Returns the location the snapshot was written to.
+    """
+
+    from alchemist.conf import defer
+
+    filename = filename or path(app)
+    extension = app.extensions.get('alchemist', {})
+    sources = extension.get('settings_sources')
+    if sources is None:
+        if extension.get('settings_snapshot') == filename:
+            # Configured from this very snapshot; it is still fresh.
+            return filename
+
+        raise exceptions.ImproperlyConfigured(
+            'Settings were not gathered from their sources; '
+            'nothing to freeze.')
+
+    # Validate that everything is resolved and can be serialized.
+
+    config = dict(app.config)
+    for name, value in config.items():
+        if isinstance(value, defer):
+            raise exceptions.ImproperlyConfigured(
+                'The setting %r is still deferred.' % name)
+
+        try:
+            pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        except Exception:
+            raise exceptions.ImproperlyConfigured(
+                'The setting %r cannot be frozen: %r' % (name, value))
+
+    # The test runner detection is re-run on every start and is a part of
+    # the fingerprint instead.
+
+    config.pop('TESTING', None)
+
+    directory = os.path.dirname(filename)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    # Write to the side and rename over so a concurrently starting
+    # process never reads a partial snapshot.
+
+    data = {'fingerprint': _fingerprint(app, sources), 'config': config}
+    temporary = '%s.%d' % (filename, os.getpid())
+    with open(temporary, 'wb') as stream:
+        pickle.dump(data, stream, pickle.HIGHEST_PROTOCOL)
+
+    os.rename(temporary, filename)
+
+    return filename
+
+
+def load(app, filename=None):
+    """
+    Read the configuration from the snapshot of the application; returns
+    None if there is no snapshot or it has gone stale.
+    """
+
+    filename = filename or path(app)
+
+    try:
+        with open(filename, 'rb') as stream:
+            data = pickle.load(stream)
+
+    except Exception:
+        # Missing, unreadable, or written by an incompatible version; fall
+        # back to discovery.
+        return None
+
+    fingerprint = data.get('fingerprint', {})
+    sources = [source for source, _ in fingerprint.get('sources', ())]
+    if fingerprint != _fingerprint(app, sources):
+        return None
+
+    extension = app.extensions.setdefault('alchemist', {})
+    extension['settings_snapshot'] = filename
+
+    return data['config']
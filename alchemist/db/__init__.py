@@ -1,18 +1,24 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import, division
 from ._engine import engine
-from ._session import Session, session
+from ._session import Session, session, readonly, release
 from .query import Query
-from .model import (Model, _metadata as metadata, _registry_map as registry,
-                    _metadata_map as component_metadata)
-from .operations import (init, clear, flush, shell)
+from ._nplusone import nplusone, LazyLoadWarning, LazyLoadError
+from .model import Model, metadata, registry, component_metadata
+from .operations import (init, clear, flush, shell, pool, warmup, hot,
+                         compiled)
 
 
 __all__ = [
     'engine',
     'Session',
     'session',
+    'readonly',
+    'release',
     'Query',
+    'nplusone',
+    'LazyLoadWarning',
+    'LazyLoadError',
     'Model',
     'metadata',
     'component_metadata',
@@ -21,6 +27,10 @@ __all__ = [
     'clear',
     'flush',
     'shell',
+    'pool',
+    'warmup',
+    'hot',
+    'compiled',
 ]
 
 # TODO: Support these options perhaps -- look into them at least.
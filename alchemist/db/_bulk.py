@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import, division
+from . import _shard, cache
+from sqlalchemy import exc, sql
+from sqlalchemy.orm import attributes
+import itertools
+
+#! Dialects whose DBAPI runs `executemany` a row at a time (a round trip
+#! each); their batches are sent as a single multi-VALUES INSERT instead.
+#! SQLite runs in process and MySQLdb rewrites the INSERT by itself.
+multivalues = frozenset(('postgresql',))
+
+
+def batches(iterable, size):
+    """Lists of up to `size` items of the iterable; consumed lazily.
+    """
+
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+
+        yield batch
+
+
+def _columns(mapper):
+    # The column of each (column) attribute of the model.
+
+    if len(mapper.tables) != 1:
+        raise exc.InvalidRequestError(
+            'Bulk operations need a model mapped to a single table; '
+            '%s is not.' % mapper.class_.__name__)
+
+    return dict((prop.key, prop.columns[0]) for prop in mapper.column_attrs
+                if prop.columns[0].table is mapper.local_table)
+
+
+def _defaulted(table, values):
+    # Whether a column left out of the values has a default computed in
+    # Python (which a multi-VALUES INSERT won't run).
+
+    for column in table.columns:
+        default = column.default
+        if column.key not in values and default is not None and \
+                not default.is_sequence:
+            return True
+
+    return False
+
+
+def _insert(connection, table, rows, returning):
+    statement = table.insert()
+    if returning:
+        # One at a time so that the generated primary key is known; it is
+        # taken from RETURNING where the dialect uses it.
+        for values, assign in rows:
+            result = connection.execute(statement, values)
+            assign(result.inserted_primary_key)
+            result.close()
+
+        return
+
+    values = [row[0] for row in rows]
+    dialect = connection.dialect
+    if dialect.name in multivalues and dialect.supports_multivalues_insert \
+            and values[0] and not _defaulted(table, values[0]):
+        connection.execute(statement.values(values))
+        return
+
+    connection.execute(statement, values)
+
+
+def _update(connection, table, rows):
+    primary = table.primary_key.columns
+    statement = table.update().where(sql.and_(*[
+        column == sql.bindparam('alchemist_pk_%s' % column.key)
+        for column in primary]))
+
+    connection.execute(statement, [row[0] for row in rows])
+    for _, done in rows:
+        done()
+
+
+def _updated(state, keys):
+    # The changes are saved; the instance is clean unless others (of its
+    # relationships, say) are left.
+
+    state._commit(state.dict, keys)
+    if not state.committed_state:
+        state._commit_all(state.dict, state._instance_dict())
+
+
+def _execute(session, mapper, items, batch_size):
+    # Items are pairs of (group, row) where each group is (kind, shard,
+    # keys, returning) and each row a pair of (values, callback); the
+    # consecutive rows of a batch alike are sent as one statement.
+
+    if getattr(session, 'readonly', False):
+        raise exc.InvalidRequestError(
+            'Session is read-only; changes cannot be saved.')
+
+    table = mapper.local_table
+    for batch in batches(items, batch_size):
+        for group, rows in itertools.groupby(batch, lambda item: item[0]):
+            kind, shard, _, returning = group
+            rows = [row for _, row in rows]
+            statement = table.insert() if kind == 'insert' else \
+                table.update()
+
+            connection = session.connection(
+                mapper, statement, shard_id=shard)
+
+            if kind == 'insert':
+                _insert(connection, table, rows, returning)
+
+            else:
+                _update(connection, table, rows)
+
+            cache.written(session, [table.name])
+
+
+def _inserting(mapper, values, assign, shard, return_defaults):
+    primary = mapper.local_table.primary_key.columns
+    returning = return_defaults and any(
+        column.key not in values for column in primary)
+
+    def set_primary_key(key):
+        for column, value in zip(primary, key):
+            assign(mapper.get_property_by_column(column).key, value)
+
+    return (('insert', shard, tuple(sorted(values)), returning),
+            (values, set_primary_key))
+
+
+def insert_mappings(session, mapper, mappings, batch_size=1000,
+                    return_defaults=False):
+    """Insert the rows held by the mappings (of attribute to value).
+    """
+
+    columns = _columns(mapper)
+    model = _shard.model_of(mapper)
+
+    def items():
+        for mapping in mappings:
+            values = dict((columns[key].key, value)
+                          for key, value in mapping.items())
+
+            shard = None
+            if model is not None:
+                shard = model.__shard__(values[_shard.key_of(model).key])
+
+            yield _inserting(mapper, values, mapping.__setitem__, shard,
+                             return_defaults)
+
+    _execute(session, mapper, items(), batch_size)
+
+
+def save(session, mapper, instances, batch_size=1000, return_defaults=False):
+    """
+    Insert the new instances and update the changed attributes of the
+    persisted ones.
+    """
+
+    columns = _columns(mapper)
+    model = _shard.model_of(mapper)
+    primary = mapper.local_table.primary_key.columns
+
+    def items():
+        for instance in instances:
+            state = attributes.instance_state(instance)
+            shard = None
+            if model is not None:
+                shard = _shard.of_instance(model, instance)
+
+            if state.key is None:
+                values = dict((column.key, state.dict[key])
+                              for key, column in columns.items()
+                              if key in state.dict)
+
+                yield _inserting(
+                    mapper, values,
+                    lambda key, value, instance=instance: setattr(
+                        instance, key, value),
+                    shard, return_defaults)
+
+                continue
+
+            keys = sorted(key for key in state.committed_state
+                          if key in columns and key in state.dict)
+
+            if not keys:
+                continue
+
+            values = dict((columns[key].key, state.dict[key])
+                          for key in keys)
+
+            for column, value in zip(primary, state.key[1]):
+                values['alchemist_pk_%s' % column.key] = value
+
+            yield (('update', shard, tuple(keys), False),
+                   (values, lambda state=state, keys=keys: _updated(
+                       state, keys)))
+
+    _execute(session, mapper, items(), batch_size)
@@ -1,16 +1,266 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import, division
-from alchemist import utils, exceptions
+from alchemist import exceptions
 from alchemist.conf import settings
+from ._pool import Metrics, metered
+from ._queries import QueryLog
+import collections
+import os
 import sqlalchemy as sa
 import six
 import threading
+import time
+from importlib import import_module
 from sqlalchemy.engine.url import URL, make_url
 
 
+class Heartbeat(object):
+    """Measures the lag of a replica by a heartbeat table.
+
+    Something (eg. a periodic task calling `beat`) keeps writing the
+    current time to the table on the primary; the lag of a replica is how
+    far its copy of the table is behind that of the primary.
+    """
+
+    def __init__(self, table='alchemist_heartbeat', column='stamp'):
+        self.table = sa.sql.table(table, sa.sql.column(column))
+        self.column = self.table.c[column]
+
+    def _stamp(self, target):
+        return target.execute(
+            sa.select([sa.func.max(self.column)])).scalar()
+
+    def beat(self, primary):
+        """Write the current time to the heartbeat table of the primary.
+        """
+
+        primary.execute(self.table.insert().values(
+            {self.column.name: time.time()}))
+
+    def __call__(self, primary, replica):
+        stamp = self._stamp(primary)
+        if stamp is None:
+            # No heartbeat yet; nothing to lag behind.
+            return 0
+
+        return stamp - (self._stamp(replica) or 0)
+
+
+class Balancer(object):
+    """Spreads reads over the replicas of a database.
+
+    Either in turn (`round-robin`) or to the replica with the fewest
+    connections checked out of its pool (`least-connections`).
+
+    Given a lag probe (called with the primary and a replica and returning
+    the lag of the replica in seconds) replicas lagging more than
+    `max_lag` seconds, or whose lag cannot be measured, are taken out of
+    rotation until they catch up; lag is measured every `interval`
+    seconds.
+    """
+
+    def __init__(self, engines, strategy='round-robin', primary=None,
+                 probe=None, max_lag=0, interval=5):
+        if strategy not in ('round-robin', 'least-connections'):
+            raise exceptions.ImproperlyConfigured(
+                'Unknown replica balancing strategy %r.' % strategy)
+
+        self.engines = engines
+        self.strategy = strategy
+        self.lock = threading.Lock()
+        self.turn = 0
+
+        self.primary = primary
+        self.probe = probe
+        self.max_lag = max_lag
+        self.interval = interval
+
+        #! Lag of each replica as last measured; None if it failed.
+        self.lag = {}
+
+        #! When lag was last measured.
+        self.measured = 0
+
+        self.measuring = threading.Lock()
+
+        # Count the connections checked out of each replica; not every
+        # pool implementation can tell.
+        self.connections = {}
+        for target in engines:
+            self.connections[target] = 0
+            sa.event.listen(target, 'checkout', self._checkout(target))
+            sa.event.listen(target, 'checkin', self._checkin(target))
+
+    def _checkout(self, target):
+        def checkout(*args):
+            with self.lock:
+                self.connections[target] += 1
+
+        return checkout
+
+    def _checkin(self, target):
+        def checkin(*args):
+            with self.lock:
+                self.connections[target] -= 1
+
+        return checkin
+
+    def measure(self):
+        """Measure the lag of every replica with the probe.
+        """
+
+        # One thread measures while the others carry on with the lag as
+        # last measured.
+        if not self.measuring.acquire(False):
+            return
+
+        try:
+            self.measured = time.time()
+            for target in self.engines:
+                try:
+                    self.lag[target] = self.probe(self.primary, target)
+
+                except Exception:
+                    self.lag[target] = None
+
+        finally:
+            self.measuring.release()
+
+    @property
+    def available(self):
+        """The replicas in rotation.
+        """
+
+        if self.probe is None:
+            return self.engines
+
+        if time.time() - self.measured >= self.interval:
+            self.measure()
+
+        return [target for target in self.engines
+                if self.lag.get(target) is not None
+                and self.lag[target] <= self.max_lag]
+
+    def dispose(self):
+        for target in self.engines:
+            target.dispose()
+
+    def choose(self):
+        """
+        The replica to send the next reads to; None if there are none (in
+        rotation).
+        """
+
+        if not self.engines:
+            return None
+
+        engines = self.available
+        if not engines:
+            return None
+
+        with self.lock:
+            if self.strategy == 'least-connections':
+                return min(engines, key=self.connections.__getitem__)
+
+            target = engines[self.turn % len(engines)]
+            self.turn += 1
+            return target
+
+
+def _is_memory(item):
+    # Whether the item is the engine of an in-memory SQLite database.
+
+    url = getattr(item, 'url', None)
+    return url is not None and url.get_backend_name() == 'sqlite' and \
+        url.database in (None, '', ':memory:')
+
+
+class Registry(object):
+    """Engines (or balancers) by key.
+
+    Each is created once; concurrent first uses of a key wait on a lock of
+    the key instead of creating (and leaking) an engine each. Given a
+    limit, the oldest beyond it are evicted and disposed; disposing closes
+    the pooled connections not checked out, those in use are closed once
+    returned. Engines of in-memory SQLite databases are only forgotten as
+    their single connection holds the database.
+    """
+
+    def __init__(self):
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.pid = os.getpid()
+
+        #! Items created before the process was forked; never used again
+        #! but kept so their connections (shared with the parent) are not
+        #! closed when collected.
+        self.orphans = []
+
+    def _forked(self):
+        # The locks may have been held by threads of the parent; they are
+        # gone and would never release them.
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.orphans.extend(self.items.values())
+        self.items = collections.OrderedDict()
+        self.pid = os.getpid()
+
+    def get(self, key, create, *args, **kwargs):
+        if self.pid != os.getpid():
+            self._forked()
+
+        # Fast path; the lookup of a dictionary needs no lock.
+        target = self.items.get(key)
+        if target is not None:
+            return target
+
+        limit = kwargs.get('limit')
+
+        with self.lock:
+            lock = self.locks.setdefault(key, threading.Lock())
+
+        with lock:
+            target = self.items.get(key)
+            if target is not None:
+                return target
+
+            target = create(*args)
+
+            evicted = []
+            with self.lock:
+                self.items[key] = target
+                while limit and len(self.items) > limit:
+                    old, item = self.items.popitem(last=False)
+                    self.locks.pop(old, None)
+                    evicted.append(item)
+
+        for item in evicted:
+            if not _is_memory(item):
+                item.dispose()
+
+        return target
+
+    def clear(self):
+        """Forget and dispose of every item.
+        """
+
+        with self.lock:
+            items = list(self.items.values())
+            self.items.clear()
+            self.locks.clear()
+
+        for item in items:
+            item.dispose()
+
+
 class Engine(object):
 
     def __getattribute__(self, name):
+        # Our own API first; all else is that of the default engine.
+        if name in ('replica', 'replicas'):
+            return object.__getattribute__(self, name)
+
         return getattr(self['default'], name)
 
     def __dir__(self):
@@ -19,84 +269,250 @@ class Engine(object):
     def __repr__(self):
         return repr(self['default'])
 
-    @utils.memoize
     def __getitem__(self, name):
+        if settings['TESTING']:
+            # Each thread has a testing database of its own; keep only so
+            # many of their engines around.
+            key = (name, threading.current_thread().ident)
+            return _testing.get(
+                key, _build, name,
+                limit=settings.get('DATABASE_TEST_ENGINES', 8))
 
-        if 'DATABASES' not in settings:
-            raise exceptions.ImproperlyConfigured(
-                'DATABASES not configured in project settings.')
+        return _engines.get(name, _build, name)
 
-        if name not in settings['DATABASES']:
-            raise exceptions.ImproperlyConfigured(
-                '%r not present in DATABASES configuration.' % name)
+    def replicas(self, name='default'):
+        """The balancer over the replicas declared for the named database.
+
+        Replicas are declared as a list under `replicas` in the (expanded)
+        configuration of a database; each is either a URL or a mapping
+        that overrides the configuration of the database. Reads are
+        balanced by the `balance` strategy of the database.
+
+        A `lag_probe` (a callable or a dotted path to one) takes replicas
+        lagging more than `lag_max` seconds out of rotation; measured
+        every `lag_interval` seconds.
+
+        Replicas are ignored when testing.
+        """
+
+        return _balancers.get(name, _balancer, name)
+
+    def replica(self, name='default'):
+        """The engine that the next reads of the named database go to.
+        """
+
+        return self.replicas(name).choose() or self[name]
+
+
+def _configuration(name):
+    """The configuration of the named database.
+    """
+
+    if 'DATABASES' not in settings:
+        raise exceptions.ImproperlyConfigured(
+            'DATABASES not configured in project settings.')
+
+    if name not in settings['DATABASES']:
+        raise exceptions.ImproperlyConfigured(
+            '%r not present in DATABASES configuration.' % name)
+
+    config = settings['DATABASES'][name]
+    if not isinstance(config, six.string_types):
+        config = dict(map(lambda i: (i[0].lower(), i[1]), config.items()))
+
+    return config
+
+
+def _build(name):
+    return _create(_configuration(name))
+
+
+def _balancer(name):
+    """Build the balancer over the replicas of the named database.
+    """
+
+    config = _configuration(name)
+    if isinstance(config, six.string_types) or settings['TESTING']:
+        return Balancer([])
+
+    engines = []
+    for replica in config.get('replicas', ()):
+        if not isinstance(replica, six.string_types):
+            replica = dict(config, **dict(
+                map(lambda i: (i[0].lower(), i[1]), replica.items())))
+
+        engines.append(_create(replica))
 
-        config = settings['DATABASES'][name]
+    probe = config.get('lag_probe')
+    if isinstance(probe, six.string_types):
+        module, probe = probe.rsplit('.', 1)
+        probe = getattr(import_module(module), probe)
 
-        if isinstance(config, six.string_types):
-            url = make_url(config)
-            options = {}
+    if isinstance(probe, type):
+        probe = probe()
+
+    return Balancer(
+        engines, config.get('balance', 'round-robin'),
+        primary=engine[name], probe=probe,
+        max_lag=config.get('lag_max', 0),
+        interval=config.get('lag_interval', 5))
+
+
+def _create(config):
+    """Create an engine from a database configuration.
+    """
+
+    if isinstance(config, six.string_types):
+        url = make_url(config)
+        options = {}
+
+    else:
+        options = dict(config.get('options', {}))
+        url = URL(
+            config['engine'],
+            username=config.get('username', config.get('user')),
+            password=config.get('password', config.get('pass')),
+            host=config.get('hostname', config.get('host')),
+            port=config.get('port'),
+            database=config.get('name', config.get('database')))
+
+    # If alchemist is invoked by a test runner we should switch to using
+    # testing databases.
+
+    if settings['TESTING']:
+
+        if url.drivername.startswith('sqlite'):
+
+            # Switch to using an in-memory database for sqlite.
+            url.database = ':memory:'
 
         else:
-            config = dict(map(lambda i: (i[0].lower(), i[1]), config.items()))
-            options = config.get('options', {})
-            url = URL(
-                config['engine'],
-                username=config.get('username', config.get('user')),
-                password=config.get('password', config.get('pass')),
-                host=config.get('hostname', config.get('host')),
-                port=config.get('port'),
-                database=config.get('name', config.get('database')))
-
-        # If alchemist is invoked by a test runner we should switch to using
-        # testing databases.
 
-        if settings['TESTING']:
+            # Switch to using a named testing database for other dialects.
+            ident = threading.current_thread().ident
+            url.database = 'test_%s_%s' % (url.database, ident)
+
+    # Apply MySQL hacks to make MySQL play nice.
+    pool_size = None
+    pool_recycle = None
+    if url.drivername.startswith('mysql'):
+        pool_size = 10
+        pool_recycle = 7200
+
+    # Get "global" options for the database engine.
+    pool_size = settings.get('DATABASE_POOL_SIZE', pool_size)
+    if pool_size:
+        options.setdefault('pool_size', pool_size)
+
+    pool_recycle = settings.get('DATABASE_POOL_RECYCLE', pool_recycle)
+    if pool_recycle:
+        options.setdefault('pool_recycle', pool_recycle)
+
+    pool_timeout = settings.get('DATABASE_POOL_TIMEOUT')
+    if pool_timeout:
+        options.setdefault('pool_timeout', pool_timeout)
 
-            if url.drivername.startswith('sqlite'):
+    # Collect metrics of the pool; exposed as `metrics` on the engine.
+    metrics = Metrics()
+    if 'pool' not in options:
+        poolclass = options.get('poolclass')
+        if poolclass is None:
+            poolclass = url.get_dialect().get_pool_class(url)
 
-                # Switch to using an in-memory database for sqlite.
-                url.database = ':memory:'
+        options['poolclass'] = metered(poolclass, metrics)
 
-            else:
+    # Forward configuration to sqlalchemy and create the engine.
+    engine = sa.create_engine(url, **options)
 
-                # Switch to using a named testing database for other dialects.
-                ident = threading.current_thread().ident
-                url.database = 'test_%s_%s' % (url.database, ident)
+    engine.metrics = metrics
+    metrics.listen(engine)
 
-        # Apply MySQL hacks to make MySQL play nice.
-        pool_size = None
-        pool_recycle = None
-        if url.drivername.startswith('mysql'):
-            pool_size = 10
-            pool_recycle = 7200
+    sa.event.listen(engine, 'connect', _connect)
+    sa.event.listen(engine, 'checkout', _checkout)
 
-        # Get "global" options for the database engine.
-        pool_size = settings.get('DATABASE_POOL_SIZE', pool_size)
-        if pool_size:
-            options.setdefault('pool_size', pool_size)
+    # Time the statements if there is a slow-query log or sampling; the
+    # listeners are left off otherwise.
+    engine.queries = QueryLog(
+        slow=settings.get('DATABASE_SLOW_QUERY_MS'),
+        sample=settings.get('DATABASE_QUERY_SAMPLE', 0),
+        size=settings.get('DATABASE_QUERY_BUFFER', 1000),
+        filename=settings.get('DATABASE_QUERY_LOG'),
+        file_size=settings.get('DATABASE_QUERY_LOG_BYTES', 10 * 1024 * 1024),
+        backups=settings.get('DATABASE_QUERY_LOG_BACKUPS', 5))
 
-        pool_recycle = settings.get('DATABASE_POOL_RECYCLE', pool_recycle)
-        if pool_recycle:
-            options.setdefault('pool_recycle', pool_recycle)
+    if engine.queries.enabled:
+        engine.queries.listen(engine)
 
-        pool_timeout = settings.get('DATABASE_POOL_TIMEOUT')
-        if pool_timeout:
-            options.setdefault('pool_timeout', pool_timeout)
+    # Return the created engine.
+    return engine
 
-        # Forward configuration to sqlalchemy and create the engine.
-        engine = sa.create_engine(url, **options)
 
-        if settings["DEBUG"]:
-            # Create a no-op listener if we're in debug mode.
-            from sqlalchemy.event import listen
-            listen(engine, "after_cursor_execute", lambda *a, **kw: None)
+def route(model):
+    """The name of the database the model is stored in.
 
-        # Return the created engine.
-        return engine
+    Looked up in $DATABASE_ROUTES by 'component:Model', by the full python
+    name of the model and then by its component; 'default' otherwise.
+    """
+
+    routes = settings.get('DATABASE_ROUTES')
+    if not routes or model is None:
+        return 'default'
+
+    component = getattr(model, '_component', None)
+    for key in ('%s:%s' % (component, model.__name__),
+                '%s.%s' % (model.__module__, model.__name__),
+                component):
+        if key in routes:
+            return routes[key]
+
+    return 'default'
+
+
+def _connect(connection, record):
+    record.info['alchemist.pid'] = os.getpid()
+
+
+def _checkout(connection, record, proxy):
+    # The connection was opened by the parent of this (forked) process;
+    # drop it without closing it (that would close it for the parent as
+    # well) and have the pool open another. Engines of the registry are
+    # replaced on a fork so only those held across it come here. Those
+    # opened before the listener was added are left alone.
+    pid = record.info.get('alchemist.pid')
+    if pid is not None and pid != os.getpid():
+        record.connection = proxy.connection = None
+        raise sa.exc.DisconnectionError(
+            'Connection belongs to the parent process; reconnecting.')
+
+
+def metrics():
+    """
+    The metrics of the pool of each engine made by this process; by the
+    name of its database.
+    """
+
+    result = {}
+    for registry in (_engines, _testing):
+        if registry.pid != os.getpid():
+            continue
+
+        for key, target in list(registry.items.items()):
+            name = key[0] if isinstance(key, tuple) else key
+            if hasattr(target, 'metrics'):
+                result[name] = target.metrics
+
+    return result
 
 
 def clear_cache():
-    Engine.__getitem__._cache.clear()
+    _balancers.clear()
+    _engines.clear()
+    _testing.clear()
+
+
+_engines = Registry()
+_testing = Registry()
+_balancers = Registry()
 
 
 engine = Engine()
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import, division
+from sqlalchemy import exc, sql
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import UnaryExpression
+import base64
+import collections
+import datetime
+import decimal
+import json
+import six
+import uuid
+
+try:
+    import enum
+
+except ImportError:  # pragma: nocoverage
+    enum = None
+
+#! A page of results and the token continuing after it (None on the last).
+Page = collections.namedtuple('Page', ['items', 'token'])
+
+#! Dialects that compare row values, e.g. (a, b) > (1, 2), with an index.
+_row_values = frozenset(('postgresql', 'mysql'))
+
+#! Formats of the values (by type) held by tokens; the offset from UTC
+#! of an aware datetime (or time) follows it as +HH:MM.
+_formats = {
+    'datetime': (datetime.datetime, '%Y-%m-%dT%H:%M:%S.%f'),
+    'date': (datetime.date, '%Y-%m-%d'),
+    'time': (datetime.time, '%H:%M:%S.%f'),
+}
+
+#! Values that JSON holds as they are.
+_plain = six.string_types + six.integer_types + (float, bool, type(None))
+
+
+class _Offset(datetime.tzinfo):
+    # A fixed offset (in minutes) from UTC; restores that of a token.
+
+    def __init__(self, minutes):
+        self.minutes = minutes
+
+    def utcoffset(self, value):
+        return datetime.timedelta(minutes=self.minutes)
+
+    def dst(self, value):
+        return datetime.timedelta(0)
+
+    def tzname(self, value):
+        return _offset(self.minutes)
+
+    def __repr__(self):
+        return '_Offset(%d)' % self.minutes
+
+
+def _offset(minutes):
+    sign = '-' if minutes < 0 else '+'
+    return '%s%02d:%02d' % (sign, abs(minutes) // 60, abs(minutes) % 60)
+
+
+def _format(value, format):
+    text = value.strftime(format)
+    offset = None
+    if isinstance(value, (datetime.datetime, datetime.time)):
+        offset = value.utcoffset()
+
+    if offset is not None:
+        text += _offset(offset.days * 1440 + offset.seconds // 60)
+
+    return text
+
+
+def _parse(text, kind, format):
+    offset = None
+    if kind is not datetime.date and text[-6:-5] in ('+', '-'):
+        text, sign, (hours, minutes) = \
+            text[:-6], text[-6], text[-5:].split(':')
+
+        offset = int(hours) * 60 + int(minutes)
+        if sign == '-':
+            offset = -offset
+
+    value = datetime.datetime.strptime(text, format)
+    if offset is not None:
+        value = value.replace(tzinfo=_Offset(offset))
+
+    if kind is datetime.date:
+        value = value.date()
+
+    elif kind is datetime.time:
+        value = value.timetz()
+
+    return value
+
+
+def _enum_class(column):
+    # The (python) enumeration of the values of the column; if any.
+
+    kind = getattr(column, 'type', None)
+    cls = getattr(kind, 'enum_class', None)
+    if cls is None:
+        try:
+            cls = kind.python_type
+
+        except (AttributeError, NotImplementedError):
+            return None
+
+    if enum is not None and isinstance(cls, type) and \
+            issubclass(cls, enum.Enum):
+        return cls
+
+
+def keys(order_by, primary_key):
+    """The pairs of (column, descending) that order the query.
+
+    The primary key is added (ascending) where missing so that every row
+    is found at one place in the order.
+    """
+
+    if not isinstance(order_by, (list, tuple)):
+        order_by = [order_by]
+
+    pairs = []
+    for clause in order_by:
+        descending = False
+        if isinstance(clause, UnaryExpression) and clause.modifier in (
+                operators.desc_op, operators.asc_op):
+            descending = clause.modifier is operators.desc_op
+            clause = clause.element
+
+        if hasattr(clause, '__clause_element__'):
+            clause = clause.__clause_element__()
+
+        pairs.append((clause, descending))
+
+    for column in primary_key:
+        if not any(column.shares_lineage(key) for key, _ in pairs
+                   if hasattr(key, 'shares_lineage')):
+            pairs.append((column, False))
+
+    return pairs
+
+
+def after(pairs, values, dialect=None):
+    """The criterion of the rows that come after the values in the order.
+    """
+
+    directions = set(descending for _, descending in pairs)
+    if len(directions) == 1 and getattr(dialect, 'name', None) in _row_values:
+        left = sql.tuple_(*[column for column, _ in pairs])
+        right = sql.tuple_(*[sql.literal(value) for value in values])
+        return left < right if directions.pop() else left > right
+
+    # (a > x) OR (a = x AND b > y) OR ...
+    clauses = []
+    for index, (column, descending) in enumerate(pairs):
+        value = values[index]
+        clause = column < value if descending else column > value
+        clauses.append(sql.and_(*[
+            pairs[prior][0] == values[prior] for prior in range(index)
+        ] + [clause]))
+
+    return sql.or_(*clauses)
+
+
+def encode(values, pairs=None):
+    """The opaque token of the values of the keys of a row.
+
+    Raises InvalidRequestError if a value is of a type a token can't hold;
+    naming its column of the `pairs` (of `keys`) if passed.
+    """
+
+    data = []
+    for index, value in enumerate(values):
+        for name, (kind, format) in _formats.items():
+            if type(value) is kind:
+                value = {name: _format(value, format)}
+                break
+
+        else:
+            if isinstance(value, decimal.Decimal):
+                value = {'decimal': six.text_type(value)}
+
+            elif isinstance(value, uuid.UUID):
+                value = {'uuid': value.hex}
+
+            elif enum is not None and isinstance(value, enum.Enum):
+                value = {'enum': value.value}
+
+            elif isinstance(value, (six.binary_type, bytearray)) and \
+                    not isinstance(value, six.string_types):
+                value = {'bytes': base64.urlsafe_b64encode(
+                    bytes(value)).decode('ascii')}
+
+            elif not isinstance(value, _plain):
+                column = pairs[index][0] if pairs is not None else index
+                raise exc.InvalidRequestError(
+                    'Cannot hold %r (of %s) in a continuation token; order '
+                    'by columns of strings, numbers, dates, times, UUIDs, '
+                    'bytes or enumerations.' % (value, column))
+
+        data.append(value)
+
+    text = json.dumps(data, separators=(',', ':'))
+    return base64.urlsafe_b64encode(text.encode('utf8')).decode('ascii')
+
+
+def decode(token, pairs=None):
+    """The values held by the token; raises ValueError if malformed.
+
+    Enumerations are restored by the types of the columns of the `pairs`
+    (of `keys`) if passed; else left as their values.
+    """
+
+    try:
+        text = base64.urlsafe_b64decode(token.encode('ascii'))
+        data = json.loads(text.decode('utf8'))
+
+        values = []
+        for index, value in enumerate(data):
+            if isinstance(value, dict):
+                (name, text), = value.items()
+                if name == 'decimal':
+                    value = decimal.Decimal(text)
+
+                elif name == 'uuid':
+                    value = uuid.UUID(text)
+
+                elif name == 'bytes':
+                    value = base64.urlsafe_b64decode(text.encode('ascii'))
+
+                elif name == 'enum':
+                    cls = None
+                    if pairs is not None:
+                        cls = _enum_class(pairs[index][0])
+
+                    value = cls(text) if cls is not None else text
+
+                else:
+                    value = _parse(text, *_formats[name])
+
+            values.append(value)
+
+    except (TypeError, ValueError, KeyError, IndexError, UnicodeError,
+            AttributeError, decimal.InvalidOperation):
+        raise ValueError('Malformed continuation token: %r' % token)
+
+    return values
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import, division
+from alchemist.profiling import profile
+from importlib import import_module
+import six
+import threading
+
+
+def _is_missing(error, name):
+    # Whether the import error is of the named module itself missing;
+    # rather than of an import made by it.
+
+    missing = getattr(error, 'name', None)
+    if missing is not None:
+        return missing == name
+
+    # Python 2 names only the last part of the module.
+    message = six.text_type(error)
+    return message in ('No module named %s' % name,
+                       'No module named %s' % name.rsplit('.', 1)[-1])
+
+
+class Loader(object):
+    """
+    Imports the models modules or packages of the registered components;
+    either right away or deferred until the models are first needed.
+    """
+
+    def __init__(self):
+        #! Components whose models have yet to be imported.
+        self.pending = []
+
+        #! Number of imports currently running.
+        self.active = 0
+
+        self.condition = threading.Condition()
+        self.local = threading.local()
+
+    def defer(self, components):
+        """Defer the import of the models of the passed components.
+        """
+
+        with self.condition:
+            self.pending.extend(c for c in components
+                                if c not in self.pending)
+
+    def _take(self):
+        with self.condition:
+            if self.pending:
+                self.active += 1
+                return self.pending.pop(0)
+
+    def _import(self, component):
+        self.local.importing = True
+        try:
+            with profile.phase('models', component):
+                # Mirror flask-components; a component need not have
+                # models.
+                module = import_module(component)
+                if getattr(module, 'models', None) is None:
+                    name = '%s.models' % component
+                    try:
+                        import_module(name)
+
+                    except ImportError as error:
+                        if not _is_missing(error, name):
+                            raise
+
+        except Exception:
+            # Put back; imported again (raising in the thread that needs
+            # the models) by the next `load`.
+            with self.condition:
+                self.pending.insert(0, component)
+
+            raise
+
+        finally:
+            self.local.importing = False
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    def _work(self):
+        while True:
+            component = self._take()
+            if component is None:
+                return
+
+            self._import(component)
+
+    def _warm(self):
+        try:
+            self._work()
+
+        except Exception:
+            # The component was put back for `load` to raise from.
+            pass
+
+    def load(self):
+        """Import the models of every deferred component.
+
+        Returns once all of them have been imported; including those that
+        are being imported by the warm-up threads. The errors of imports
+        that failed (on any thread) are raised here.
+        """
+
+        if not self.pending and not self.active:
+            # Fast path; nothing has been deferred.
+            return
+
+        if getattr(self.local, 'importing', False):
+            # The models being imported are using the models; the import
+            # that is running in this thread can't be waited for.
+            return
+
+        while True:
+            self._work()
+
+            with self.condition:
+                while self.active:
+                    self.condition.wait()
+
+                if not self.pending:
+                    # Else put back by a failed warm-up import.
+                    return
+
+    def warm(self, threads=1):
+        """Import the deferred models on background threads.
+        """
+
+        workers = []
+        for _ in range(threads):
+            worker = threading.Thread(target=self._warm, name='models-warmup')
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        return workers
+
+
+loader = Loader()
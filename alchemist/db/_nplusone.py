@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import, division
+from alchemist.conf import settings
+from contextlib import contextmanager
+from sqlalchemy.orm.strategies import LazyLoader
+from ._queries import fingerprint
+import collections
+import os
+import six
+import sqlalchemy
+import sys
+import threading
+import warnings
+
+
+class LazyLoadWarning(UserWarning):
+    """The same lazy load ran too many times in one scope.
+    """
+
+
+class LazyLoadError(AssertionError):
+    """The same lazy load ran too many times in one scope (when testing).
+    """
+
+
+# Frames of these are skipped looking for the code that made a load; as
+# are the functions SQLAlchemy generates (from strings).
+_internal = (os.path.dirname(sqlalchemy.__file__),
+             os.path.dirname(os.path.abspath(__file__)), '<string>')
+
+_local = threading.local()
+
+
+def _origin():
+    # The relationship lazily loaded by the query being run (None if it is
+    # not a lazy load) and the code that ran it; found up the stack.
+
+    prop = None
+    frame = sys._getframe(2)
+    while frame is not None and \
+            frame.f_code.co_filename.startswith(_internal):
+        if prop is None:
+            loader = frame.f_locals.get('self')
+            if isinstance(loader, LazyLoader):
+                prop = loader.parent_property
+
+        frame = frame.f_back
+
+    site = None
+    if frame is not None:
+        site = '%s:%d in %s' % (
+            frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+
+    return prop, site
+
+
+class Scope(object):
+    """Counts the statements of lazy loads by fingerprint and relationship.
+
+    Once the same lazy load of a relationship has run more than `limit`
+    times a LazyLoadWarning is issued (or a LazyLoadError raised when
+    testing).
+    """
+
+    def __init__(self, limit, name=None):
+        self.limit = limit
+        self.name = name
+
+        #! Number of lazy loads by (fingerprint, relationship).
+        self.counts = collections.Counter()
+
+    def record(self, query):
+        # Only lazy loads are counted; others aren't compiled to be keyed.
+        prop, site = _origin()
+        if prop is None:
+            return
+
+        key = (fingerprint(six.text_type(query.statement)), prop)
+        self.counts[key] += 1
+
+        if self.counts[key] != self.limit + 1:
+            return
+
+        attribute = '%s.%s' % (prop.parent.class_.__name__, prop.key)
+        message = (
+            'Lazy load of %s ran more than %d times%s; last from %s. Load it '
+            "eagerly with options(joinedload('%s')) or subqueryload." % (
+                attribute, self.limit,
+                ' in %s' % self.name if self.name else '',
+                site, prop.key))
+
+        if settings.get('TESTING'):
+            raise LazyLoadError(message)
+
+        warnings.warn(message, LazyLoadWarning, stacklevel=2)
+
+
+def current():
+    """The scope of this thread; None if there is none.
+    """
+
+    return getattr(_local, 'scope', None)
+
+
+def start(limit=None, name=None):
+    """Begin a scope in this thread; returns the one it replaces.
+
+    The limit defaults to $DATABASE_LAZY_LOAD_LIMIT; if that is None the
+    current scope is kept.
+    """
+
+    if limit is None:
+        limit = settings.get('DATABASE_LAZY_LOAD_LIMIT')
+
+    previous = current()
+    if limit is not None:
+        _local.scope = Scope(limit, name)
+
+    return previous
+
+
+def stop(previous=None):
+    """End the scope of this thread (restoring the previous one).
+    """
+
+    scope = current()
+    _local.scope = previous
+    return scope
+
+
+@contextmanager
+def nplusone(limit=None, name=None):
+    """Watch the queries of the block for repeated lazy loads.
+
+    Yields the `Scope` counting them; see `Scope` for the limit. Requests
+    are watched on their own when $DATABASE_LAZY_LOAD_LIMIT is set.
+    """
+
+    previous = start(limit, name)
+    try:
+        yield current()
+
+    finally:
+        stop(previous)
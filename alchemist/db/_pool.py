@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import, division
+import errno
+import json
+import logging
+import os
+import sqlalchemy as sa
+import tempfile
+import threading
+import time
+
+
+#! Upper bounds (in milliseconds) of the buckets of the histograms; the
+#! last bucket is unbounded.
+BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class Histogram(object):
+    """Durations counted into buckets by milliseconds.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = [0] * (len(BUCKETS) + 1)
+            self.total = 0
+
+    def add(self, seconds):
+        milliseconds = seconds * 1000
+        index = len(BUCKETS)
+        for bucket, bound in enumerate(BUCKETS):
+            if milliseconds <= bound:
+                index = bucket
+                break
+
+        with self.lock:
+            self.counts[index] += 1
+            self.total += seconds
+
+    def snapshot(self):
+        with self.lock:
+            count = sum(self.counts)
+            return {
+                'histogram': [[bound, n] for bound, n in zip(
+                    BUCKETS + (None,), self.counts)],
+                'mean': self.total / count if count else 0,
+            }
+
+
+#! Logger that the time each request held connections is written to.
+logger = logging.getLogger('alchemist.db.pool')
+
+#! Time each request held connections checked out; see `start`.
+requests = Histogram()
+
+_local = threading.local()
+
+
+def start():
+    """
+    Start counting the time connections are held out of any pool by this
+    thread.
+    """
+
+    _local.held = 0
+
+
+def stop():
+    """Stop counting; the total is recorded in `requests` and returned.
+
+    None if counting was not started.
+    """
+
+    held = getattr(_local, 'held', None)
+    _local.held = None
+    if held is not None:
+        requests.add(held)
+
+    return held
+
+
+class Metrics(object):
+    """Counters of the connection pool of an engine.
+
+    Collected from the events of the pool and from a subclass of the pool
+    class of the engine (see `metered`) that times each checkout.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.engine = None
+        self.reset()
+
+    def reset(self):
+        """Zero every counter.
+        """
+
+        with self.lock:
+            self.checkouts = 0
+            self.connects = 0
+            self.timeouts = 0
+            self.invalidations = 0
+            self.overflows = 0
+            self.peak_overflow = 0
+            self.wait = Histogram()
+            self.hold = Histogram()
+            self.age_max = 0
+            self.age_total = 0
+
+    def listen(self, target):
+        """Collect the events of the pool of the passed engine.
+        """
+
+        self.engine = target
+        sa.event.listen(target, 'connect', self._connect)
+        sa.event.listen(target, 'checkout', self._checkout)
+        sa.event.listen(target, 'checkin', self._checkin)
+        sa.event.listen(target, 'invalidate', self._invalidate)
+
+    def _connect(self, connection, record):
+        record.info['alchemist.connected'] = time.time()
+        with self.lock:
+            self.connects += 1
+
+    def _checkout(self, connection, record, proxy):
+        now = time.time()
+        record.info['alchemist.checkout'] = now
+        age = now - record.info.get('alchemist.connected', now)
+        with self.lock:
+            self.checkouts += 1
+            self.age_total += age
+            self.age_max = max(self.age_max, age)
+
+    def _checkin(self, connection, record):
+        checkout = record.info.pop('alchemist.checkout', None)
+        if checkout is None:
+            return
+
+        held = time.time() - checkout
+        self.hold.add(held)
+
+        if getattr(_local, 'held', None) is not None:
+            _local.held += held
+
+    def _invalidate(self, connection, record, exception):
+        with self.lock:
+            self.invalidations += 1
+
+    def waited(self, seconds, overflow=0, overflowed=False):
+        """Record a checkout that waited the passed number of seconds.
+
+        The overflow of the pool is that after the checkout; `overflowed`
+        if the checkout opened an overflow connection.
+        """
+
+        self.wait.add(seconds)
+        with self.lock:
+            if overflowed:
+                self.overflows += 1
+
+            self.peak_overflow = max(self.peak_overflow, overflow)
+
+    def timed_out(self):
+        """Record a checkout that timed out.
+        """
+
+        with self.lock:
+            self.timeouts += 1
+
+    def snapshot(self):
+        """The counters (and the state of the pool) as a mapping.
+        """
+
+        with self.lock:
+            data = {
+                'checkouts': self.checkouts,
+                'connects': self.connects,
+                'timeouts': self.timeouts,
+                'invalidations': self.invalidations,
+                'overflows': self.overflows,
+                'peak_overflow': self.peak_overflow,
+                'age': {
+                    'max': self.age_max,
+                    'mean': (self.age_total / self.checkouts
+                             if self.checkouts else 0),
+                },
+            }
+
+        data['wait'] = self.wait.snapshot()
+        data['hold'] = self.hold.snapshot()
+
+        pool = self.engine.pool if self.engine is not None else None
+        data['pool'] = {'class': type(pool).__name__}
+        for name in ('size', 'checkedout', 'overflow'):
+            # Some pools (SingletonThreadPool) hold their size as a number.
+            value = getattr(pool, name, None)
+            if value is not None:
+                data['pool'][name] = value() if callable(value) else value
+
+        return data
+
+
+def metered(poolclass, metrics):
+    """Subclass the pool class to time its checkouts into the metrics.
+
+    Pools recreated by `dispose` keep the subclass and so the metrics.
+    """
+
+    def timed(method):
+        def checkout(self):
+            before = self.overflow() if hasattr(self, 'overflow') else 0
+            start = time.time()
+            try:
+                connection = method(self)
+
+            except sa.exc.TimeoutError:
+                metrics.timed_out()
+                raise
+
+            # The overflow of a QueuePool counts up from minus its size; it
+            # grew past zero when an overflow connection was opened.
+            overflow = self.overflow() if hasattr(self, 'overflow') else 0
+            metrics.waited(time.time() - start, overflow,
+                           overflow > max(before, 0))
+
+            return connection
+
+        return checkout
+
+    return type(str('Metered%s' % poolclass.__name__), (poolclass,), {
+        'metrics': metrics,
+        'connect': timed(poolclass.connect),
+        'unique_connection': timed(poolclass.unique_connection),
+    })
+
+
+#! Least number of seconds between writes of the metrics of a process; see
+#! `publish`.
+PUBLISH_INTERVAL = 1
+
+_published = {'time': 0}
+
+
+def publish(directory, metrics, force=False):
+    """
+    Write the snapshot of the metrics (by the name of their database) and
+    of `requests` to a file of this process in the directory.
+
+    Written at most every `PUBLISH_INTERVAL` seconds unless forced; read
+    back by `collect`.
+    """
+
+    now = time.time()
+    if not force and now - _published['time'] < PUBLISH_INTERVAL:
+        return
+
+    _published['time'] = now
+
+    data = {
+        'pid': os.getpid(),
+        'time': now,
+        'databases': dict((name, target.snapshot())
+                          for name, target in metrics.items()),
+        'requests': requests.snapshot(),
+    }
+
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+
+        except OSError:
+            # Made by another process in the meantime.
+            if not os.path.isdir(directory):
+                raise
+
+    # Written aside and renamed into place; readers see either file whole.
+    descriptor, temporary = tempfile.mkstemp(dir=directory)
+    with os.fdopen(descriptor, 'w') as stream:
+        json.dump(data, stream)
+
+    os.rename(temporary, os.path.join(directory, '%d.json' % data['pid']))
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+
+    except OSError as ex:
+        # Only a process that does not exist is dead; another (of another
+        # user, say) may just not be signalled by this one.
+        return ex.errno != errno.ESRCH
+
+    return True
+
+
+def collect(directory):
+    """The snapshots published to the directory; by process.
+
+    Those of processes that have since ended are removed.
+    """
+
+    snapshots = []
+    if not os.path.isdir(directory):
+        return snapshots
+
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.json'):
+            continue
+
+        path = os.path.join(directory, name)
+        try:
+            with open(path) as stream:
+                data = json.load(stream)
+
+        except (IOError, OSError, ValueError):
+            continue
+
+        if hasattr(os, 'kill') and not _alive(data['pid']):
+            try:
+                os.remove(path)
+
+            except OSError:
+                pass
+
+            continue
+
+        snapshots.append(data)
+
+    return snapshots
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import, division
+from alchemist import utils
+from logging.handlers import RotatingFileHandler
+import collections
+import hashlib
+import logging
+import random
+import re
+import sqlalchemy as sa
+import threading
+import time
+
+#! Logger that slow and sampled statements are written to.
+logger = logging.getLogger('alchemist.db.queries')
+
+_literals = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'%\([^)]*\)s|(?<!:):\w+|%s'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(?)'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def fingerprint(statement):
+    """
+    Normalize the statement; literals, parameters and lists of either
+    collapse so that statements differing only in those are alike.
+    """
+
+    for pattern, replacement in _literals:
+        statement = pattern.sub(replacement, statement)
+
+    return statement.strip()
+
+
+@utils.memoize
+def _handler(filename, size, backups):
+    handler = RotatingFileHandler(
+        filename, maxBytes=size, backupCount=backups, delay=True)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    return handler
+
+
+class QueryLog(object):
+    """Times the statements executed by an engine.
+
+    Statements slower than `slow` milliseconds, and a `sample` of the
+    rest, are kept in a ring buffer of the last `size` entries and are
+    written to the `alchemist.db.queries` logger (and the rotating log
+    file if one is named).
+    """
+
+    def __init__(self, slow=None, sample=0, size=1000, filename=None,
+                 file_size=10 * 1024 * 1024, backups=5):
+        self.slow = slow
+        self.sample = sample
+
+        #! The most recent entries; oldest first.
+        self.entries = collections.deque(maxlen=size)
+
+        self.lock = threading.Lock()
+
+        if filename:
+            _handler(filename, file_size, backups)
+
+    @property
+    def enabled(self):
+        return self.slow is not None or self.sample > 0
+
+    def listen(self, target):
+        """Time the statements executed by the passed engine.
+        """
+
+        sa.event.listen(target, 'before_cursor_execute', self._before)
+        sa.event.listen(target, 'after_cursor_execute', self._after)
+        sa.event.listen(target, 'dbapi_error', self._error)
+
+    def _before(self, conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault('alchemist.query_start', []).append(time.time())
+
+    def _error(self, conn, cursor, statement, parameters, context, exception):
+        # The statement failed; `_after` won't be called to pair it with
+        # its start.
+        starts = conn.info.get('alchemist.query_start')
+        if starts:
+            starts.pop()
+
+    def _after(self, conn, cursor, statement, parameters, context, many):
+        duration = (time.time() - conn.info['alchemist.query_start'].pop())
+        duration *= 1000
+
+        slow = self.slow is not None and duration >= self.slow
+        if not slow and not (self.sample and random.random() < self.sample):
+            return
+
+        normal = fingerprint(statement)
+        entry = {
+            'time': time.time(),
+            'milliseconds': duration,
+            'slow': slow,
+            'fingerprint': normal,
+            'hash': hashlib.md5(normal.encode('utf8')).hexdigest()[:12],
+            'statement': statement,
+        }
+
+        with self.lock:
+            self.entries.append(entry)
+
+        logger.log(
+            logging.WARNING if slow else logging.INFO,
+            '%s %.2fms [%s] %s', 'slow' if slow else 'sample', duration,
+            entry['hash'], normal)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
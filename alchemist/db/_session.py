@@ -1,14 +1,66 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import, division
-from . import engine, query
-from flask import appcontext_tearing_down, g
-from sqlalchemy import orm
+from . import engine, query, _engine, _nplusone, _pool, _shard
+from ._engine import route
+from alchemist.conf import settings
+from flask import (appcontext_tearing_down, request_started, request_finished,
+                   g, request, has_request_context, after_this_request,
+                   current_app, _app_ctx_stack)
+from sqlalchemy import exc, inspect, orm
+from sqlalchemy.ext.declarative.api import DeclarativeMeta
+from sqlalchemy.sql import expression
+from sqlalchemy.sql.expression import Select, CompoundSelect
+from sqlalchemy.sql.util import find_tables
 from werkzeug import LocalProxy
+import time
+
+
+def _is_read(clause):
+    """Whether the passed statement only reads (and locks nothing).
+    """
+
+    if not isinstance(clause, (Select, CompoundSelect)):
+        return False
+
+    return not (getattr(clause, '_for_update_arg', None)
+                or getattr(clause, 'for_update', False))
+
+
+def _route(mapper, clause):
+    """The name of the database the mapper (or the clause) is routed to.
+    """
+
+    if not settings.get('DATABASE_ROUTES'):
+        return 'default'
+
+    model = getattr(mapper, 'class_', None)
+    if model is None and isinstance(mapper, type):
+        model = mapper
+
+    if model is None and clause is not None:
+        # Route by the first table of a model the statement refers to.
+        for table in find_tables(clause, include_crud=True):
+            model = getattr(table, 'class_', None)
+            if model is not None:
+                break
+
+    return route(model)
 
 
 class Session(orm.Session):
 
-    def __init__(self, **kwargs):
+    #! Dialects that can start a read-only transaction.
+    readonly_dialects = frozenset(('postgresql', 'mysql'))
+
+    def __init__(self, readonly=False, **kwargs):
+
+        #! Whether the session only reads; it then holds no transaction (each
+        #! statement returns its connection to the pool) and refuses to
+        #! flush changes.
+        self.readonly = readonly
+        if readonly:
+            kwargs.setdefault('autocommit', True)
+            kwargs.setdefault('autoflush', False)
 
         # Default the bind and query class.
 
@@ -31,18 +83,295 @@ class Session(orm.Session):
 
         super(Session, self).__init__(**kwargs)
 
+        #! Whether the current transaction has written; it then stays on
+        #! the primary until it ends.
+        self._written = False
+
+        #! The replica of each database the reads of the current
+        #! transaction go to.
+        self._replicas = {}
+
+        #! Whether a write has been committed by this session; its reads
+        #! then stay on the primary so that they see it.
+        self._pinned = False
+
+        #! Time until which reads stay on the primary; carried over to the
+        #! next requests of the client by the pin cookie (or token).
+        self.pinned_until = 0
+
+        #! Whether the pin cookie is to be set on the response.
+        self._cookie = False
+
     def __repr__(self):
         return '<Session(bind=%r)>' % self.bind
 
+    def _connection_for_bind(self, engine, *args, **kwargs):
+        connection = super(Session, self)._connection_for_bind(
+            engine, *args, **kwargs)
+
+        if (self.readonly and settings.get('DATABASE_READONLY_TRANSACTION')
+                and engine.dialect.name in self.readonly_dialects):
+            # Straight through the DBAPI; the connection may be set to close
+            # with its (first) result.
+            cursor = connection.connection.cursor()
+            try:
+                cursor.execute('SET TRANSACTION READ ONLY')
+
+            finally:
+                cursor.close()
+
+        return connection
+
+    def query(self, *entities, **kwargs):
+        if len(entities) == 1 and not kwargs and \
+                self._query_cls is query.Query and \
+                isinstance(entities[0], DeclarativeMeta):
+            return query.over(entities[0], self)
+
+        return super(Session, self).query(*entities, **kwargs)
+
+    def flush(self, *args, **kwargs):
+        if self.readonly and (self.new or self.dirty or self.deleted):
+            raise exc.InvalidRequestError(
+                'Session is read-only; changes cannot be flushed.')
+
+        super(Session, self).flush(*args, **kwargs)
+
+    #! The shard that statements of sharded models run against; set while
+    #! a bulk operation of a query limited to one runs (see `Query.update`).
+    _shard_id = None
+
+    def execute(self, clause, params=None, mapper=None, bind=None, **kwargs):
+        if bind is not None or kwargs.get('shard_id') is not None:
+            return super(Session, self).execute(
+                clause, params, mapper, bind, **kwargs)
+
+        clause = expression._literal_as_text(clause)
+        if mapper is not None:
+            model = _shard.model_of(inspect(mapper))
+
+        else:
+            model = _shard.model_of_clause(clause)
+
+        if model is None:
+            return super(Session, self).execute(
+                clause, params, mapper, **kwargs)
+
+        # A statement of a sharded model runs against the shards it is
+        # restricted to (by the shard key); each of them otherwise.
+        if self._shard_id is not None:
+            shards = [self._shard_id]
+
+        else:
+            shards = _shard.choose_for(clause, model, params)
+
+        if len(shards) > 1:
+            _shard.check(clause, model)
+
+        results = [super(Session, self).execute(
+            clause, params, mapper, shard_id=shard, **kwargs)
+            for shard in shards]
+
+        return results[0] if len(results) == 1 else _shard.Results(results)
+
+    def connection(self, mapper=None, clause=None, bind=None,
+                   close_with_result=False, shard_id=None, instance=None,
+                   **kwargs):
+        if bind is None and (shard_id is not None or instance is not None):
+            bind = self.get_bind(
+                mapper, clause, shard_id=shard_id, instance=instance)
+
+        return super(Session, self).connection(
+            mapper, clause, bind, close_with_result, **kwargs)
+
+    def connection_callable(self, mapper, instance):
+        # Used by the flush to find the connection for each instance.
+        return self.connection(mapper, instance=instance)
+
+    def get_bind(self, mapper=None, clause=None, shard_id=None,
+                 instance=None, **kwargs):
+        if shard_id is None and instance is not None:
+            model = _shard.model_of(mapper)
+            if model is not None:
+                shard_id = _shard.of_instance(model, instance)
+
+        if shard_id is not None:
+            # Sharded models are read from and written to the shard.
+            return engine[shard_id]
+
+        primary = super(Session, self).get_bind(mapper, clause)
+        if primary is not engine['default']:
+            # Explicitly bound elsewhere; leave it be.
+            return primary
+
+        name = _route(mapper, clause)
+        if name != 'default':
+            primary = engine[name]
+
+        # Reads go to a replica of the database unless the transaction has
+        # written (or is writing) to the primary.
+
+        if self._flushing or self._written or not _is_read(clause):
+            self._written = True
+            return primary
+
+        if self._pinned or self.pinned_until > time.time():
+            return primary
+
+        replica = self._replicas.get(name)
+        if replica is None:
+            replica = self._replicas[name] = engine.replica(name)
+
+        return replica
+
+    def _end(self):
+        self._written = False
+        self._replicas = {}
+
+    @property
+    def token(self):
+        """
+        Token to hand back to `pin` in a later request of the client; None
+        if its reads need not stay on the primary.
+        """
+
+        if self.pinned_until > time.time():
+            return '%.3f' % self.pinned_until
+
+    def pin(self, token):
+        """Keep reads on the primary until the time held by the token.
+
+        The time is capped to $DATABASE_PIN_SECONDS from now; malformed
+        tokens are ignored.
+        """
+
+        try:
+            until = float(token)
+
+        except (TypeError, ValueError):
+            return
+
+        limit = time.time() + settings.get('DATABASE_PIN_SECONDS', 0)
+        self.pinned_until = max(self.pinned_until, min(until, limit))
+
+    def _committed(self):
+        # Reads-your-writes; the rest of the context reads from the primary
+        # as do the requests of the client in the next seconds.
+
+        self._pinned = True
+
+        seconds = settings.get('DATABASE_PIN_SECONDS', 0)
+        if not seconds:
+            return
+
+        self.pinned_until = time.time() + seconds
+        if has_request_context() and not self._cookie:
+            self._cookie = True
+            after_this_request(self._set_cookie)
+
+    def _set_cookie(self, response):
+        token = self.token
+        if token is not None:
+            response.set_cookie(
+                settings.get('DATABASE_PIN_COOKIE', 'alchemist_pin'), token,
+                max_age=settings.get('DATABASE_PIN_SECONDS', 0),
+                httponly=True)
+
+        return response
+
+    def commit(self):
+        try:
+            # Read once committed; the flush made by the commit marks it.
+            super(Session, self).commit()
+            if self._written:
+                self._committed()
+
+        finally:
+            self._end()
+
+    def rollback(self):
+        try:
+            super(Session, self).rollback()
+
+        finally:
+            self._end()
+
+    def close(self):
+        try:
+            super(Session, self).close()
+
+        finally:
+            self._end()
+
+
+def readonly(view):
+    """Mark the view as only reading from the database.
+
+    Requests to it get a read-only session; as do requests made with one
+    of $DATABASE_READONLY_METHODS to views not marked `readonly = False`.
+    """
+
+    view.readonly = True
+    return view
+
+
+def _is_readonly():
+    if not has_request_context():
+        return False
+
+    view = current_app.view_functions.get(request.endpoint)
+    marked = getattr(view, 'readonly', None)
+    if marked is not None:
+        return marked
+
+    return request.method in settings.get('DATABASE_READONLY_METHODS', ())
+
 
 def _get_session():
-    _session = getattr(g, '_session', None)
+    # Read the application context stack directly instead of paying for
+    # the resolution of the `g` proxy.
+    context = _app_ctx_stack.top
+    store = context.g if context is not None else g
+
+    _session = getattr(store, '_session', None)
     if _session is None:
-        _session = g._session = Session()
+        _session = store._session = Session(readonly=_is_readonly())
+        if has_request_context():
+            _session.pin(request.cookies.get(
+                settings.get('DATABASE_PIN_COOKIE', 'alchemist_pin')))
 
     return _session
 
 
+def release():
+    """
+    Close the session of the current context (if one was made), returning
+    its connections to the pools.
+
+    Anything not committed is rolled back and the loaded instances are
+    detached; a later use of `session` begins anew. Meant for views that
+    are done with the database before they are done responding.
+    """
+
+    _session = getattr(g, '_session', None)
+    if _session is not None:
+        _session.close()
+
+
+@request_started.connect
+def _start_request(*args, **kwargs):
+    g._request = '%s %s' % (request.method, request.path)
+    g._nplusone = (_nplusone.start(name=g._request),)
+    _pool.start()
+
+
+@request_finished.connect
+def _finish_request(*args, **kwargs):
+    # The response is built; it may yet take a while to send (or stream).
+    if settings.get('DATABASE_RELEASE_EARLY'):
+        release()
+
+
 @appcontext_tearing_down.connect
 def _teardown_session(*args, **kwargs):
     """
@@ -52,16 +381,29 @@ def _teardown_session(*args, **kwargs):
     This ensures that the database connnection is closed appropriately.
     """
 
-    _session = getattr(g, '_session', None)
-    if _session is not None:
-        _session.close()
+    release()
+
+    started = getattr(g, '_nplusone', None)
+    if started is not None:
+        _nplusone.stop(*started)
+
+    held = _pool.stop()
+    if held is not None:
+        _pool.logger.debug('%s held connections for %.2fms', getattr(
+            g, '_request', None), held * 1000)
+
+        # Let `db pool` (run in another process) show these.
+        directory = settings.get('DATABASE_METRICS')
+        if directory:
+            _pool.publish(directory, _engine.metrics())
 
 
 session = LocalProxy(_get_session)
 
 
 def refresh():
-    if session:
-        session.expire_all()
-        session.expunge_all()
-        session.commit()
+    _session = getattr(g, '_session', None)
+    if _session is not None:
+        _session.expire_all()
+        _session.expunge_all()
+        _session.commit()
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import, division
+from alchemist.conf import settings
+from sqlalchemy import exc
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import (
+    BinaryExpression, BindParameter, BooleanClauseList, ClauseList, Grouping)
+from sqlalchemy.sql.expression import Insert, Select
+from sqlalchemy.sql.util import find_tables
+import itertools
+import threading
+
+
+def model_of(mapper):
+    """The sharded model of the mapper; None if it is not sharded.
+    """
+
+    model = getattr(mapper, 'class_', None)
+    if getattr(model, '__shard__', None) is not None:
+        return model
+
+
+def model_of_clause(clause):
+    """The sharded model of the first table of the statement with one.
+    """
+
+    for table in find_tables(clause, include_crud=True):
+        model = getattr(table, 'class_', None)
+        if model is not None and getattr(model, '__shard__', None) is not None:
+            # The table holds a proxy of the model.
+            return model.__mapper__.class_
+
+
+def key_of(model):
+    """The column holding the shard key of the sharded model.
+
+    Named by `__shard_key__`; else the (single) primary key.
+    """
+
+    mapper = model.__mapper__
+    name = getattr(model, '__shard_key__', None)
+    if name is not None:
+        return mapper.columns[name]
+
+    return mapper.primary_key[0]
+
+
+def names(model):
+    """Every shard of the sharded model.
+
+    Named by `__shards__`; else every configured database.
+    """
+
+    shards = getattr(model, '__shards__', None)
+    if shards is None:
+        shards = sorted(settings.get('DATABASES', {}))
+
+    return list(shards)
+
+
+def of_instance(model, instance):
+    """The shard the instance of the sharded model belongs to.
+    """
+
+    key = key_of(model)
+    prop = model.__mapper__.get_property_by_column(key)
+    return model.__shard__(getattr(instance, prop.key))
+
+
+def _values(clause, key, params):
+    # The values the shard key is restricted to by the clause; None if it
+    # is not.
+
+    def value(element):
+        if isinstance(element, BindParameter):
+            if element.key in params:
+                return params[element.key]
+
+            return element.effective_value
+
+        raise LookupError
+
+    if isinstance(clause, BooleanClauseList) and clause.operator is \
+            operators.and_:
+        for element in clause.clauses:
+            found = _values(element, key, params)
+            if found is not None:
+                return found
+
+        return None
+
+    if not isinstance(clause, BinaryExpression):
+        return None
+
+    left, right = clause.left, clause.right
+    if not getattr(left, 'shares_lineage', None) or \
+            not left.shares_lineage(key):
+        left, right = right, left
+
+    if not getattr(left, 'shares_lineage', None) or \
+            not left.shares_lineage(key):
+        return None
+
+    try:
+        if clause.operator is operators.eq:
+            return [value(right)]
+
+        if clause.operator is operators.in_op:
+            if isinstance(right, Grouping):
+                right = right.element
+
+            if isinstance(right, ClauseList):
+                return [value(element) for element in right.clauses]
+
+    except LookupError:
+        pass
+
+    return None
+
+
+def choose(query, model):
+    """The shards the query is to be run against.
+
+    Restricted by an equality (or IN) on the shard key in the criterion
+    of the query; else every shard. The choice is remembered for the
+    statement (criterion and parameters) of the query.
+    """
+
+    cached = query.__dict__.get('_shard_choice')
+    if cached is not None and cached[0] is query._criterion and \
+            cached[1] is query._params:
+        return cached[2]
+
+    shards = None
+    if query._criterion is not None:
+        values = _values(query._criterion, key_of(model), query._params)
+        if values is not None:
+            shards = []
+            for value in values:
+                shard = model.__shard__(value)
+                if shard not in shards:
+                    shards.append(shard)
+
+    if shards is None:
+        shards = names(model)
+
+    query._shard_choice = (query._criterion, query._params, shards)
+    return shards
+
+
+def choose_for(statement, model, params):
+    """The shards the (core) statement is to be run against.
+
+    An INSERT goes to the shard of the key in its values; raises if there
+    is none. Others are restricted as in `choose`.
+    """
+
+    key = key_of(model)
+    params = params if isinstance(params, dict) else {}
+
+    if isinstance(statement, Insert):
+        values = dict((getattr(column, 'key', column), value)
+                      for column, value in (statement.parameters or {}).items())
+        values.update(params)
+        if key.key not in values:
+            raise exc.InvalidRequestError(
+                'The shard of the INSERT into %s is not known without the '
+                'value of %s; pass shard_id.' % (model.__name__, key.key))
+
+        return [model.__shard__(values[key.key])]
+
+    criterion = getattr(statement, '_whereclause', None)
+    values = None
+    if criterion is not None:
+        values = _values(criterion, key, params)
+
+    if values is None:
+        return names(model)
+
+    shards = []
+    for value in values:
+        shard = model.__shard__(value)
+        if shard not in shards:
+            shards.append(shard)
+
+    return shards
+
+
+class Results(object):
+    """The results of a statement run against several shards.
+
+    The rows are those of each shard in turn; the row count their sum.
+    """
+
+    def __init__(self, results):
+        self.results = results
+
+    @property
+    def rowcount(self):
+        return sum(result.rowcount for result in self.results)
+
+    def __iter__(self):
+        return itertools.chain(*self.results)
+
+    def fetchall(self):
+        return list(self)
+
+    def close(self):
+        for result in self.results:
+            result.close()
+
+
+def check(statement, model):
+    """Raise unless the statement can be run against each shard alike.
+    """
+
+    if isinstance(statement, Select) and (
+            statement._order_by_clause.clauses or
+            statement._limit is not None or statement._offset is not None):
+        raise exc.InvalidRequestError(
+            'Ordering or limiting a statement across the shards of %s needs '
+            'a query (which merges the results); or pass shard_id.' % (
+                model.__name__))
+
+
+def execute(connections, statement, params):
+    """Execute the statement on each connection; in parallel.
+
+    Returns the results in the order of the connections.
+    """
+
+    if len(connections) == 1:
+        return [connections[0].execute(statement, params)]
+
+    results = [None] * len(connections)
+    errors = []
+
+    def run(index, connection):
+        try:
+            results[index] = connection.execute(statement, params)
+
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=run, args=item)
+               for item in enumerate(connections)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    return results
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import, division
+from alchemist.conf import settings
+from . import _engine, _session
+from concurrent.futures import ThreadPoolExecutor
+from flask import _app_ctx_stack
+from sqlalchemy import orm
+from werkzeug import LocalProxy
+import asyncio
+import threading
+import weakref
+
+try:
+    import contextvars
+
+except ImportError:  # pragma: nocoverage
+    contextvars = None
+
+__all__ = [
+    'engine',
+    'AsyncEngine',
+    'AsyncSession',
+    'AsyncQuery',
+    'session',
+    'remove',
+]
+
+# SQLAlchemy only drives blocking database APIs; each operation is run on
+# a bounded pool of threads shared by every event loop and the caller is
+# handed a future to await. Many concurrent waits thus share a handful of
+# threads (sized to $DATABASE_AIO_THREADS) instead of holding one each.
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _pool():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    settings.get('DATABASE_AIO_THREADS', 10))
+
+    return _executor
+
+
+def _run(function, *args, **kwargs):
+    """Run the function on the pool; returns a future of its result.
+
+    The function runs in the application context of the caller.
+    """
+
+    top = _app_ctx_stack.top
+    app = top.app if top is not None else None
+
+    def call():
+        if app is None:
+            return function(*args, **kwargs)
+
+        with app.app_context():
+            return function(*args, **kwargs)
+
+    return asyncio.get_event_loop().run_in_executor(_pool(), call)
+
+
+def _locked(lock, function):
+    # The function run holding the lock (if any).
+
+    if lock is None:
+        return function
+
+    def call(*args, **kwargs):
+        with lock:
+            return function(*args, **kwargs)
+
+    return call
+
+
+class Result(object):
+    """The buffered result of a statement.
+    """
+
+    def __init__(self, result):
+        self.rows = result.fetchall() if result.returns_rows else None
+        self.rowcount = result.rowcount
+        result.close()
+
+    def __iter__(self):
+        return iter(self.rows or ())
+
+    def first(self):
+        return self.rows[0] if self.rows else None
+
+    def scalar(self):
+        row = self.first()
+        return row[0] if row is not None else None
+
+
+def _execute(bind, statement, *multiparams, **params):
+    connection = bind.connect()
+    try:
+        return Result(connection.execute(statement, *multiparams, **params))
+
+    finally:
+        connection.close()
+
+
+class AsyncEngine(object):
+    """An engine of `alchemist.db.engine` driven from an event loop.
+    """
+
+    def __init__(self, target):
+        #! The (blocking) engine.
+        self.sync = target
+
+    def __repr__(self):
+        return '<AsyncEngine(%r)>' % self.sync
+
+    def execute(self, statement, *multiparams, **params):
+        """Execute the statement; returns a future of the `Result`.
+        """
+
+        return _run(_execute, self.sync, statement, *multiparams, **params)
+
+    def dispose(self):
+        return _run(self.sync.dispose)
+
+
+class Engine(object):
+    """The engines configured by $DATABASES for use from an event loop.
+    """
+
+    def __getitem__(self, name):
+        return AsyncEngine(_engine.engine[name])
+
+    def __getattr__(self, name):
+        return getattr(self['default'], name)
+
+
+engine = Engine()
+
+
+class AsyncQuery(object):
+    """A query whose methods that load return futures.
+
+    Everything else (filtering, ordering, options) builds the query as
+    usual. Loaded instances are not reloaded behind the scenes from the
+    event loop; eager-load what is needed.
+    """
+
+    #! Methods of the query that run it.
+    loading = frozenset((
+        'all', 'first', 'one', 'scalar', 'count', 'get', 'delete', 'update',
+        'exists'))
+
+    def __init__(self, query, lock=None):
+        #! The (blocking) query.
+        self.sync = query
+
+        #! The lock of the session of the query; see `AsyncSession`.
+        self.lock = lock
+
+    def __iter__(self):
+        raise TypeError(
+            'An asynchronous query is not iterable; await `all()` instead.')
+
+    def __getattr__(self, name):
+        attribute = getattr(self.sync, name)
+        if not callable(attribute):
+            return attribute
+
+        if name in self.loading:
+            return lambda *args, **kwargs: _run(
+                _locked(self.lock, attribute), *args, **kwargs)
+
+        def build(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            if isinstance(result, orm.Query):
+                return type(self)(result, self.lock)
+
+            return result
+
+        return build
+
+
+class AsyncSession(object):
+    """A session whose operations that reach the database return futures.
+
+    Its operations run one at a time (those awaited together, as with
+    `asyncio.gather`, wait for each other on the pool); still, `session`
+    gives each task one of its own. Instances are not expired on commit
+    as reloading them would block the event loop.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('expire_on_commit', False)
+
+        #! The (blocking) session.
+        self.sync = _session.Session(**kwargs)
+
+        #! Held by the operation running on the session.
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return '<AsyncSession(bind=%r)>' % self.sync.bind
+
+    def __getattr__(self, name):
+        # Operations that don't reach the database (add, expunge, etc.).
+        return getattr(self.sync, name)
+
+    def _run(self, function, *args, **kwargs):
+        return _run(_locked(self.lock, function), *args, **kwargs)
+
+    def query(self, *entities, **kwargs):
+        return AsyncQuery(self.sync.query(*entities, **kwargs), self.lock)
+
+    def execute(self, clause, params=None, **kwargs):
+        return self._run(lambda: Result(
+            self.sync.execute(clause, params, **kwargs)))
+
+    def get(self, model, ident):
+        return self._run(self.sync.query(model).get, ident)
+
+    def save(self, instance, commit=False):
+        """Add the instance to the session and flush (or commit) it.
+        """
+
+        self.sync.add(instance)
+        return self._run(self.sync.commit if commit else self.sync.flush)
+
+    def refresh(self, instance, *args, **kwargs):
+        return self._run(self.sync.refresh, instance, *args, **kwargs)
+
+    def flush(self, *args, **kwargs):
+        return self._run(self.sync.flush, *args, **kwargs)
+
+    def commit(self):
+        return self._run(self.sync.commit)
+
+    def rollback(self):
+        return self._run(self.sync.rollback)
+
+    def close(self):
+        return self._run(self.sync.close)
+
+
+def _current_task():
+    try:
+        current = asyncio.current_task
+
+    except AttributeError:  # pragma: nocoverage
+        current = asyncio.Task.current_task
+
+    try:
+        return current()
+
+    except RuntimeError:
+        # No running event loop.
+        return None
+
+
+#! Sessions of the code running outside of any task; per thread.
+_local = threading.local()
+
+if contextvars is not None:
+    _scope = contextvars.ContextVar('alchemist.db.aio.session', default=None)
+
+else:  # pragma: nocoverage
+    _scope = weakref.WeakKeyDictionary()
+
+
+def _scoped(create=True):
+    task = _current_task()
+    if task is None:
+        current = getattr(_local, 'session', None)
+        if current is None and create:
+            current = _local.session = AsyncSession()
+
+        return current
+
+    if contextvars is not None:
+        # Tasks inherit the context of the task that spawned them; the
+        # session is only that of the task it was created in.
+        scoped = _scope.get()
+        if scoped is not None and scoped[0]() is task:
+            return scoped[1]
+
+        if not create:
+            return None
+
+        current = AsyncSession()
+        _scope.set((weakref.ref(task), current))
+        return current
+
+    current = _scope.get(task)  # pragma: nocoverage
+    if current is None and create:  # pragma: nocoverage
+        current = _scope[task] = AsyncSession()
+
+    return current  # pragma: nocoverage
+
+
+#! The session of the current task.
+session = LocalProxy(_scoped)
+
+
+def remove():
+    """
+    Close and forget the session of the current task; returns a future of
+    it closing (or None if there was no session).
+    """
+
+    current = _scoped(create=False)
+    if current is None:
+        return None
+
+    task = _current_task()
+    if task is None:
+        _local.session = None
+
+    elif contextvars is not None:
+        _scope.set(None)
+
+    else:  # pragma: nocoverage
+        _scope.pop(task, None)
+
+    return current.close()
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import, division
+from alchemist import utils
+from alchemist.conf import settings
+from importlib import import_module
+from sqlalchemy import event, orm
+import collections
+import hashlib
+import itertools
+import os
+import six
+import tempfile
+import threading
+import time
+import uuid
+
+__all__ = [
+    'MemoryCache',
+    'FileCache',
+    'backend',
+    'invalidate',
+]
+
+# Cached results are keyed (see `Query.cache`) on the statement, its
+# parameters and a token of each table it reads from. Writing to a table
+# replaces its token; entries of the table are then never read again and
+# age out of the backend.
+
+
+class MemoryCache(object):
+    """Cache in this process of up to `size` bytes of entries.
+
+    The least recently used entries are evicted to make room.
+    """
+
+    def __init__(self, size=64 * 1024 * 1024):
+        self.size = size
+        self.used = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                self.used -= len(value)
+                return None
+
+            # Most recently used last.
+            self.entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl is not None else None
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.used -= len(entry[0])
+
+            if len(value) > self.size:
+                return
+
+            while self.entries and self.used + len(value) > self.size:
+                _, entry = self.entries.popitem(last=False)
+                self.used -= len(entry[0])
+
+            self.entries[key] = (value, expires)
+            self.used += len(value)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.used = 0
+
+
+class FileCache(object):
+    """Cache of entries in files of a directory; shared by processes.
+
+    Point the directory at a memory file system (such as /dev/shm) to keep
+    it off the disk. Expired entries are removed as they are read.
+    """
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.path.join(tempfile.gettempdir(), 'alchemist-cache')
+
+        self.directory = directory
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+
+            except OSError:
+                # Made by another process in the meantime.
+                if not os.path.isdir(directory):
+                    raise
+
+    def _path(self, key):
+        name = hashlib.sha1(key.encode('utf8')).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as stream:
+                expires, value = six.moves.cPickle.load(stream)
+
+        except (IOError, OSError, EOFError, ValueError):
+            return None
+
+        if expires is not None and expires < time.time():
+            try:
+                os.remove(path)
+
+            except OSError:
+                pass
+
+            return None
+
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl is not None else None
+
+        # Written aside and renamed into place; readers see either entry
+        # whole.
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(descriptor, 'wb') as stream:
+            six.moves.cPickle.dump((expires, value), stream, -1)
+
+        os.rename(temporary, self._path(key))
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, name))
+
+            except OSError:
+                pass
+
+
+@utils.memoize
+def _backend(name):
+    if isinstance(name, six.string_types):
+        module, name = name.rsplit('.', 1)
+        name = getattr(import_module(module), name)
+
+    if isinstance(name, type):
+        name = name()
+
+    return name
+
+
+def backend():
+    """The backend named by $DATABASE_CACHE.
+
+    An instance, a class or the dotted path to one; a `MemoryCache` by
+    default.
+    """
+
+    return _backend(settings.get(
+        'DATABASE_CACHE', 'alchemist.db.cache.MemoryCache'))
+
+
+def _token(table):
+    return 'alchemist.table:%s' % table
+
+
+def tokens(tables):
+    """The current token of each of the named tables.
+    """
+
+    target = backend()
+    return [target.get(_token(table)) for table in sorted(tables)]
+
+
+def invalidate(*tables):
+    """Forget the cached results that read from the named tables.
+    """
+
+    target = backend()
+    for table in tables:
+        target.set(_token(table), uuid.uuid4().hex)
+
+
+def written(session, tables):
+    """Note that the session has written to the named tables.
+
+    Their results are invalidated now and again once the transaction is
+    committed (as it may have been cached meanwhile by another session);
+    until then the session does not use the cache for them.
+    """
+
+    if not tables:
+        return
+
+    invalidate(*tables)
+    session.info.setdefault('alchemist.cache.written', set()).update(tables)
+
+
+def pending(session):
+    """The tables written by the current transaction of the session.
+    """
+
+    return session.info.get('alchemist.cache.written', ())
+
+
+def _tables(mapper):
+    tables = set(table.name for table in mapper.tables)
+    for prop in mapper.relationships:
+        if prop.secondary is not None:
+            tables.add(prop.secondary.name)
+
+    return tables
+
+
+@event.listens_for(orm.Session, 'after_flush')
+def _flushed(session, context):
+    tables = set()
+    for instance in itertools.chain(
+            session.new, session.dirty, session.deleted):
+        tables.update(_tables(orm.object_mapper(instance)))
+
+    written(session, tables)
+
+
+@event.listens_for(orm.Session, 'after_bulk_update')
+@event.listens_for(orm.Session, 'after_bulk_delete')
+def _bulk(context):
+    mapper = context.query._mapper_zero_or_none()
+    if mapper is not None:
+        written(context.session, _tables(mapper))
+
+
+@event.listens_for(orm.Session, 'after_commit')
+def _committed(session):
+    invalidate(*session.info.pop('alchemist.cache.written', ()))
+
+
+@event.listens_for(orm.Session, 'after_transaction_end')
+def _ended(session, transaction):
+    if transaction._parent is None:
+        session.info.pop('alchemist.cache.written', None)
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import, division
 from alchemist.db import session
+from alchemist.db._session import _get_session
+from alchemist.db._loader import loader
 from alchemist.conf import settings
 from importlib import import_module
 from alchemist.db.query import Query
@@ -8,6 +10,7 @@ from sqlalchemy.orm.util import has_identity
 from sqlalchemy.ext.declarative import clsregistry
 from sqlalchemy.ext.declarative import declared_attr, DeclarativeMeta, base
 import sqlalchemy as sa
+from werkzeug import LocalProxy
 import weakref
 import re
 import six
@@ -47,6 +50,32 @@ _metadata_map = {}
 _registry_map = {}
 
 
+def _loaded(target):
+    """
+    Proxy to the target that ensures the models of every component have
+    been imported before it is used.
+    """
+
+    def resolve():
+        loader.load()
+        return target
+
+    return LocalProxy(resolve)
+
+
+#! Public views of the above that import any deferred models on first use.
+metadata = _loaded(_metadata)
+component_metadata = _loaded(_metadata_map)
+registry = _loaded(_registry_map)
+
+
+@sa.event.listens_for(sa.orm.mapper, 'before_configured')
+def _load_models():
+    # Mapped classes are being used; any relationship may reference a
+    # model that has yet to be imported.
+    loader.load()
+
+
 def _is_model(name, bases, attrs):
 
     if name == 'NewBase' and not attrs and not bases:
@@ -123,7 +152,19 @@ class ModelBase(six.with_metaclass(ModelBaseProxy, type)):
             session.query(Model).all()
         """
 
-        return session.query(self)
+        # Straight to the session of the context; past the proxy.
+        return _get_session().query(self)
+
+    @property
+    def aquery(self):
+        """
+        Create a query over this model in the session of the current
+        asyncio task; see `alchemist.db.aio`. ::
+            await Model.aquery.filter_by(name='x').all()
+        """
+
+        from alchemist.db import aio
+        return aio.session.query(self)
 
     @property
     def _decl_class_registry(self):
@@ -194,6 +235,17 @@ class Model(six.with_metaclass(ModelBase)):
 
     __abstract__ = True
 
+    #! Function from the shard key of an instance to the name of the
+    #! database (shard) it is stored in; None if the model is not sharded.
+    __shard__ = None
+
+    #! Name of the column holding the shard key; the primary key if None.
+    __shard_key__ = None
+
+    #! Names of the shards queried when a query can't be routed to some of
+    #! them; every configured database if None.
+    __shards__ = None
+
     __init__ = base._declarative_constructor
 
     @declared_attr
@@ -226,3 +278,44 @@ class Model(six.with_metaclass(ModelBase)):
         else:
             # Just flush the session; do not commit.
             session.flush()
+
+    @classmethod
+    def bulk_save(cls, instances, batch_size=1000, return_defaults=False):
+        """Save the instances in batches; bypassing the unit of work.
+
+        New instances are inserted and the changed attributes of persisted
+        ones are updated; `batch_size` rows at a time by `executemany` (or
+        a multi-VALUES INSERT where that is faster). The instances may be
+        streamed from a generator; they are not added to the session and
+        their relationships are not cascaded.
+
+        With `return_defaults` the primary keys generated by the database
+        are set on the instances; those inserts are made one at a time.
+        """
+
+        from alchemist.db import _bulk
+        _bulk.save(session, cls.__mapper__, instances, batch_size,
+                   return_defaults)
+
+    @classmethod
+    def bulk_insert_mappings(cls, mappings, batch_size=1000,
+                             return_defaults=False):
+        """Insert the rows of the mappings (of attribute name to value).
+
+        As `bulk_save`; with `return_defaults` the generated primary keys
+        are set on the mappings.
+        """
+
+        from alchemist.db import _bulk
+        _bulk.insert_mappings(session, cls.__mapper__, mappings, batch_size,
+                              return_defaults)
+
+    def asave(self, commit=False):
+        """Save the changes to the model from an asyncio task.
+
+        As `save` but in the session of the current task; returns a future
+        to await. See `alchemist.db.aio`.
+        """
+
+        from alchemist.db import aio
+        return aio.session.save(self, commit=commit)
@@ -2,9 +2,13 @@
 from __future__ import unicode_literals, absolute_import, division
 from .sql import init, clear, flush
 from .shell import shell
+from .pool import pool
+from .warmup import warmup, hot, compiled
 
 
 __all__ = [
     'init', 'clear', 'flush',
     'shell',
+    'pool',
+    'warmup', 'hot', 'compiled',
 ]
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import, division
+from ... import exceptions, utils
+from ...conf import settings
+from .._pool import collect
+import json
+import six
+import time
+
+
+def _histogram(name, data):
+    utils.print_('-', name, '%.2fms' % (data['mean'] * 1000), 'mean')
+    last = None
+    for bound, count in data['histogram']:
+        if count:
+            utils.print_(' ', '<=%sms' % bound if bound is not None
+                         else '>%sms' % last, six.text_type(count))
+
+        last = bound
+
+
+def _print(name, data):
+    pool = data['pool']
+    utils.print_('*', name, pool.pop('class'), ' '.join(
+        '%s=%s' % item for item in sorted(pool.items())))
+
+    for key in ('checkouts', 'connects', 'timeouts', 'invalidations',
+                'overflows', 'peak_overflow'):
+        utils.print_('-', key, six.text_type(data[key]))
+
+    _histogram('wait', data['wait'])
+    _histogram('hold', data['hold'])
+
+    utils.print_('-', 'age', '%.1fs' % data['age']['max'],
+                 'max (%.1fs mean)' % data['age']['mean'])
+
+
+def pool(databases=None, interval=None, count=None, format='text'):
+    """Show the metrics of the connection pools of the databases.
+
+    The metrics are those published by the serving processes to the
+    directory of $DATABASE_METRICS; one snapshot each, followed by the time
+    their requests held connections checked out (see
+    `alchemist.db.release`). Shown once; or every `interval` seconds (up
+    to `count` times) when streaming.
+    """
+
+    directory = settings.get('DATABASE_METRICS')
+    if not directory:
+        raise exceptions.ImproperlyConfigured(
+            'The metrics of the pools are published by the server to the '
+            'directory of DATABASE_METRICS; it is not set.')
+
+    shown = 0
+    while True:
+        snapshots = collect(directory)
+        if not snapshots and format != 'json':
+            utils.print_('!', 'pool', 'no metrics published to', directory)
+
+        for snapshot in snapshots:
+            pid = snapshot['pid']
+            names = databases or sorted(snapshot['databases'])
+            for name in names:
+                data = snapshot['databases'].get(name)
+                if data is None:
+                    continue
+
+                if format == 'json':
+                    data.update(database=name, pid=pid,
+                                time=snapshot['time'])
+                    six.print_(json.dumps(data, sort_keys=True))
+
+                else:
+                    _print('%s (%d)' % (name, pid), data)
+
+            data = snapshot['requests']
+            if format == 'json':
+                six.print_(json.dumps({
+                    'requests': data, 'pid': pid, 'time': snapshot['time'],
+                }, sort_keys=True))
+
+            else:
+                utils.print_('*', 'requests (%d)' % pid)
+                _histogram('hold', data)
+
+        shown += 1
+        if not interval or (count and shown >= count):
+            return
+
+        time.sleep(interval)
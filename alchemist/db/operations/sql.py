@@ -2,7 +2,7 @@
 from __future__ import unicode_literals, absolute_import, division
 from ... import utils
 from .. import metadata, engine
-from .._engine import clear_cache
+from .._engine import clear_cache, route
 from .._session import refresh
 from .utils import HighlightStream
 from sqlalchemy_utils import (create_mock_engine, create_database,
@@ -14,10 +14,6 @@ def op(expression, tables=None, test=None, primary=None, secondary=None,
        names=None, echo=False, commit=True,
        offline=False, verbose=False):
 
-    if verbose:
-        url = repr(engine['default'].url)
-        utils.print_('*', primary, 'default', url)
-
     # Offline preparation cannot commit to the database and should always
     # echo output.
 
@@ -25,6 +21,7 @@ def op(expression, tables=None, test=None, primary=None, secondary=None,
         commit = False
         echo = True
 
+    announced = set()
     for table in (tables or metadata.sorted_tables):
 
         if not is_table_included(table, names):
@@ -32,7 +29,12 @@ def op(expression, tables=None, test=None, primary=None, secondary=None,
 
         # Determine the target engine from the model.
 
-        target = engine['default']
+        database = route(getattr(table, 'class_', None))
+        target = engine[database]
+
+        if verbose and database not in announced:
+            announced.add(database)
+            utils.print_('*', primary, database, repr(target.url))
 
         if not offline and test(target, table):
             continue
@@ -54,6 +56,20 @@ def op(expression, tables=None, test=None, primary=None, secondary=None,
     refresh()
 
 
+def databases(names=None):
+    """The names of the databases holding the included tables.
+    """
+
+    found = []
+    for table in metadata.sorted_tables:
+        if is_table_included(table, names):
+            database = route(getattr(table, 'class_', None))
+            if database not in found:
+                found.append(database)
+
+    return found or ['default']
+
+
 def init(**kwargs):
     """Initialize the specified names in the specified databases.
 
@@ -62,11 +78,16 @@ def init(**kwargs):
       - Ensure all tables exist in the database.
     """
 
-    # TODO: Iterate through all engines in name set.
     database = kwargs.pop('database', False)
-    if database and not database_exists(engine['default'].url):
-        create_database(engine['default'].url, encoding='utf8')
-        clear_cache()
+    if database:
+        created = False
+        for name in databases(kwargs.get('names')):
+            if not database_exists(engine[name].url):
+                create_database(engine[name].url, encoding='utf8')
+                created = True
+
+        if created:
+            clear_cache()
 
     expression = lambda target, table: table.create(target)
     test = lambda target, table: table.exists(target)
@@ -84,10 +105,15 @@ def clear(**kwargs):
     expression = lambda target, table: table.drop(target)
     test = lambda x, tab: not database_exists(x.url) or not tab.exists(x)
 
-    # TODO: Iterate through all engines in name set.
-    if database and database_exists(engine['default'].url):
-        drop_database(engine['default'].url)
-        clear_cache()
+    if database:
+        dropped = False
+        for name in databases(kwargs.get('names')):
+            if database_exists(engine[name].url):
+                drop_database(engine[name].url)
+                dropped = True
+
+        if dropped:
+            clear_cache()
 
     op(expression, reversed(metadata.sorted_tables), test=test,
        primary='clear', secondary='drop', **kwargs)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import, division
+from ... import utils
+from ...conf import settings
+from .. import engine
+import collections
+import six
+import sqlalchemy as sa
+import threading
+
+#! Statements compiled for each database when warming up; with the keys of
+#! the parameters they are executed with and whether with many sets.
+statements = []
+
+
+class _Compiled(dict):
+    # Holds the hot statements only; SQLAlchemy would add every other
+    # statement executed with it as well.
+
+    def __setitem__(self, key, value):
+        pass
+
+
+#! The compiled forms of the hot statements by database name; see
+#! `compiled`.
+compiled_cache = collections.defaultdict(_Compiled)
+
+
+def hot(statement, keys=(), many=False):
+    """Register a statement to compile for each database on warm-up.
+
+    The keys are those of the parameters it is executed with (and `many` if
+    with a list of them). Returns the statement so that it can be used in
+    place.
+    """
+
+    statements.append((statement, tuple(sorted(keys)), many))
+    return statement
+
+
+def compiled(name='default'):
+    """
+    The engine of the named database executing the hot statements with
+    the forms compiled on warm-up.
+    """
+
+    return engine[name].execution_options(compiled_cache=compiled_cache[name])
+
+
+def _connect(target, connections, errors, ready, release):
+    # Hold the connection until all are open so that each is a connection
+    # of its own; it is closed by the thread that opened it as not every
+    # driver allows otherwise.
+    connection = None
+    try:
+        connection = target.connect()
+        connection.scalar(sa.select([1]))
+        connections.append(connection)
+
+    except Exception as ex:
+        errors.append(ex)
+
+    finally:
+        ready.release()
+
+    release.wait()
+    if connection is not None:
+        connection.close()
+
+
+def warmup(databases=None, verbose=False):
+    """Fill the connection pools of the databases.
+
+    Opens as many connections as each pool keeps, concurrently; pings each
+    and returns them to the pool. Registered hot statements are then
+    compiled for each database. Returns the number of connections opened
+    for each database.
+    """
+
+    databases = databases or sorted(settings.get('DATABASES', {}))
+
+    threads = []
+    opened = {}
+    ready = threading.Semaphore(0)
+    release = threading.Event()
+    for name in databases:
+        target = engine[name]
+        size = 1
+        if isinstance(target.pool, sa.pool.QueuePool):
+            size = target.pool.size()
+
+        connections, errors = [], []
+        opened[name] = (connections, errors)
+        for _ in range(size):
+            threads.append(threading.Thread(target=_connect, args=(
+                target, connections, errors, ready, release)))
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        ready.acquire()
+
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    result = {}
+    for name, (connections, errors) in sorted(opened.items()):
+        # Keyed as `Connection.execute` looks them up.
+        dialect = engine[name].dialect
+        for statement, keys, many in statements:
+            dict.__setitem__(
+                compiled_cache[name], (dialect, statement, keys, many),
+                statement.compile(
+                    dialect=dialect, column_keys=list(keys), inline=many))
+
+        result[name] = len(connections)
+
+        if verbose:
+            utils.print_('*', 'warmup', name, '%d connections' % len(
+                connections))
+
+        for error in errors:
+            utils.print_('!', 'warmup', name, six.text_type(error))
+
+    return result
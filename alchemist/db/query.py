@@ -1,7 +1,15 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import, division
-from sqlalchemy import orm
+from . import _bulk, _keyset, _nplusone, _shard, cache as _cache
+from sqlalchemy import event, exc, inspect, orm
 from sqlalchemy.ext.declarative.api import DeclarativeMeta
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.sql.util import find_tables
+from sqlalchemy.util import KeyedTuple
+import contextlib
+import hashlib
+import six
 
 
 class Query(orm.Query):
@@ -14,9 +22,388 @@ class Query(orm.Query):
         # Find and instantiate the query class defined on the entity.
         entity = entities[-1] if entities else None
         if isinstance(entity, DeclarativeMeta):
-            if hasattr(entity, '__query__'):
-                # Found a query class; set it.
-                cls = entity.__query__
+            cls = getattr(entity, '__query__', cls)
 
         # Continue as normal.
         return super(Query, cls).__new__(cls)
+
+    #! The shard the query is limited to; see `set_shard`.
+    _shard_id = None
+
+    def set_shard(self, name):
+        """Limit the query to the named shard (database).
+        """
+
+        query = self._clone()
+        query._shard_id = name
+        return query
+
+    #! How the results of the query are cached as (ttl, key); see `cache`.
+    _caching = None
+
+    def cache(self, ttl=None, key=None):
+        """Cache the results of the query for `ttl` seconds.
+
+        Keyed on the compiled statement and its parameters unless a `key`
+        is given. Writes (flushes or bulk operations) to any table the
+        statement reads from invalidate the result. The backend is named by
+        $DATABASE_CACHE; see `alchemist.db.cache`.
+        """
+
+        query = self._clone()
+        query._caching = (ttl, key)
+        return query
+
+    def __iter__(self):
+        scope = _nplusone.current()
+        if scope is not None:
+            scope.record(self)
+
+        if self._caching is None:
+            return super(Query, self).__iter__()
+
+        context = self._compile_context()
+        context.statement.use_labels = True
+        if self._autoflush and not self._populate_existing:
+            self.session._autoflush()
+
+        statement = context.statement
+        tables = set(table.name for table in find_tables(statement))
+        if tables & set(_cache.pending(self.session)):
+            # The transaction has written to a table of the statement.
+            return self._execute_and_instances(context)
+
+        ttl, key = self._caching
+        if key is None:
+            compiled = statement.compile(dialect=self._dialect(statement))
+            parameters = compiled.construct_params(self._params)
+            parameters = sorted(parameters.items())
+            key = '%s\0%r\0%r' % (compiled, parameters, self._shard_id)
+
+        key = '%s\0%r' % (key, _cache.tokens(tables))
+        key = 'alchemist.query:%s' % hashlib.sha1(
+            key.encode('utf8')).hexdigest()
+
+        backend = _cache.backend()
+        value = backend.get(key)
+        if value is not None:
+            result = six.moves.cPickle.loads(value)
+
+        else:
+            result = list(self._execute_and_instances(context))
+            backend.set(key, six.moves.cPickle.dumps(result, -1), ttl)
+
+        # The cached instances are copied into the session as they are.
+        return self.merge_result(result, load=False)
+
+    def paginate_keyset(self, order_by, after=None, limit=20):
+        """A page of up to `limit` results and the token of the next page.
+
+        Seeks past the last row of the page the `after` token came with
+        instead of counting an offset; every page costs the same. The order
+        is a column (or a list of them) each ascending or `desc`; ties are
+        broken by the primary key. The columns must not be nullable (rows
+        with nulls would be skipped) and the query must have no limit or
+        offset of its own.
+
+        Raises ValueError if the token is malformed.
+        """
+
+        if self._limit is not None or self._offset is not None:
+            raise exc.InvalidRequestError(
+                'paginate_keyset() pages by its own limit; the query must '
+                'have no limit or offset.')
+
+        pairs = self._keys(order_by)
+
+        values = None
+        if after is not None:
+            values = _keyset.decode(after, pairs)
+            if len(values) != len(pairs):
+                raise ValueError('Malformed continuation token: %r' % after)
+
+        items, last = self._seek(pairs, values, limit)
+        token = _keyset.encode(last, pairs) if last is not None else None
+        return _keyset.Page(items, token)
+
+    def _dialect(self, clause=None):
+        # The dialect of the database the query is read from.
+
+        if clause is None:
+            clause = self.statement
+
+        return self.session.get_bind(
+            self._mapper_zero(), clause, shard_id=self._shard_id).dialect
+
+    def _keys(self, order_by):
+        # The keys to seek by; each column of them must not be nullable.
+
+        pairs = _keyset.keys(order_by, self._mapper_zero().primary_key)
+        for column, _ in pairs:
+            if getattr(column, 'nullable', False):
+                raise exc.InvalidRequestError(
+                    'Cannot seek by %s; it is nullable and rows where it is '
+                    'null would be skipped. Declare it nullable=False or '
+                    'order by another column.' % column)
+
+        return pairs
+
+    def _seek(self, pairs, values, limit, offset=None):
+        # Up to `limit` results after the values of the keys (the first
+        # if None; past `offset` of them); and the values of the last
+        # result if there are more.
+
+        query = self.limit(None).offset(None).order_by(None).order_by(*[
+            column.desc() if descending else column.asc()
+            for column, descending in pairs])
+
+        if values is not None:
+            query = query.filter(_keyset.after(
+                pairs, values, self._dialect()))
+
+        count = len(self._entities)
+        query = query.add_columns(*[
+            column.label('alchemist_key_%d' % index)
+            for index, (column, _) in enumerate(pairs)])
+
+        rows = query.offset(offset).limit(limit + 1).all()
+
+        last = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1][count:]
+
+        return [row[0] if count == 1 else row[:count] for row in rows], last
+
+    #! Drivers that stream results from a server-side cursor.
+    server_side_drivers = frozenset(('psycopg2',))
+
+    def stream(self, chunk_size=1000):
+        """Iterate the results a chunk at a time.
+
+        Each chunk is expunged from the session once iterated (changes made
+        to it are flushed first) so memory stays flat however many rows
+        there are. Rows are read from a server-side cursor where the driver
+        has one; else by a query per chunk that seeks past the last row of
+        the one before, in the order of the query ended by the primary key
+        (whose columns, as for `paginate_keyset`, must not be nullable).
+        """
+
+        if self._dialect().driver in self.server_side_drivers:
+            chunks = _bulk.batches(self.yield_per(chunk_size), chunk_size)
+
+        else:
+            chunks = self._chunks(chunk_size)
+
+        for chunk in chunks:
+            for item in chunk:
+                yield item
+
+            self._release(chunk)
+
+    def _chunks(self, chunk_size):
+        # The offset of the query applies to the first chunk (the rest seek
+        # past it); its limit to all of them.
+
+        pairs = self._keys(self._order_by or [])
+
+        values, offset, remaining = None, self._offset, self._limit
+        while remaining is None or remaining > 0:
+            size = chunk_size
+            if remaining is not None:
+                size = min(size, remaining)
+                remaining -= size
+
+            items, values = self._seek(pairs, values, size, offset)
+            yield items
+
+            if values is None:
+                return
+
+            offset = None
+
+    def _release(self, chunk):
+        session = self.session
+        if session.new or session.dirty or session.deleted:
+            session.flush()
+
+        for item in chunk:
+            for element in item if isinstance(item, tuple) else (item,):
+                if inspect(element, raiseerr=False) is not None and \
+                        element in session:
+                    session.expunge(element)
+
+    def _sharded(self):
+        # The shards the query runs against; None if it is not sharded.
+
+        if self._shard_id is not None:
+            return [self._shard_id]
+
+        # That of the first entity; a column names its model.
+        entity = self._entities[0].entity_zero if self._entities else None
+        model = _shard.model_of(getattr(entity, 'mapper', None))
+        if model is not None:
+            return _shard.choose(self, model)
+
+    def count(self):
+        shards = self._sharded()
+        if shards is None:
+            return super(Query, self).count()
+
+        if len(shards) == 1:
+            # Counted (from a subquery) on the shard.
+            return super(Query, self.set_shard(shards[0])).count()
+
+        # Summed over the shards; the limit and offset are of the whole.
+        query = self.limit(None).offset(None)
+        total = sum(query.set_shard(shard).count() for shard in shards)
+
+        total = max(0, total - (self._offset or 0))
+        if self._limit is not None:
+            total = min(total, self._limit)
+
+        return total
+
+    def update(self, values, synchronize_session='evaluate'):
+        with self._on_shard():
+            return super(Query, self).update(values, synchronize_session)
+
+    def delete(self, synchronize_session='evaluate'):
+        with self._on_shard():
+            return super(Query, self).delete(synchronize_session)
+
+    @contextlib.contextmanager
+    def _on_shard(self):
+        # Bulk operations execute through the session; it runs them against
+        # the shard of the query (or those of the criterion; see
+        # `Session.execute`).
+
+        session = self.session
+        previous = session._shard_id
+        session._shard_id = self._shard_id
+        try:
+            yield
+
+        finally:
+            session._shard_id = previous
+
+    def _execute_and_instances(self, querycontext):
+        shards = self._sharded()
+        if shards is None:
+            return super(Query, self)._execute_and_instances(querycontext)
+
+        if len(shards) > 1:
+            return self._fan_out(shards)
+
+        connection = self._connection_from_session(
+            mapper=self._mapper_zero_or_none(),
+            clause=querycontext.statement, shard_id=shards[0],
+            close_with_result=True)
+
+        result = connection.execute(querycontext.statement, self._params)
+        return self.instances(result, querycontext)
+
+    def _fan_out(self, shards):
+        # Run against each of the shards at once and merge the results in
+        # the order of the query; the limit and offset apply to the merged
+        # results (each shard returns up to their sum).
+
+        aggregated = any(
+            isinstance(element, FunctionElement) and
+            element.name.lower() in _aggregates
+            for entity in self._entities if hasattr(entity, 'column')
+            for element in visitors.iterate(entity.column, {}))
+
+        if self._group_by or self._having is not None or aggregated:
+            raise exc.InvalidRequestError(
+                'Grouping or aggregating is not supported across shards '
+                '(count() is); limit the query to one with set_shard.')
+
+        pairs = _keyset.keys(self._order_by or [], ())
+
+        query = self.limit(None).offset(None)
+        if self._limit is not None:
+            query = query.limit((self._offset or 0) + self._limit)
+
+        count = len(self._entities)
+        if pairs:
+            # The values ordered by are selected to merge on.
+            query = query.add_columns(*[
+                column.label('alchemist_order_%d' % index)
+                for index, (column, _) in enumerate(pairs)])
+
+        context = query._compile_context()
+        context.statement.use_labels = True
+
+        # Connections are taken from the session one at a time; the
+        # statement is then run against all of the shards at once.
+
+        mapper = self._mapper_zero_or_none()
+        connections = [self._connection_from_session(
+            mapper=mapper, clause=context.statement, shard_id=shard,
+            close_with_result=True) for shard in shards]
+
+        results = _shard.execute(connections, context.statement, self._params)
+
+        rows = []
+        for result in results:
+            rows.extend(query.instances(result, context))
+
+        if pairs:
+            # Each run is in order already; the (stable) sort merges them
+            # a key at a time from the last. Nulls come first ascending.
+            for index in reversed(range(len(pairs))):
+                rows.sort(key=lambda row: _ordered(row[count + index]),
+                          reverse=pairs[index][1])
+
+            if count == 1:
+                rows = [row[0] for row in rows]
+
+            else:
+                labels = rows[0].keys()[:count] if rows else ()
+                rows = [KeyedTuple(row[:count], labels) for row in rows]
+
+        start = self._offset or 0
+        stop = start + self._limit if self._limit is not None else None
+        return iter(rows[start:stop])
+
+
+#! Functions whose result is of the rows of each shard alone.
+_aggregates = frozenset(('count', 'sum', 'min', 'max', 'avg'))
+
+
+def _ordered(value):
+    # Sorts None before any value (where comparing would raise).
+    return (value is not None, value)
+
+
+#! The query over each mapper; built once and cloned for each query over
+#! its model (see `over`).
+_prototypes = {}
+
+
+def over(model, session):
+    """A query over the model in the session.
+
+    Cloned from a query built the first time for the mapper of the model
+    instead of being built anew (through `Query.__new__` and the setup of
+    its entities) each time.
+    """
+
+    mapper = model.__mapper__
+    prototype = _prototypes.get(mapper)
+    if prototype is None:
+        prototype = _prototypes[mapper] = Query([model])
+
+    query = prototype._clone()
+    query.session = session
+
+    # Polymorphic loading adds to this in place.
+    query._polymorphic_adapters = prototype._polymorphic_adapters.copy()
+    return query
+
+
+@event.listens_for(orm.mapper, 'after_configured')
+def _configured():
+    # Newly configured mappers may change the loading of those before.
+    _prototypes.clear()
@@ -1,10 +1,62 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import, division
 from flask.ext import script, components
+from alchemist import utils
+from alchemist.profiling import profile
+from importlib import import_module
+import ast
 import colorama
+import pkgutil
 import sys
 
 
+@utils.memoize
+def _describe(path):
+    """Read the docstring of the referenced command without importing it.
+    """
+
+    module, name = path.rsplit('.', 1)
+    try:
+        source = pkgutil.get_loader(module).get_source(module)
+        for node in ast.parse(source).body:
+            if isinstance(node, ast.ClassDef) and node.name == name:
+                return (ast.get_docstring(node) or '').strip()
+
+    except Exception:  # pragma: nocoverage
+        pass
+
+    return ''
+
+
+class LazyCommand(script.Command):
+    """
+    Stands in for a command that has yet to be imported; the management
+    utility swaps it for the real command when it is invoked. Its options
+    are unknown until then so it is only good for listing the command.
+    """
+
+    def __init__(self, name, path, **kwargs):
+        self.name = name
+        self.path = path
+        self.kwargs = kwargs
+
+        if ' ' in name:
+            self.namespace, self.name = name.split(' ', 1)
+
+    @property
+    def help(self):
+        return _describe(self.path)
+
+    description = help
+
+    def load(self):
+        """Import and construct the command.
+        """
+
+        module, name = self.path.rsplit('.', 1)
+        return getattr(import_module(module), name)(**self.kwargs)
+
+
 class Manager(script.Manager):
 
     def __init__(self, app, **kwargs):
@@ -19,7 +71,25 @@ class Manager(script.Manager):
         super(Manager, self).__init__(app, **kwargs)
 
         # Discover commands using the flask-components utility.
-        for component in components.find('commands', app):
+        for key in list(app.config.get('COMPONENTS', [])):
+            with profile.phase('commands', key):
+                self._discover(app, key)
+
+        profile.report('manager')
+
+    def _discover(self, app, key):
+        # Components declaring their commands in `__commands__` have them
+        # imported only when invoked.
+        for module in components.find(
+                'commands', app, components=[key], raw=True):
+            declared = getattr(module, '__commands__', None)
+            if declared is not None:
+                for name, path in declared.items():
+                    self.add_command(LazyCommand(name, path))
+
+                return
+
+        for component in components.find('commands', app, components=[key]):
             for command in component.values():
                 if (command and isinstance(command, type) and
                         issubclass(command, (script.Command, script.Manager))):
@@ -41,12 +111,14 @@ class Manager(script.Manager):
 
             # HACK: Overriding the old shell isn't cool.
             # Should do it by default.
-        from alchemist.commands import Shell
-        self._commands['shell'] = Shell(context=context)
+        self._commands['shell'] = LazyCommand(
+            'shell', 'alchemist.commands.shell.Shell', context=context)
 
         if default_command is not None and len(sys.argv) == 1:
             sys.argv.append(default_command)
 
+        self._load(sys.argv[1:])
+
         try:
             result = self.handle(sys.argv[0], sys.argv[1:])
         except SystemExit as e:
@@ -54,6 +126,23 @@ class Manager(script.Manager):
 
         sys.exit(result or 0)
 
+    def _load(self, args):
+        """Import the command that the passed arguments invoke.
+        """
+
+        manager = self
+        for name in args:
+            command = manager._commands.get(name)
+            if isinstance(command, LazyCommand):
+                command = manager._commands[name] = command.load()
+                if isinstance(command, script.Manager):
+                    command.parent = manager
+
+            if not isinstance(command, script.Manager):
+                return
+
+            manager = command
+
 # Monkey path flask-script (until it can better handle normal WSGI
 # applications)
 script.Manager.__call__ = Manager.__call__
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import, division
+from . import utils
+from contextlib import contextmanager
+import json
+import os
+import time
+
+try:
+    import tracemalloc
+
+except ImportError:  # pragma: nocoverage
+    tracemalloc = None
+
+__all__ = [
+    'profile',
+]
+
+#! Environment variable that enables profiling of the start-up phases.
+VARIABLE = 'ALCHEMIST_PROFILE_STARTUP'
+
+#! Environment variable naming a file to write a JSON report to.
+REPORT_VARIABLE = 'ALCHEMIST_PROFILE_STARTUP_REPORT'
+
+
+class Profile(object):
+    """Records the time and memory taken by each phase of start-up.
+
+    Enabled by $ALCHEMIST_PROFILE_STARTUP; each report is also written as
+    JSON to the file named by $ALCHEMIST_PROFILE_STARTUP_REPORT.
+    """
+
+    def __init__(self):
+        #! Phases recorded since the last report.
+        self.entries = []
+
+        #! Reports made so far by this process.
+        self.reports = []
+
+        #! Whether tracemalloc was started here (and is to be stopped).
+        self.tracing = False
+
+    @property
+    def enabled(self):
+        return bool(os.environ.get(VARIABLE) or
+                    os.environ.get(REPORT_VARIABLE))
+
+    def _memory(self):
+        if tracemalloc is None:
+            return None
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+
+        return tracemalloc.get_traced_memory()[0]
+
+    @contextmanager
+    def phase(self, name, target=''):
+        """Record the time and memory spent in the block.
+        """
+
+        if not self.enabled:
+            yield
+            return
+
+        memory = self._memory()
+        start = time.time()
+
+        try:
+            yield
+
+        finally:
+            duration = time.time() - start
+            if memory is not None:
+                memory = self._memory() - memory
+
+            self.entries.append({
+                'phase': name,
+                'target': target,
+                'seconds': duration,
+                'memory': memory,
+            })
+
+    def report(self, title):
+        """Print the phases recorded since the last report; slowest first.
+        """
+
+        if not self.enabled:
+            return
+
+        entries = sorted(self.entries, key=lambda e: -e['seconds'])
+        self.entries = []
+
+        # Tracing slows every allocation; it is not left on for the life of
+        # the process (a later phase starts it again).
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+        utils.print_('*', 'profile', title)
+        for entry in entries:
+            memory = entry['memory']
+            utils.print_(
+                '%9.2fms' % (entry['seconds'] * 1000),
+                entry['phase'], entry['target'],
+                '' if memory is None else '%+.1fKiB' % (memory / 1024))
+
+        self.reports.append({
+            'title': title,
+            'pid': os.getpid(),
+            'time': time.time(),
+            'phases': entries,
+        })
+
+        filename = os.environ.get(REPORT_VARIABLE)
+        if filename:
+            with open(filename, 'w') as stream:
+                json.dump({'reports': self.reports}, stream, indent=2)
+
+
+profile = Profile()
@@ -2,6 +2,7 @@
 from __future__ import unicode_literals, absolute_import, division
 from contextlib import contextmanager
 from alchemist import db
+from alchemist.db import _nplusone
 import requests
 import json
 
@@ -19,10 +20,14 @@ def settings(app, **kwargs):
     # Make requested changes for this scope.
     app.config.update(kwargs)
 
-    yield
+    try:
+        yield
 
-    # Restore the previous application config.
-    app.config = _config
+    finally:
+        # Restore the previous application config in place so that views
+        # of the configuration see the change.
+        app.config.clear()
+        app.config.update(_config)
 
 
 class TestBase:
@@ -38,6 +43,19 @@ class TestBase:
         # know it.
         cls.Q = lambda s, x: db.session.query(x)
 
+    def setup_method(self, method):
+        # Watch each test for repeated lazy loads (raising LazyLoadError
+        # when testing) if $DATABASE_LAZY_LOAD_LIMIT is set.
+        self._nplusone = (_nplusone.start(name='%s.%s' % (
+            type(self).__name__, method.__name__)),)
+
+    def teardown_method(self, method):
+        # Not started by subclasses with a setup_method of their own.
+        started = getattr(self, '_nplusone', None)
+        if started is not None:
+            _nplusone.stop(*started)
+            del self._nplusone
+
     def teardown(self):
         # Rollback the session.
         db.session.rollback()
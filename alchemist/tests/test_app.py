@@ -4,7 +4,27 @@ from flask import Flask
 from os import path
 import os
 import sys
+import shutil
+import tempfile
+import inspect
+import json
+import py
+import timeit
+import six
 import alchemist
+from pytest import mark
+
+try:   # pragma: nocoverage
+    from unittest import mock
+
+except ImportError:  # pragma: nocoverage
+    import mock
+
+try:
+    import tracemalloc
+
+except ImportError:  # pragma: nocoverage
+    tracemalloc = None
 
 
 class TestSettings:
@@ -85,6 +105,61 @@ class TestSettings:
         del os.environ['TESTS_A_SETTINGS_MODULE']
 
 
+class TestSnapshot:
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = path.join(self.directory, 'settings.snapshot')
+        os.environ['ALCHEMIST_SETTINGS_SNAPSHOT'] = self.filename
+
+        self.module = path.join(self.directory, 'settings.py')
+        with open(self.module, 'w') as stream:
+            stream.write('C_SETTING = 3\n')
+
+        os.environ['ALCHEMIST_TESTS_A_SETTINGS_MODULE'] = self.module
+
+    def teardown(self):
+        del os.environ['ALCHEMIST_SETTINGS_SNAPSHOT']
+        del os.environ['ALCHEMIST_TESTS_A_SETTINGS_MODULE']
+        shutil.rmtree(self.directory)
+
+    def _configure(self):
+        app = Flask('alchemist.tests.a')
+        alchemist.configure(app)
+        return app
+
+    def test_freeze(self):
+        from alchemist.conf import snapshot
+
+        assert snapshot.dump(self._configure()) == self.filename
+
+        app = self._configure()
+
+        assert app.extensions['alchemist']['settings_snapshot'] == (
+            self.filename)
+        assert app.config['A_SETTING'] == 5
+        assert app.config['C_SETTING'] == 3
+
+    def test_stale(self):
+        from alchemist.conf import snapshot
+
+        snapshot.dump(self._configure())
+
+        stat = os.stat(self.module)
+        os.utime(self.module, (stat.st_atime, stat.st_mtime + 10))
+
+        app = self._configure()
+
+        assert 'settings_snapshot' not in app.extensions['alchemist']
+        assert app.config['C_SETTING'] == 3
+
+    def test_missing(self):
+        app = self._configure()
+
+        assert 'settings_snapshot' not in app.extensions['alchemist']
+        assert 'settings_sources' in app.extensions['alchemist']
+
+
 class TestApplication:
 
     @staticmethod
@@ -122,6 +197,104 @@ class TestApplication:
         del os.environ['ALCHEMIST_APPLICATION']
 
 
+class ApplicationLookup(object):
+
+    @staticmethod
+    def _clear_cache():
+        from alchemist import app
+        type(app).__dict__['_find_application']._cache.clear()
+
+    def setup(self):
+        self._clear_cache()
+        os.environ['ALCHEMIST_APPLICATION'] = ''
+
+        # Issue the lookups from a frame inside the project package as
+        # would happen for a model or a settings access within it.
+        self.namespace = {'__package__': 'alchemist.tests.a'}
+        six.exec_('def call(function): return function()', self.namespace)
+
+    def teardown(self):
+        del os.environ['ALCHEMIST_APPLICATION']
+        self._clear_cache()
+
+    @staticmethod
+    def _legacy_find_application():
+        # The discovery as it was before it walked the frames directly.
+        from alchemist import app
+        for frame in reversed(inspect.stack()[1:]):
+            name = frame[0].f_globals.get('__package__')
+            if (name and (not name.startswith('alchemist')
+                          or name.startswith('alchemist.tests.a'))):
+                application = app._get_application_from_name(name)
+                if application:
+                    return application
+
+
+class TestApplicationLookup(ApplicationLookup):
+
+    def test_frame_walk(self):
+        from alchemist import app
+
+        expected = self.namespace['call'](self._legacy_find_application)
+
+        with mock.patch.object(inspect, 'stack', side_effect=AssertionError):
+            found = self.namespace['call'](app._find_application)
+
+        assert found.name == 'alchemist.tests.a'
+        assert found is expected
+
+    def test_pinned(self):
+        from alchemist import app
+
+        call = self.namespace['call']
+        found = call(app._find_application)
+
+        cache = type(app).__dict__['_find_application']._cache
+        assert list(cache.values()) == [found]
+
+        # Found again without looking through the packages of the stack.
+        with mock.patch.object(
+                type(app), '_get_application_from_name',
+                side_effect=AssertionError):
+            assert call(app._find_application) is found
+
+    def test_miss_not_pinned(self):
+        from alchemist import app
+
+        assert app._find_application() is None
+        assert not type(app).__dict__['_find_application']._cache
+
+
+@mark.skipif(not os.environ.get('ALCHEMIST_BENCHMARK'),
+             reason='set ALCHEMIST_BENCHMARK to run benchmarks')
+class TestApplicationBenchmark(ApplicationLookup):
+    """
+    Measures the cost of looking up a setting outside of an application
+    context; run with `-s` to see the timings.
+    """
+
+    def test_lookup(self):
+        from alchemist import app
+
+        call = self.namespace['call']
+
+        def lookup():
+            self._clear_cache()
+            return call(app._find_application)
+
+        number = 50
+        before = timeit.timeit(
+            lambda: call(self._legacy_find_application), number=number)
+        after = timeit.timeit(lookup, number=number)
+        pinned = timeit.timeit(
+            lambda: call(app._find_application), number=number)
+
+        print('\nsettings lookup outside of an application context')
+        print('  inspect.stack: %8.1f us' % (before / number * 1e6))
+        print('  frame walk:    %8.1f us' % (after / number * 1e6))
+        print('  pinned:        %8.1f us' % (pinned / number * 1e6))
+
+
 class TestTestingDetection:
 
     def setup(self):
@@ -181,3 +354,58 @@ class TestTestingDetection:
         assert not self.app.config['TESTING']
 
         sys.argv = old
+
+
+class TestStartupProfile:
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = path.join(self.directory, 'profile.json')
+        os.environ['ALCHEMIST_PROFILE_STARTUP_REPORT'] = self.filename
+
+    def teardown(self):
+        del os.environ['ALCHEMIST_PROFILE_STARTUP_REPORT']
+        shutil.rmtree(self.directory)
+
+    def test_configure(self):
+        self.app = Flask('alchemist.tests.a')
+
+        capture = py.io.StdCapture(out=True, in_=False)
+        alchemist.configure(self.app)
+        _, err = capture.done()
+
+        assert 'configure alchemist.tests.a' in err.read()
+
+        with open(self.filename) as stream:
+            report = json.load(stream)['reports'][-1]
+
+        phases = {(p['phase'], p['target']) for p in report['phases']}
+
+        assert ('settings', 'alchemist.tests.a.b') in phases
+        assert ('models', 'alchemist.tests.a.b') in phases
+        assert ('mappers', '') in phases
+
+    @mark.skipif(tracemalloc is None, reason='requires tracemalloc')
+    def test_tracing_stopped(self):
+        self.app = Flask('alchemist.tests.a')
+
+        capture = py.io.StdCapture(out=True, in_=False)
+        alchemist.configure(self.app)
+        capture.done()
+
+        assert not tracemalloc.is_tracing()
+
+    @mark.skipif(tracemalloc is None, reason='requires tracemalloc')
+    def test_tracing_kept(self):
+        self.app = Flask('alchemist.tests.a')
+
+        tracemalloc.start()
+        try:
+            capture = py.io.StdCapture(out=True, in_=False)
+            alchemist.configure(self.app)
+            capture.done()
+
+            assert tracemalloc.is_tracing()
+
+        finally:
+            tracemalloc.stop()
@@ -78,6 +78,21 @@ class TestServer(CommandTest):
                 processes=config['SERVER_PROCESSES'],
                 threaded=config['SERVER_THREADED'])
 
+    def test_warmup(self):
+        with mock.patch('alchemist.db.warmup') as warmup:
+            self._run(['run', '--warmup'],
+                      patch='flask.ext.script.Server.handle')
+
+        warmup.assert_called_with(verbose=True)
+
+    def test_warmup_setting(self):
+        with test.settings(self.app, DATABASE_WARMUP=True):
+            with mock.patch('alchemist.db.warmup') as warmup:
+                self._run(['run', '--no-warmup'],
+                          patch='flask.ext.script.Server.handle')
+
+        assert not warmup.called
+
 
 class TestShell(CommandTest):
 
@@ -175,6 +190,20 @@ class TestDatabase(CommandTest):
         target.assert_called_with(
             echo=False, names=[], verbose=True, commit=True, offline=False)
 
+    def test_pool_default(self):
+        cmd = ['db', 'pool']
+        target = self._run(cmd, patch='alchemist.db.pool')
+
+        target.assert_called_with(
+            databases=[], interval=None, count=None, format='text')
+
+    def test_pool_stream(self):
+        cmd = ['db', 'pool', 'default', '-i', '5', '--json']
+        target = self._run(cmd, patch='alchemist.db.pool')
+
+        target.assert_called_with(
+            databases=['default'], interval=5, count=None, format='json')
+
 
 class TestSettings(CommandTest):
 
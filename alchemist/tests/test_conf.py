@@ -24,3 +24,125 @@ class TestSettings:
             assert settings['A_SETTING'] == 1
             assert len(settings) > 0
             assert len(list(iter(settings))) > 0
+
+
+class TestSettingsView:
+
+    def setup(self):
+        from alchemist.conf import Config
+
+        self.app = Flask('alchemist')
+        self.app.config = Config(self.app.root_path, self.app.config)
+        self.app.config['A_SETTING'] = 1
+
+    def test_mutation(self):
+        with self.app.app_context():
+            assert settings['A_SETTING'] == 1
+
+            self.app.config['A_SETTING'] = 2
+
+            assert settings['A_SETTING'] == 2
+
+            del self.app.config['A_SETTING']
+
+            assert 'A_SETTING' not in settings
+
+    def test_test_settings(self):
+        from alchemist.test import settings as override
+
+        with self.app.app_context():
+            with override(self.app, A_SETTING=2):
+                assert settings['A_SETTING'] == 2
+
+            assert settings['A_SETTING'] == 1
+
+    def test_invalidate(self):
+        with self.app.app_context():
+            assert settings['A_SETTING'] == 1
+
+            dict.__setitem__(self.app.config, 'A_SETTING', 2)
+
+            assert settings['A_SETTING'] == 1
+
+            settings.invalidate()
+
+            assert settings['A_SETTING'] == 2
+
+    def test_switch_application(self):
+        other = Flask('alchemist')
+        other.config['A_SETTING'] = 3
+
+        with self.app.app_context():
+            assert settings['A_SETTING'] == 1
+
+            with other.app_context():
+                assert settings['A_SETTING'] == 3
+
+            assert settings['A_SETTING'] == 1
+
+
+class TestDefer:
+
+    def test_names(self):
+        from alchemist.conf import defer
+
+        value = defer('A_SETTING + len(B_SETTING)')
+
+        assert value.names == {'A_SETTING', 'B_SETTING', 'len'}
+
+    def test_resolve(self):
+        from alchemist.conf import defer
+
+        value = defer('A_SETTING * 2')
+
+        assert value.resolve({'A_SETTING': 2}) == 4
+
+    def test_resolve_settings(self):
+        from alchemist.conf import defer
+
+        app = Flask('alchemist')
+        app.config['A_SETTING'] = 3
+        with app.app_context():
+            assert defer('A_SETTING * 2').resolve() == 6
+
+    def test_order(self):
+        from alchemist.conf import defer
+
+        config = {
+            'C_SETTING': defer('B_SETTING + 1'),
+            'B_SETTING': defer('A_SETTING + 1'),
+            'A_SETTING': 1,
+        }
+
+        assert defer.order(config) == ['B_SETTING', 'C_SETTING']
+
+    def test_configure_order(self):
+        import alchemist
+        from alchemist.conf import defer
+        from alchemist.tests.a import settings as module
+
+        module.D_SETTING = defer('E_SETTING * 2')
+        module.E_SETTING = defer('A_SETTING + 1')
+
+        try:
+            app = Flask('alchemist.tests.a')
+            alchemist.configure(app)
+
+            assert app.config['E_SETTING'] == 6
+            assert app.config['D_SETTING'] == 12
+
+        finally:
+            del module.D_SETTING
+            del module.E_SETTING
+
+    def test_cycle(self):
+        from alchemist.conf import defer
+        from alchemist.exceptions import ImproperlyConfigured
+
+        config = {
+            'A_SETTING': defer('B_SETTING'),
+            'B_SETTING': defer('A_SETTING'),
+        }
+
+        with pytest.raises(ImproperlyConfigured):
+            defer.order(config)
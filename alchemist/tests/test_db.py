@@ -2,10 +2,14 @@
 from __future__ import unicode_literals, absolute_import, division
 import alchemist
 import contextlib
+import os
 import py
+import shutil
+import sys
+import tempfile
 from alchemist.test import settings
 from flask import Flask
-from pytest import raises
+from pytest import raises, mark
 from sqlalchemy.engine.result import ResultProxy
 from sqlalchemy.exc import OperationalError
 from . import utils
@@ -22,8 +26,8 @@ class TestEngine:
 
     @staticmethod
     def _clear_cache():
-        from alchemist.db._engine import Engine
-        Engine.__getitem__._cache.clear()
+        from alchemist.db._engine import clear_cache
+        clear_cache()
 
     def setup(self):
         utils.unload_modules('alchemist')
@@ -110,38 +114,1821 @@ class TestEngine:
 
             assert db.engine.url.drivername == 'sqlite'
 
+    def _threads(self, count, target):
+        import threading
+
+        def run():
+            with self.app.app_context():
+                target()
+
+        threads = [threading.Thread(target=run) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+    def test_concurrent(self):
+        from alchemist import db
+        from alchemist.db import _engine
+        import time
+
+        create = _engine._create
+        created = []
+
+        def slow(config):
+            time.sleep(0.05)
+            created.append(config)
+            return create(config)
+
+        uri = 'sqlite:///:memory:'
+        with settings(self.app, DATABASES={'default': uri}):
+            with mock.patch.object(_engine, '_create', slow):
+                self._threads(4, lambda: db.engine['default'])
+
+        assert len(created) == 1
+
+    def test_testing_limit(self):
+        from alchemist import db
+        from alchemist.db import _engine
+        import time
+
+        engines = []
+
+        uri = 'sqlite:///:memory:'
+        config = {'DATABASES': {'default': uri}, 'TESTING': True,
+                  'DATABASE_TEST_ENGINES': 2}
+
+        # Hold the threads until all are done so that none reuses the
+        # identity of another.
+        def use():
+            engines.append(db.engine['default'])
+            while len(engines) < 4:
+                time.sleep(0.01)
+
+        with settings(self.app, **config):
+            self._threads(4, use)
+
+        assert len(set(engines)) == 4
+        assert len(_engine._testing.items) == 2
+
+    def test_evicted_in_use(self):
+        from alchemist.db import _engine
+        import sqlalchemy as sa
+
+        registry = _engine.Registry()
+        first = registry.get('first', sa.create_engine, 'sqlite://', limit=1)
+        first.execute('CREATE TABLE kept (id INTEGER)')
+        first.execute('INSERT INTO kept VALUES (1)')
+
+        registry.get('second', sa.create_engine, 'sqlite://', limit=1)
+
+        # Evicted but not disposed; its in-memory database is kept for
+        # whoever still holds the engine.
+        assert list(registry.items) == ['second']
+        assert first.execute('SELECT id FROM kept').scalar() == 1
+
+    def test_evicted_disposed(self):
+        from alchemist.db import _engine
+        import sqlalchemy as sa
+
+        filename = os.path.join(tempfile.mkdtemp(), 'evicted.db')
+        try:
+            registry = _engine.Registry()
+            first = registry.get(
+                'first', sa.create_engine, 'sqlite:///%s' % filename,
+                limit=1)
+
+            with mock.patch.object(first, 'dispose') as dispose:
+                first.execute('SELECT 1')
+                registry.get(
+                    'second', sa.create_engine, 'sqlite://', limit=1)
+
+            assert list(registry.items) == ['second']
+            assert dispose.called
+
+        finally:
+            shutil.rmtree(os.path.dirname(filename))
+
 
 class TestSession:
 
     def setup(self):
-        utils.unload_modules('alchemist')
+        utils.unload_modules('alchemist')
+        self.app = Flask('alchemist')
+
+    def test_unbound(self):
+        from alchemist import db
+
+        assert not db.session
+
+    def test_acquire_no_database(self):
+        from alchemist import db, exceptions
+
+        with raises(exceptions.ImproperlyConfigured), self.app.app_context():
+            assert db.session
+
+    def test_acquire_default(self):
+        from alchemist import db
+
+        config = {'default': 'sqlite:///:memory:'}
+        with settings(self.app, DATABASES=config), self.app.app_context():
+            assert db.session
+
+    def test_repr(self):
+        from alchemist import db
+
+        config = {'default': 'sqlite:///:memory:'}
+        with settings(self.app, DATABASES=config), self.app.app_context():
+            text = '<Session(bind=%r)>' % db.engine['default']
+            assert repr(db.session) == text
+
+
+class TestReplicas:
+
+    @staticmethod
+    def _clear_cache():
+        from alchemist.db._engine import clear_cache
+        clear_cache()
+
+    def setup(self):
+        import sqlalchemy as sa
+
+        self._clear_cache()
+
+        self.directory = tempfile.mkdtemp()
+        self.names = {}
+        for name in ('primary', 'replica'):
+            filename = os.path.join(self.directory, '%s.db' % name)
+            self.names[name] = filename
+
+            target = sa.create_engine('sqlite:///%s' % filename)
+            target.execute('CREATE TABLE item (name VARCHAR(20))')
+            target.execute('INSERT INTO item VALUES (?)', name)
+
+        self.table = sa.sql.table('item', sa.sql.column('name'))
+
+        self.app = Flask('alchemist')
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def teardown(self):
+        self.context.pop()
+        self._clear_cache()
+        shutil.rmtree(self.directory)
+
+    def _config(self, **kwargs):
+        config = {
+            'engine': 'sqlite',
+            'name': self.names['primary'],
+            'replicas': [{'name': self.names['replica']}],
+        }
+
+        config.update(kwargs)
+        return {'default': config}
+
+    def _read(self):
+        from alchemist import db
+        import sqlalchemy as sa
+
+        return db.session.execute(sa.select([self.table.c.name])).scalar()
+
+    def test_read(self):
+        with settings(self.app, DATABASES=self._config()):
+            assert self._read() == 'replica'
+
+    def test_write(self):
+        from alchemist import db
+
+        with settings(self.app, DATABASES=self._config()):
+            db.session.execute(self.table.insert().values(name='new'))
+
+            assert self._read() == 'primary'
+
+            db.session.commit()
+
+            # Read your writes.
+            assert self._read() == 'primary'
+
+    def test_write_flushed(self):
+        from alchemist import db
+        from sqlalchemy.ext.declarative import declarative_base
+        import sqlalchemy as sa
+
+        class Item(declarative_base()):
+
+            __tablename__ = 'item'
+
+            name = sa.Column(sa.String(20), primary_key=True)
+
+        with settings(self.app, DATABASES=self._config()):
+            db.session.add(Item(name='new'))
+            db.session.commit()
+
+            # Written by the flush of the commit; read your writes.
+            assert db.session._pinned
+            assert self._read() == 'primary'
+
+    def test_pin(self):
+        from alchemist import db
+
+        app = Flask('alchemist')
+
+        @app.route('/write')
+        def write():
+            db.session.execute(self.table.insert().values(name='new'))
+            db.session.commit()
+            return 'written'
+
+        @app.route('/read')
+        def read():
+            return self._read()
+
+        config = self._config()
+        with settings(app, DATABASES=config, DATABASE_PIN_SECONDS=30):
+            client = app.test_client()
+
+            assert client.get('/read').data == b'replica'
+            assert client.get('/write').data == b'written'
+            assert client.get('/read').data == b'primary'
+
+            assert app.test_client().get('/read').data == b'replica'
+
+    def test_lag(self):
+        from alchemist import db
+        from alchemist.db._engine import Heartbeat
+        import sqlalchemy as sa
+        import time
+
+        heartbeat = Heartbeat()
+        for name in ('primary', 'replica'):
+            target = sa.create_engine('sqlite:///%s' % self.names[name])
+            target.execute('CREATE TABLE alchemist_heartbeat (stamp FLOAT)')
+
+        config = self._config(lag_probe=heartbeat, lag_max=5)
+        with settings(self.app, DATABASES=config):
+            # The replica has yet to see the heartbeat.
+            heartbeat.beat(db.engine['default'])
+
+            assert db.engine.replica() is db.engine['default']
+
+            # The replica caught up.
+            replica = db.engine.replicas().engines[0]
+            heartbeat.beat(replica)
+            db.engine.replicas().measure()
+
+            assert db.engine.replica() is replica
+            assert db.engine.replicas().lag[replica] < 5
+
+    def test_lag_failure(self):
+        from alchemist import db
+
+        def probe(primary, replica):
+            raise RuntimeError
+
+        config = self._config(lag_probe=probe)
+        with settings(self.app, DATABASES=config):
+            assert self._read() == 'primary'
+
+    def test_round_robin(self):
+        from alchemist import db
+
+        replicas = [{'name': self.names['replica']},
+                    {'name': self.names['primary']}]
+
+        with settings(self.app, DATABASES=self._config(replicas=replicas)):
+            first = db.engine.replica()
+            second = db.engine.replica()
+
+            assert first is not second
+            assert db.engine.replica() is first
+
+    def test_least_connections(self):
+        from alchemist import db
+
+        replicas = [{'name': self.names['replica']},
+                    {'name': self.names['primary']}]
+
+        config = self._config(replicas=replicas, balance='least-connections')
+        with settings(self.app, DATABASES=config):
+            first = db.engine.replica()
+            with contextlib.closing(first.connect()):
+                assert db.engine.replica() is not first
+
+            assert db.engine.replica() is first
+
+    def test_testing(self):
+        with settings(self.app, DATABASES=self._config(), TESTING=True):
+            from alchemist import db
+
+            assert db.engine.replica() is db.engine['default']
+
+
+class TestReadonly:
+
+    def setup(self):
+        from alchemist.db._engine import clear_cache
+        import sqlalchemy as sa
+
+        clear_cache()
+
+        self.directory = tempfile.mkdtemp()
+        self.app = Flask('alchemist')
+        self.context = self.app.app_context()
+        self.context.push()
+
+        self.settings = settings(self.app, DATABASES={'default': {
+            'engine': 'sqlite',
+            'name': os.path.join(self.directory, 'readonly.db'),
+            'options': {'poolclass': sa.pool.QueuePool},
+        }})
+
+        self.settings.__enter__()
+
+    def teardown(self):
+        from alchemist.db._engine import clear_cache
+
+        self.settings.__exit__(None, None, None)
+        self.context.pop()
+        clear_cache()
+        shutil.rmtree(self.directory)
+
+    def test_release(self):
+        from alchemist import db
+
+        session = db.Session(readonly=True)
+
+        assert session.execute('SELECT 1').scalar() == 1
+        assert db.engine['default'].pool.checkedout() == 0
+
+        session.close()
+
+    def test_flush(self):
+        from alchemist import db
+        import sqlalchemy as sa
+
+        metaclass = 'sqlalchemy.ext.declarative.api.DeclarativeMeta'
+        with settings(self.app, MODEL_METACLASS=metaclass):
+
+            class Item(db.Model):
+
+                __tablename__ = 'item'
+
+                id = sa.Column(sa.Integer, primary_key=True)
+
+        session = db.Session(readonly=True)
+        session.flush()
+        session.add(Item())
+
+        with raises(sa.exc.InvalidRequestError):
+            session.flush()
+
+    def test_transaction(self):
+        from alchemist import db
+
+        session = db.Session(readonly=True)
+        target = mock.MagicMock()
+        target.dialect.name = 'postgresql'
+
+        with settings(self.app, DATABASE_READONLY_TRANSACTION=True):
+            connection = session._connection_for_bind(target)
+
+        cursor = connection.connection.cursor.return_value
+        cursor.execute.assert_called_with('SET TRANSACTION READ ONLY')
+
+    def test_view(self):
+        from alchemist import db
+
+        app = Flask('alchemist')
+
+        @app.route('/default', methods=['GET', 'POST'])
+        def default():
+            return repr(db.session.readonly)
+
+        @app.route('/marked', methods=['POST'])
+        @db.readonly
+        def marked():
+            return repr(db.session.readonly)
+
+        @app.route('/unmarked')
+        def unmarked():
+            return repr(db.session.readonly)
+
+        unmarked.readonly = False
+
+        config = {'DATABASES': self.app.config['DATABASES']}
+        with settings(app, **config):
+            client = app.test_client()
+
+            assert client.get('/default').data == b'False'
+            assert client.post('/marked').data == b'True'
+
+            with settings(app, DATABASE_READONLY_METHODS=['GET']):
+                assert client.get('/default').data == b'True'
+                assert client.post('/default').data == b'False'
+                assert client.get('/unmarked').data == b'False'
+
+
+class TestShard:
+
+    def setup(self):
+        from alchemist.db._engine import clear_cache
+
+        clear_cache()
+
+        self.directory = tempfile.mkdtemp()
+        self.databases = {'default': 'sqlite://'}
+        for name in ('even', 'odd'):
+            self.databases[name] = {
+                'engine': 'sqlite',
+                'name': os.path.join(self.directory, '%s.db' % name),
+                'options': {'connect_args': {'check_same_thread': False}},
+            }
+
+        self.app = Flask('alchemist')
+        self.context = self.app.app_context()
+        self.context.push()
+
+        self.settings = settings(
+            self.app, DATABASES=self.databases, MODEL_METACLASS=(
+                'sqlalchemy.ext.declarative.api.DeclarativeMeta'))
+
+        self.settings.__enter__()
+
+        from alchemist import db
+        import sqlalchemy as sa
+
+        class Account(db.Model):
+
+            __tablename__ = 'account'
+
+            __shards__ = ['even', 'odd']
+
+            @staticmethod
+            def __shard__(key):
+                return 'odd' if key % 2 else 'even'
+
+            id = sa.Column(sa.Integer, primary_key=True, autoincrement=False)
+
+            name = sa.Column(sa.Unicode(20))
+
+        self.Account = Account
+
+        for name in Account.__shards__:
+            Account.metadata.create_all(db.engine[name])
+
+    def teardown(self):
+        from alchemist import db
+        from alchemist.db._engine import clear_cache
+
+        db.session.close()
+        self.settings.__exit__(None, None, None)
+        self.context.pop()
+        clear_cache()
+        shutil.rmtree(self.directory)
+
+    def _populate(self, stop=5):
+        from alchemist import db
+
+        for ident in range(1, stop):
+            db.session.add(self.Account(id=ident, name='%d' % ident))
+
+        db.session.commit()
+        db.session.expunge_all()
+
+    def test_insert(self):
+        from alchemist import db
+
+        self._populate()
+
+        rows = db.engine['odd'].execute('SELECT id FROM account ORDER BY id')
+        assert [row[0] for row in rows] == [1, 3]
+
+        rows = db.engine['even'].execute('SELECT id FROM account ORDER BY id')
+        assert [row[0] for row in rows] == [2, 4]
+
+    def test_choose(self):
+        from alchemist.db import _shard
+
+        Account = self.Account
+
+        query = Account.query.filter(Account.id == 3)
+        assert _shard.choose(query, Account) == ['odd']
+        assert _shard.choose(query, Account) is _shard.choose(query, Account)
+
+        query = query.filter(Account.name == '3')
+        assert _shard.choose(query, Account) == ['odd']
+
+        query = Account.query.filter(Account.id.in_([1, 3, 4]))
+        assert _shard.choose(query, Account) == ['odd', 'even']
+
+        query = Account.query.filter(Account.name == '3')
+        assert _shard.choose(query, Account) == ['even', 'odd']
+
+    def test_get(self):
+        self._populate()
+
+        assert self.Account.query.get(3).name == '3'
+        assert self.Account.query.get(4).name == '4'
+        assert self.Account.query.get(5) is None
+
+    def test_filter(self):
+        Account = self.Account
+
+        self._populate()
+
+        assert Account.query.filter(Account.id == 2).one().name == '2'
+        assert Account.query.filter_by(name='3').one().id == 3
+
+    def test_fan_out(self):
+        self._populate()
+
+        accounts = self.Account.query.all()
+        assert sorted(account.id for account in accounts) == [1, 2, 3, 4]
+
+    def test_set_shard(self):
+        self._populate()
+
+        accounts = self.Account.query.set_shard('odd').all()
+        assert sorted(account.id for account in accounts) == [1, 3]
+
+    def test_update(self):
+        from alchemist import db
+
+        self._populate()
+
+        account = self.Account.query.get(3)
+        account.name = 'three'
+        db.session.commit()
+
+        rows = db.engine['odd'].execute('SELECT name FROM account WHERE id=3')
+        assert rows.scalar() == 'three'
+
+    def test_order_by(self):
+        Account = self.Account
+
+        self._populate(7)
+
+        query = Account.query.order_by(Account.id)
+        assert [a.id for a in query] == [1, 2, 3, 4, 5, 6]
+
+        query = Account.query.order_by(Account.id.desc())
+        assert [a.id for a in query] == [6, 5, 4, 3, 2, 1]
+
+        query = Account.query.order_by(Account.name.desc(), Account.id)
+        assert [a.id for a in query][:2] == [6, 5]
+
+        rows = Account.query.with_entities(Account.id, Account.name) \
+            .order_by(Account.id).all()
+        assert rows[0].id == 1 and rows[0].name == '1'
+
+    def test_limit(self):
+        Account = self.Account
+
+        self._populate(7)
+
+        query = Account.query.order_by(Account.id)
+        assert [a.id for a in query.limit(2)] == [1, 2]
+        assert [a.id for a in query.offset(3).limit(2)] == [4, 5]
+        assert [a.id for a in query.offset(4)] == [5, 6]
+        assert [a.id for a in query[1:3]] == [2, 3]
+        assert query.first().id == 1
+
+        assert len(Account.query.limit(4).all()) == 4
+
+    def test_count(self):
+        Account = self.Account
+
+        self._populate(7)
+
+        assert Account.query.count() == 6
+        assert Account.query.filter(Account.id > 2).count() == 4
+        assert Account.query.filter(Account.id == 3).count() == 1
+        assert Account.query.set_shard('odd').count() == 3
+        assert Account.query.limit(4).count() == 4
+        assert Account.query.offset(5).limit(4).count() == 1
+
+    def test_group_by(self):
+        from sqlalchemy import exc, func
+
+        Account = self.Account
+        query = Account.query.group_by(Account.name)
+
+        with raises(exc.InvalidRequestError):
+            query.all()
+
+        with raises(exc.InvalidRequestError):
+            Account.query.with_entities(func.max(Account.id)).scalar()
+
+        assert query.set_shard('odd').all() == []
+
+    def test_bulk_update(self):
+        from alchemist import db
+
+        Account = self.Account
+
+        self._populate(7)
+
+        assert Account.query.update({'name': 'x'}) == 6
+        assert Account.query.filter(Account.id == 3).update(
+            {'name': 'three'}) == 1
+        assert Account.query.set_shard('even').filter(
+            Account.id > 2).update({'name': 'y'}, 'fetch') == 2
+        db.session.commit()
+
+        rows = db.engine['odd'].execute('SELECT name FROM account ORDER BY id')
+        assert [row[0] for row in rows] == ['x', 'three', 'x']
+
+        rows = db.engine['even'].execute(
+            'SELECT name FROM account ORDER BY id')
+        assert [row[0] for row in rows] == ['x', 'y', 'y']
+
+    def test_bulk_delete(self):
+        from alchemist import db
+
+        Account = self.Account
+
+        self._populate(7)
+
+        assert Account.query.filter(Account.id.in_([1, 2])).delete(
+            synchronize_session=False) == 2
+        assert Account.query.set_shard('odd').delete() == 2
+        db.session.commit()
+
+        assert Account.query.count() == 2
+
+    def test_execute(self):
+        from alchemist import db
+        from sqlalchemy import exc
+        import sqlalchemy as sa
+
+        Account = self.Account
+        table = Account.__table__
+
+        db.session.execute(table.insert(), {'id': 7, 'name': 'seven'})
+        db.session.execute(table.insert().values(id=8, name='eight'))
+        db.session.commit()
+
+        assert db.session.execute(sa.select([table.c.name]).where(
+            table.c.id == 7)).scalar() == 'seven'
+
+        result = db.session.execute(table.update().values(name='n'))
+        assert result.rowcount == 2
+
+        rows = db.session.execute(sa.select([table.c.id])).fetchall()
+        assert sorted(row[0] for row in rows) == [7, 8]
+
+        with raises(exc.InvalidRequestError):
+            db.session.execute(sa.select([table.c.id]).order_by(table.c.id))
+
+        with raises(exc.InvalidRequestError):
+            db.session.execute(table.insert(), {'name': 'nine'})
+
+        rows = db.session.execute(
+            sa.select([table.c.id]).order_by(table.c.id), shard_id='odd')
+        assert [row[0] for row in rows] == [7]
+
+
+class TestBulk:
+
+    def setup(self):
+        from alchemist.db._engine import clear_cache
+
+        clear_cache()
+
+        self.directory = tempfile.mkdtemp()
+        self.app = Flask('alchemist')
+        self.context = self.app.app_context()
+        self.context.push()
+
+        self.settings = settings(
+            self.app, DATABASES={'default': {
+                'engine': 'sqlite',
+                'name': os.path.join(self.directory, 'bulk.db'),
+            }}, MODEL_METACLASS=(
+                'sqlalchemy.ext.declarative.api.DeclarativeMeta'))
+
+        self.settings.__enter__()
+
+        from alchemist import db
+        import sqlalchemy as sa
+
+        class Item(db.Model):
+
+            __tablename__ = 'item'
+
+            id = sa.Column(sa.Integer, primary_key=True)
+
+            name = sa.Column(sa.Unicode(20))
+
+            kind = sa.Column(sa.Unicode(20), default='plain')
+
+        self.Item = Item
+        Item.metadata.create_all(db.engine['default'])
+
+        self.statements = []
+        sa.event.listen(
+            db.engine['default'], 'before_cursor_execute', self._executed)
+
+    def teardown(self):
+        from alchemist import db
+        from alchemist.db._engine import clear_cache
+
+        db.session.close()
+        self.settings.__exit__(None, None, None)
+        self.context.pop()
+        clear_cache()
+        shutil.rmtree(self.directory)
+
+    def _executed(self, conn, cursor, statement, parameters, context, many):
+        if statement.startswith(('INSERT', 'UPDATE')):
+            self.statements.append((statement, many))
+
+    def test_save(self):
+        from alchemist import db
+
+        items = (self.Item(name='%d' % n) for n in range(2500))
+        self.Item.bulk_save(items, batch_size=1000)
+        db.session.commit()
+
+        assert self.Item.query.count() == 2500
+        assert self.Item.query.filter_by(kind='plain').count() == 2500
+        assert [many for _, many in self.statements] == [True] * 3
+
+    def test_save_return_defaults(self):
+        from alchemist import db
+
+        items = [self.Item(name='a'), self.Item(name='b')]
+        self.Item.bulk_save(items, return_defaults=True)
+        db.session.commit()
+
+        assert [item.id for item in items] == [1, 2]
+        assert items[1] not in db.session
+
+    def test_save_update(self):
+        from alchemist import db
+
+        self.Item.bulk_insert_mappings({'name': '%d' % n} for n in range(3))
+        db.session.commit()
+
+        items = self.Item.query.order_by(self.Item.id).all()
+        items[0].name = 'x'
+        items[2].name = 'z'
+        del self.statements[:]
+
+        self.Item.bulk_save(items)
+
+        assert len(self.statements) == 1
+        assert self.statements[0][0].startswith('UPDATE')
+        assert not db.session.dirty
+
+        db.session.commit()
+        db.session.expunge_all()
+
+        names = [item.name for item in self.Item.query.order_by(
+            self.Item.id)]
+
+        assert names == ['x', '1', 'z']
+
+    def test_insert_mappings(self):
+        from alchemist import db
+
+        mappings = [{'name': 'a'}, {'name': 'b', 'id': 10}, {'name': 'c'}]
+        self.Item.bulk_insert_mappings(mappings, return_defaults=True)
+        db.session.commit()
+
+        assert [m['id'] for m in mappings] == [1, 10, 11]
+
+    def test_multivalues(self):
+        from alchemist.db import _bulk
+
+        with mock.patch.object(_bulk, 'multivalues', frozenset(['sqlite'])):
+            self.Item.bulk_insert_mappings(
+                {'name': '%d' % n, 'kind': 'odd'} for n in range(100))
+
+            # The Python default of the kind is left to executemany.
+            self.Item.bulk_insert_mappings({'name': 'x'} for n in range(10))
+
+        # A single INSERT of every row of the batch.
+        assert [many for _, many in self.statements] == [False, True]
+        assert self.Item.query.filter_by(kind='odd').count() == 100
+        assert self.Item.query.filter_by(kind='plain').count() == 10
+
+
+class TestKeyset:
+
+    def setup(self):
+        from alchemist.db._engine import clear_cache
+
+        clear_cache()
+
+        self.app = Flask('alchemist')
+        self.context = self.app.app_context()
+        self.context.push()
+
+        self.settings = settings(
+            self.app, DATABASES={'default': 'sqlite://'}, MODEL_METACLASS=(
+                'sqlalchemy.ext.declarative.api.DeclarativeMeta'))
+
+        self.settings.__enter__()
+
+        from alchemist import db
+        import datetime
+        import sqlalchemy as sa
+
+        class Score(db.Model):
+
+            __tablename__ = 'score'
+
+            id = sa.Column(sa.Integer, primary_key=True)
+
+            points = sa.Column(sa.Integer, nullable=False)
+
+            created = sa.Column(sa.DateTime, nullable=False)
+
+            note = sa.Column(sa.Unicode(20))
+
+        self.Score = Score
+        Score.metadata.create_all(db.engine['default'])
+
+        start = datetime.datetime(2015, 1, 1)
+        Score.bulk_insert_mappings({
+            'points': n % 4,
+            'created': start + datetime.timedelta(seconds=n * 1.5),
+        } for n in range(25))
+
+        db.session.commit()
+
+    def teardown(self):
+        from alchemist import db
+        from alchemist.db._engine import clear_cache
+
+        db.session.close()
+        self.settings.__exit__(None, None, None)
+        self.context.pop()
+        clear_cache()
+
+    def _pages(self, query, order_by, limit=10):
+        pages = []
+        token = None
+        while True:
+            page = query.paginate_keyset(order_by, after=token, limit=limit)
+            pages.append(page.items)
+            token = page.token
+            if token is None:
+                return pages
+
+    def test_paginate(self):
+        pages = self._pages(self.Score.query, self.Score.id)
+
+        assert [len(page) for page in pages] == [10, 10, 5]
+        assert [s.id for page in pages for s in page] == list(range(1, 26))
+
+    def test_composite(self):
+        from sqlalchemy import desc
+
+        Score = self.Score
+        order = [desc(Score.points), Score.created]
+        expected = Score.query.order_by(
+            Score.points.desc(), Score.created, Score.id).all()
+
+        pages = self._pages(Score.query, order, limit=4)
+        assert [s for page in pages for s in page] == expected
+
+        pages = self._pages(
+            Score.query.filter(Score.points > 0), order, limit=4)
+        assert [s for page in pages for s in page] == [
+            s for s in expected if s.points > 0]
+
+    def test_row_values(self):
+        from alchemist.db import _keyset
+        from sqlalchemy import desc
+
+        Score = self.Score
+        with mock.patch.object(_keyset, '_row_values', frozenset(['sqlite'])):
+            pages = self._pages(
+                Score.query, [desc(Score.points), desc(Score.id)])
+
+        assert [s.id for page in pages for s in page] == [
+            s.id for s in Score.query.order_by(
+                Score.points.desc(), Score.id.desc())]
+
+    def test_columns(self):
+        Score = self.Score
+        pages = self._pages(
+            Score.query.with_entities(Score.id, Score.points), Score.id)
+
+        assert pages[0][0] == (1, 0)
+        assert len(pages[-1]) == 5
+
+    def _stream(self, query, chunk_size=10):
+        from alchemist import db
+
+        held = []
+        for item in query.stream(chunk_size=chunk_size):
+            held.append(len(db.session.identity_map))
+            yield item
+
+        assert max(held) <= chunk_size
+        assert len(db.session.identity_map) == 0
+
+    def test_stream(self):
+        Score = self.Score
+        expected = [(s.id, s.points) for s in Score.query.order_by(
+            Score.points.desc(), Score.id)]
+
+        query = Score.query.order_by(Score.points.desc())
+        assert [(s.id, s.points) for s in self._stream(query)] == expected
+
+    def test_stream_server_side(self):
+        from alchemist import db
+        import sqlalchemy as sa
+
+        statements = []
+        sa.event.listen(
+            db.engine['default'], 'before_cursor_execute',
+            lambda *args: statements.append(args[2]))
+
+        Score = self.Score
+        with mock.patch.object(
+                db.Query, 'server_side_drivers', frozenset(['pysqlite'])):
+            items = list(self._stream(Score.query.order_by(Score.id), 10))
+
+        assert [s.id for s in items] == list(range(1, 26))
+        assert len(statements) == 1
+
+    def test_stream_limit(self):
+        Score = self.Score
+        query = Score.query.order_by(Score.id).offset(3).limit(12)
+
+        assert [s.id for s in self._stream(query, 5)] == list(range(4, 16))
+
+    def test_limit(self):
+        from sqlalchemy import exc
+
+        with raises(exc.InvalidRequestError):
+            self.Score.query.limit(5).paginate_keyset(self.Score.id)
+
+    def test_nullable(self):
+        from sqlalchemy import exc
+
+        with raises(exc.InvalidRequestError):
+            self.Score.query.paginate_keyset(self.Score.note)
+
+        with raises(exc.InvalidRequestError):
+            list(self.Score.query.order_by(self.Score.note).stream())
+
+    def test_stream_changes(self):
+        from alchemist import db
+
+        for score in self.Score.query.stream(chunk_size=7):
+            score.points = 10
+
+        db.session.commit()
+
+        assert self.Score.query.filter_by(points=10).count() == 25
+
+    def test_token_values(self):
+        from alchemist.db import _keyset
+        import datetime
+        import decimal
+
+        naive = datetime.datetime(2015, 1, 1, 12, 30, 0, 500)
+        ahead = naive.replace(tzinfo=_keyset._Offset(330))
+        behind = naive.replace(tzinfo=_keyset._Offset(-480))
+        values = [naive, ahead, behind, datetime.date(2015, 1, 1),
+                  decimal.Decimal('1.10'), 'a', 1, None]
+
+        decoded = _keyset.decode(_keyset.encode(values))
+        assert decoded == values
+        assert decoded[0].tzinfo is None
+        assert decoded[1].utcoffset() == datetime.timedelta(minutes=330)
+        assert decoded[2].utcoffset() == datetime.timedelta(minutes=-480)
+
+    def test_token_types(self):
+        from alchemist.db import _keyset
+        from sqlalchemy import exc
+        import datetime
+        import enum
+        import uuid
+
+        class Color(enum.Enum):
+            red = 'r'
+
+        values = [uuid.uuid4(), datetime.time(12, 30, 0, 500),
+                  datetime.time(8, tzinfo=_keyset._Offset(60)),
+                  b'\x00\xff', Color.red]
+
+        column = mock.Mock(type=mock.Mock(enum_class=Color))
+        pairs = [(None, False)] * 4 + [(column, False)]
+
+        decoded = _keyset.decode(_keyset.encode(values), pairs)
+        assert decoded == values
+        assert decoded[2].utcoffset() == datetime.timedelta(minutes=60)
+
+        # Left as its value without the column.
+        assert _keyset.decode(_keyset.encode(values))[-1] == 'r'
+
+        with raises(exc.InvalidRequestError) as error:
+            _keyset.encode([1, object()], [(None, False), ('x.y', False)])
+
+        assert 'x.y' in str(error.value)
+
+    def test_uuid_key(self):
+        from alchemist import db
+        import sqlalchemy as sa
+        import uuid
+
+        class Key(sa.types.TypeDecorator):
+
+            impl = sa.CHAR(32)
+
+            def process_bind_param(self, value, dialect):
+                return value.hex if value is not None else None
+
+            def process_result_value(self, value, dialect):
+                return uuid.UUID(value) if value is not None else None
+
+        class Ticket(db.Model):
+
+            __tablename__ = 'ticket'
+
+            id = sa.Column(Key, primary_key=True, default=uuid.uuid4)
+
+        Ticket.metadata.create_all(db.engine['default'])
+        for _ in range(7):
+            db.session.add(Ticket())
+
+        db.session.commit()
+
+        pages = self._pages(Ticket.query, Ticket.id, limit=3)
+        assert [len(page) for page in pages] == [3, 3, 1]
+        assert [t.id for page in pages for t in page] == sorted(
+            t.id for t in Ticket.query)
+
+    def test_malformed(self):
+        from alchemist.db import _keyset
+
+        with raises(ValueError):
+            self.Score.query.paginate_keyset(self.Score.id, after='junk')
+
+        with raises(ValueError):
+            self.Score.query.paginate_keyset(
+                self.Score.id, after=_keyset.encode([1, 2]))
+
+
+class TestNPlusOne:
+
+    def setup(self):
+        from alchemist.db._engine import clear_cache
+
+        clear_cache()
+
+        self.app = Flask('alchemist')
+        self.context = self.app.app_context()
+        self.context.push()
+
+        self.settings = settings(
+            self.app, DATABASES={'default': 'sqlite://'}, MODEL_METACLASS=(
+                'sqlalchemy.ext.declarative.api.DeclarativeMeta'))
+
+        self.settings.__enter__()
+
+        from alchemist import db
+        import sqlalchemy as sa
+
+        class Author(db.Model):
+
+            __tablename__ = 'author'
+
+            id = sa.Column(sa.Integer, primary_key=True)
+
+        class Book(db.Model):
+
+            __tablename__ = 'book'
+
+            id = sa.Column(sa.Integer, primary_key=True)
+
+            author_id = sa.Column(sa.ForeignKey(Author.id))
+
+            author = sa.orm.relationship(Author, backref='books')
+
+        self.Author = Author
+        Author.metadata.create_all(db.engine['default'])
+        Book.metadata.create_all(db.engine['default'])
+
+        for _ in range(4):
+            db.session.add(Author(books=[Book(), Book()]))
+
+        db.session.commit()
+        db.session.expunge_all()
+
+    def teardown(self):
+        from alchemist import db
+        from alchemist.db._engine import clear_cache
+
+        db.session.close()
+        self.settings.__exit__(None, None, None)
+        self.context.pop()
+        clear_cache()
+
+    def _load(self, *options):
+        return [len(a.books) for a in self.Author.query.options(*options)]
+
+    def test_warn(self):
+        from alchemist import db
+        import warnings
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with db.nplusone(limit=3) as scope:
+                self._load()
+
+        assert len(caught) == 1
+        assert caught[0].category is db.LazyLoadWarning
+
+        message = str(caught[0].message)
+        assert 'Author.books' in message
+        assert 'more than 3 times' in message
+        assert 'test_db.py:' in message
+
+        # The query of the authors is not a lazy load; it is not counted.
+        assert list(scope.counts.values()) == [4]
+
+    def test_eager(self):
+        from alchemist import db
+        from sqlalchemy.orm import joinedload
+
+        with settings(self.app, TESTING=True):
+            with db.nplusone(limit=3) as scope:
+                self._load(joinedload('books'))
+
+        assert not scope.counts
+
+    def test_request(self):
+        from alchemist import db
+
+        @self.app.route('/')
+        def view():
+            return '%d' % sum(self._load())
+
+        with settings(self.app, TESTING=True, DATABASE_LAZY_LOAD_LIMIT=3):
+            with raises(db.LazyLoadError):
+                self.app.test_client().get('/')
+
+        with settings(self.app, TESTING=True, DATABASE_LAZY_LOAD_LIMIT=4):
+            assert self.app.test_client().get('/').data == b'8'
+
+    def test_test_case(self):
+        from alchemist import db
+        from alchemist.db import _nplusone
+        from alchemist.test import TestBase
+
+        case = TestBase()
+        previous = _nplusone.current()
+        with settings(self.app, TESTING=True, DATABASE_LAZY_LOAD_LIMIT=3):
+            case.setup_method(self.test_test_case)
+            try:
+                assert _nplusone.current().name == 'TestBase.test_test_case'
+
+                with raises(db.LazyLoadError):
+                    self._load()
+
+            finally:
+                case.teardown_method(self.test_test_case)
+
+        assert _nplusone.current() is previous
+
+        class Case(TestBase):
+
+            def setup_method(self, method):
+                pass
+
+        # Set up without the scope; torn down all the same.
+        case = Case()
+        case.setup_method(self.test_test_case)
+        case.teardown_method(self.test_test_case)
+
+        assert _nplusone.current() is previous
+
+
+class TestAsync:
+
+    def setup(self):
+        from alchemist.db._engine import clear_cache
+
+        clear_cache()
+
+        self.directory = tempfile.mkdtemp()
+        self.app = Flask('alchemist')
+        self.context = self.app.app_context()
+        self.context.push()
+
+        self.settings = settings(
+            self.app, DATABASES={'default': {
+                'engine': 'sqlite',
+                'name': os.path.join(self.directory, 'aio.db'),
+                'options': {'connect_args': {'check_same_thread': False}},
+            }}, MODEL_METACLASS=(
+                'sqlalchemy.ext.declarative.api.DeclarativeMeta'))
+
+        self.settings.__enter__()
+
+        import asyncio
+        from alchemist import db
+        import sqlalchemy as sa
+
+        class Note(db.Model):
+
+            __tablename__ = 'note'
+
+            id = sa.Column(sa.Integer, primary_key=True)
+
+            name = sa.Column(sa.Unicode(20))
+
+        self.Note = Note
+        Note.metadata.create_all(db.engine['default'])
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def teardown(self):
+        from alchemist.db import aio
+        from alchemist.db._engine import clear_cache
+        import asyncio
+
+        closing = aio.remove()
+        if closing is not None:
+            self.loop.run_until_complete(closing)
+
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+        self.settings.__exit__(None, None, None)
+        self.context.pop()
+        clear_cache()
+        shutil.rmtree(self.directory)
+
+    def _run(self, future):
+        return self.loop.run_until_complete(future)
+
+    def test_engine(self):
+        from alchemist.db import aio
+        import asyncio
+
+        assert self._run(aio.engine.execute('SELECT 1')).scalar() == 1
+
+        futures = [aio.engine['default'].execute('SELECT %d' % index)
+                   for index in range(20)]
+        results = self._run(asyncio.gather(*futures))
+
+        assert [r.scalar() for r in results] == list(range(20))
+
+    def test_model(self):
+        from alchemist.db import aio
+
+        note = self.Note(id=1, name='a')
+        self._run(note.asave(commit=True))
+
+        assert self._run(self.Note.aquery.filter_by(name='a').all()) == [note]
+        assert self._run(self.Note.aquery.count()) == 1
+        assert self._run(aio.session.get(self.Note, 1)) is note
+
+        rows = self._run(aio.engine.execute('SELECT name FROM note'))
+        assert [tuple(row) for row in rows] == [('a',)]
+
+    def test_not_expired(self):
+        from sqlalchemy import inspect
+
+        note = self.Note(id=1, name='a')
+        self._run(note.asave(commit=True))
+
+        # Read without reloading (from the event loop).
+        assert not inspect(note).expired_attributes
+        assert note.name == 'a'
+
+    def test_gather(self):
+        from alchemist import db
+        from alchemist.db import aio
+        import asyncio
+        import sqlalchemy as sa
+        import time
+
+        running = []
+        overlapped = []
+
+        def before(*args):
+            running.append(None)
+            overlapped.append(len(running) > 1)
+            time.sleep(0.01)
+
+        def after(*args):
+            running.pop()
+
+        target = db.engine['default']
+        sa.event.listen(target, 'before_cursor_execute', before)
+        sa.event.listen(target, 'after_cursor_execute', after)
+
+        session = aio.AsyncSession()
+        self._run(asyncio.gather(*[
+            session.query(self.Note).count() for _ in range(5)] + [
+            session.execute('SELECT 1') for _ in range(5)]))
+
+        # The operations of the session ran one at a time.
+        assert len(overlapped) == 10
+        assert not any(overlapped)
+
+    def test_query_iteration(self):
+        with raises(TypeError):
+            list(self.Note.aquery)
+
+    def test_scope(self):
+        from alchemist.db import aio
+
+        first, second = mock.Mock(), mock.Mock()
+
+        with mock.patch.object(aio, '_current_task', lambda: first):
+            session = aio.session._get_current_object()
+
+            assert aio.session._get_current_object() is session
+
+        with mock.patch.object(aio, '_current_task', lambda: second):
+            assert aio.session._get_current_object() is not session
+
+        # Outside of any task; per thread.
+        assert aio.session._get_current_object() is not session
+
+
+class TestPoolMetrics:
+
+    def setup(self):
+        from alchemist.db._engine import clear_cache
+        import sqlalchemy as sa
+
+        clear_cache()
+
+        self.directory = tempfile.mkdtemp()
+        self.config = {'default': {
+            'engine': 'sqlite',
+            'name': os.path.join(self.directory, 'pool.db'),
+            'options': {
+                'poolclass': sa.pool.QueuePool,
+                'pool_size': 1,
+                'max_overflow': 1,
+                'pool_timeout': 0.01,
+            },
+        }}
+
+        self.app = Flask('alchemist')
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def teardown(self):
+        from alchemist.db._engine import clear_cache
+
+        self.context.pop()
+        clear_cache()
+        shutil.rmtree(self.directory)
+
+    def test_checkout(self):
+        from alchemist import db
+        import sqlalchemy as sa
+
+        with settings(self.app, DATABASES=self.config):
+            first = db.engine['default'].connect()
+            second = db.engine['default'].connect()
+
+            with raises(sa.exc.TimeoutError):
+                db.engine['default'].connect()
+
+            second.invalidate()
+            second.close()
+            first.close()
+
+            data = db.engine['default'].metrics.snapshot()
+
+            assert data['checkouts'] == 2
+            assert data['connects'] == 2
+            assert data['overflows'] == 1
+            assert data['peak_overflow'] == 1
+            assert data['timeouts'] == 1
+            assert data['invalidations'] == 1
+            assert sum(c for _, c in data['wait']['histogram']) == 2
+            assert data['pool']['checkedout'] == 0
+
+    def test_dispose(self):
+        from alchemist import db
+
+        with settings(self.app, DATABASES=self.config):
+            db.engine['default'].connect().close()
+            db.engine['default'].dispose()
+            db.engine['default'].connect().close()
+
+            assert db.engine['default'].metrics.snapshot()['checkouts'] == 2
+
+    def test_overflow_reused(self):
+        from alchemist import db
+
+        with settings(self.app, DATABASES=self.config):
+            first = db.engine['default'].connect()
+            second = db.engine['default'].connect()
+
+            # Checked out again while the pool is still over its size; no
+            # overflow connection is opened for it.
+            first.close()
+            db.engine['default'].connect().close()
+            second.close()
+
+            data = db.engine['default'].metrics.snapshot()
+
+            assert data['checkouts'] == 3
+            assert data['overflows'] == 1
+
+    def test_publish(self):
+        from alchemist import db
+        from alchemist.db import _pool
+
+        directory = os.path.join(self.directory, 'metrics')
+        app = Flask('alchemist')
+
+        @app.route('/')
+        def view():
+            db.session.execute('SELECT 1')
+            return 'done'
+
+        with settings(app, DATABASES=self.config,
+                      DATABASE_METRICS=directory):
+            with mock.patch.object(_pool, 'publish') as publish:
+                assert app.test_client().get('/').data == b'done'
+
+        (target, metrics), _ = publish.call_args
+
+        assert target == directory
+        assert metrics['default'].snapshot()['checkouts'] == 1
+
+        _pool.publish(directory, metrics, force=True)
+        snapshot, = _pool.collect(directory)
+
+        assert snapshot['pid'] == os.getpid()
+        assert snapshot['databases']['default']['checkouts'] == 1
+        assert 'histogram' in snapshot['requests']
+
+    def test_collect_ended(self):
+        from alchemist.db import _pool
+        import json
+        import subprocess
+
+        # The file of a process that has since ended.
+        process = subprocess.Popen(['true'])
+        process.wait()
+
+        filename = os.path.join(self.directory, '%d.json' % process.pid)
+        with open(filename, 'w') as stream:
+            json.dump({'pid': process.pid}, stream)
+
+        assert _pool.collect(self.directory) == []
+        assert not os.path.exists(filename)
+
+    def test_operation(self):
+        from alchemist import db
+        from alchemist.db import _pool
+        import json
+
+        with settings(self.app, DATABASES=self.config,
+                      DATABASE_METRICS=self.directory):
+            db.engine['default'].connect().close()
+            _pool.publish(self.directory, {
+                'default': db.engine['default'].metrics}, force=True)
+
+            capture = py.io.StdCapture(out=True, in_=False)
+            db.pool(interval=0.01, count=2, format='json')
+            out, err = capture.done()
+
+        lines = [json.loads(line) for line in out.read().splitlines()]
+
+        assert len(lines) == 4
+        assert lines[0]['database'] == 'default'
+        assert lines[0]['pid'] == os.getpid()
+        assert lines[0]['checkouts'] == 1
+        assert lines[0]['hold']['mean'] >= 0
+        assert 'histogram' in lines[1]['requests']
+
+    def test_operation_unconfigured(self):
+        from alchemist import db
+        from alchemist.exceptions import ImproperlyConfigured
+
+        with settings(self.app, DATABASES=self.config):
+            with raises(ImproperlyConfigured):
+                db.pool()
+
+
+class TestRelease(TestPoolMetrics):
+
+    def _request(self, **config):
+        from alchemist import db
+
+        app = Flask('alchemist')
+        held = []
+
+        @app.route('/')
+        def view():
+            db.session.execute('SELECT 1')
+            return 'done'
+
+        @app.route('/release')
+        def release():
+            db.session.execute('SELECT 1')
+            db.release()
+            held.append(db.engine['default'].pool.checkedout())
+
+            # The session begins anew.
+            db.session.execute('SELECT 1')
+            return 'done'
+
+        @app.teardown_request
+        def teardown(exc):
+            held.append(db.engine['default'].pool.checkedout())
+
+        with settings(app, DATABASES=self.config, **config):
+            client = app.test_client()
+            assert client.get('/').data == b'done'
+            assert client.get('/release').data == b'done'
+
+        return held
+
+    def test_release(self):
+        assert self._request() == [1, 0, 1]
+
+    def test_release_early(self):
+        assert self._request(DATABASE_RELEASE_EARLY=True) == [0, 0, 0]
+
+    def test_hold(self):
+        from alchemist import db
+        from alchemist.db._pool import requests
+
+        count = sum(c for _, c in requests.snapshot()['histogram'])
+        self._request()
+
+        assert sum(c for _, c in requests.snapshot()['histogram']) == \
+            count + 2
+
+        with settings(self.app, DATABASES=self.config):
+            data = db.engine['default'].metrics.snapshot()['hold']
+            assert sum(c for _, c in data['histogram']) == 3
+
+
+class TestWarmup(TestPoolMetrics):
+
+    def test_warmup(self):
+        from alchemist import db
+
+        self.config['default']['options']['pool_size'] = 3
+
+        with settings(self.app, DATABASES=self.config):
+            assert db.warmup() == {'default': 3}
+
+            target = db.engine['default']
+
+            assert target.metrics.snapshot()['connects'] == 3
+            assert target.pool.checkedin() == 3
+
+    def test_hot(self):
+        from alchemist import db
+        from alchemist.db.operations.warmup import statements, compiled_cache
+        import sqlalchemy as sa
+
+        table = sa.sql.table('entry', sa.sql.column('id'))
+        statement = db.hot(sa.select([table.c.id]).where(
+            table.c.id == sa.bindparam('id')), keys=['id'])
+
+        try:
+            with settings(self.app, DATABASES=self.config):
+                db.engine['default'].execute(
+                    'CREATE TABLE entry (id INTEGER)')
+                db.engine['default'].execute('INSERT INTO entry VALUES (1)')
+
+                db.warmup()
+
+                # Executed with the form compiled on warm-up.
+                with mock.patch.object(
+                        statement, 'compile', side_effect=AssertionError):
+                    assert db.compiled().execute(
+                        statement, id=1).scalar() == 1
+
+                # Other statements are not kept.
+                db.compiled().execute(sa.select([table.c.id])).close()
+
+                assert len(compiled_cache['default']) == 1
+
+        finally:
+            del statements[-1]
+            compiled_cache.clear()
+
+    def test_failure(self):
+        from alchemist import db
+
+        self.config['default']['name'] = os.path.join(
+            self.directory, 'missing', 'pool.db')
+
+        with settings(self.app, DATABASES=self.config):
+            capture = py.io.StdCapture(out=True, in_=False)
+            result = db.warmup()
+            out, err = capture.done()
+
+        assert result == {'default': 0}
+        assert 'unable to open database' in err.read()
+
+
+class TestFork(TestPoolMetrics):
+
+    def _fork(self, target):
+        # Run the target in a forked worker; returns its exit status.
+        pid = os.fork()
+        if not pid:
+            status = 1
+            try:
+                status = 0 if target() else 2
+
+            finally:
+                os._exit(status)
+
+        return os.waitpid(pid, 0)[1] >> 8
+
+    @mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+    def test_fork(self):
+        from alchemist import db
+
+        with settings(self.app, DATABASES=self.config):
+            parent = db.engine['default']
+            with contextlib.closing(parent.connect()) as connection:
+                inherited = connection.connection.connection
+
+            def worker():
+                child = db.engine['default']
+                with contextlib.closing(parent.connect()) as connection:
+                    dbapi = connection.connection.connection
+                    return (child is not parent and
+                            dbapi is not inherited and
+                            connection.scalar('SELECT 1') == 1)
+
+            assert [self._fork(worker) for _ in range(3)] == [0, 0, 0]
+
+            # The parent keeps its engine and connection.
+            assert db.engine['default'] is parent
+            with contextlib.closing(parent.connect()) as connection:
+                assert connection.connection.connection is inherited
+
+    def test_unmarked(self):
+        from alchemist.db import _engine
+        import sqlalchemy as sa
+
+        # Opened before the listeners were added.
+        target = sa.create_engine('sqlite://')
+        with contextlib.closing(target.connect()) as connection:
+            opened = connection.connection.connection
+
+        sa.event.listen(target, 'checkout', _engine._checkout)
+
+        # Used as is; not taken for one of the parent.
+        with contextlib.closing(target.connect()) as connection:
+            assert connection.connection.connection is opened
+
+    def test_inherited_not_closed(self):
+        from alchemist.db import _engine
+        import sqlalchemy as sa
+        import sqlite3
+
+        opened = []
+
+        def creator():
+            opened.append(mock.Mock(wraps=sqlite3.connect(':memory:')))
+            return opened[-1]
+
+        target = sa.create_engine(
+            'sqlite://', creator=creator, poolclass=sa.pool.QueuePool)
+
+        sa.event.listen(target, 'connect', _engine._connect)
+        sa.event.listen(target, 'checkout', _engine._checkout)
+
+        with contextlib.closing(target.connect()) as connection:
+            record = connection.connection._connection_record
+
+        # As if opened by the parent of this process.
+        record.info['alchemist.pid'] = os.getpid() + 1
+
+        with contextlib.closing(target.connect()) as connection:
+            assert connection.connection.connection is opened[1]
+            assert connection.scalar('SELECT 1') == 1
+
+        # Still open for the parent.
+        assert not opened[0].close.called
+
+
+class TestQueryLog:
+
+    def setup(self):
+        from alchemist.db._engine import clear_cache
+
+        clear_cache()
+
+        self.directory = tempfile.mkdtemp()
         self.app = Flask('alchemist')
+        self.context = self.app.app_context()
+        self.context.push()
 
-    def test_unbound(self):
+    def teardown(self):
+        from alchemist.db._engine import clear_cache
+        import logging
+
+        self.context.pop()
+        clear_cache()
+        shutil.rmtree(self.directory)
+
+        logger = logging.getLogger('alchemist.db.queries')
+        for handler in list(logger.handlers):
+            handler.close()
+            logger.removeHandler(handler)
+
+    def test_fingerprint(self):
+        from alchemist.db._queries import fingerprint
+
+        assert (fingerprint("SELECT a FROM b WHERE c = 'it''s' AND d IN "
+                            "(1, 2, 3)\n  AND e = :e_1") ==
+                'SELECT a FROM b WHERE c = ? AND d IN (?) AND e = ?')
+        assert (fingerprint('SELECT x::text FROM t_1 LIMIT %(param_1)s') ==
+                'SELECT x::text FROM t_1 LIMIT ?')
+
+    def test_disabled(self):
         from alchemist import db
 
-        assert not db.session
+        with settings(self.app, DATABASES={'default': 'sqlite://'}):
+            db.engine['default'].execute('SELECT 1')
 
-    def test_acquire_no_database(self):
-        from alchemist import db, exceptions
+            assert not db.engine['default'].queries.enabled
+            assert not db.engine['default'].queries.entries
 
-        with raises(exceptions.ImproperlyConfigured), self.app.app_context():
-            assert db.session
+    def test_slow(self):
+        from alchemist import db
 
-    def test_acquire_default(self):
+        filename = os.path.join(self.directory, 'queries.log')
+        config = {
+            'DATABASES': {'default': 'sqlite://'},
+            'DATABASE_SLOW_QUERY_MS': 0,
+            'DATABASE_QUERY_LOG': filename,
+        }
+
+        with settings(self.app, **config):
+            db.engine['default'].execute('SELECT 1')
+            db.engine['default'].execute('SELECT 2')
+
+            entries = list(db.engine['default'].queries.entries)
+
+        assert len(entries) == 2
+        assert entries[0]['slow']
+        assert entries[0]['fingerprint'] == 'SELECT ?'
+        assert entries[0]['hash'] == entries[1]['hash']
+
+        with open(filename) as stream:
+            assert stream.read().count('SELECT ?') == 2
+
+    def test_buffer(self):
         from alchemist import db
 
-        config = {'default': 'sqlite:///:memory:'}
-        with settings(self.app, DATABASES=config), self.app.app_context():
-            assert db.session
+        config = {
+            'DATABASES': {'default': 'sqlite://'},
+            'DATABASE_QUERY_SAMPLE': 1,
+            'DATABASE_QUERY_BUFFER': 2,
+        }
 
-    def test_repr(self):
+        with settings(self.app, **config):
+            for index in range(5):
+                db.engine['default'].execute('SELECT %d' % index)
+
+            entries = list(db.engine['default'].queries.entries)
+
+        assert [e['statement'] for e in entries] == ['SELECT 3', 'SELECT 4']
+        assert not entries[0]['slow']
+
+    def test_error(self):
         from alchemist import db
 
-        config = {'default': 'sqlite:///:memory:'}
-        with settings(self.app, DATABASES=config), self.app.app_context():
-            text = '<Session(bind=%r)>' % db.engine['default']
-            assert repr(db.session) == text
+        config = {
+            'DATABASES': {'default': 'sqlite://'},
+            'DATABASE_QUERY_SAMPLE': 1,
+        }
+
+        with settings(self.app, **config):
+            with db.engine['default'].connect() as connection:
+                with raises(OperationalError):
+                    connection.execute('SELECT * FROM missing')
+
+                connection.execute('SELECT 1')
+
+                assert not connection.info['alchemist.query_start']
+
+            entries = list(db.engine['default'].queries.entries)
+
+        assert [e['statement'] for e in entries] == ['SELECT 1']
 
 
 class TestModel:
@@ -175,7 +1962,92 @@ class TestModel:
         assert 'Plane' in db.registry['alchemist.tests.a.b']
 
 
-class TestQuery:
+class TestLazyModels:
+
+    def setup(self):
+        utils.unload_modules('alchemist')
+
+        self.directory = tempfile.mkdtemp()
+        filename = os.path.join(self.directory, 'settings.py')
+        with open(filename, 'w') as stream:
+            stream.write('MODELS_LAZY = True\n')
+
+        os.environ['ALCHEMIST_SETTINGS_MODULE'] = filename
+
+        self.app = Flask('alchemist.tests.a')
+        self.context = self.app.app_context()
+        self.context.push()
+
+        alchemist.configure(self.app)
+
+    def teardown(self):
+        self.context.pop()
+
+        del os.environ['ALCHEMIST_SETTINGS_MODULE']
+        shutil.rmtree(self.directory)
+
+    def test_deferred(self):
+        assert 'alchemist.tests.a.models' not in sys.modules
+        assert 'alchemist.tests.a.b.models' not in sys.modules
+
+    def test_metadata(self):
+        from alchemist import db
+
+        assert 'alchemist_tests_a_b_plane' in db.metadata.tables
+        assert 'alchemist.tests.a.models' in sys.modules
+
+    def test_registry(self):
+        from alchemist import db
+
+        assert 'Plane' in db.registry['alchemist.tests.a.b']
+
+    def test_warm(self):
+        from alchemist.db._loader import loader
+
+        for worker in loader.warm(2):
+            worker.join()
+
+        assert 'alchemist.tests.a.models' in sys.modules
+        assert 'alchemist.tests.a.b.models' in sys.modules
+
+    def test_warm_failed(self):
+        from alchemist.db._loader import Loader
+
+        directory = tempfile.mkdtemp()
+        for name, models in (('alchemist_bare', None),
+                             ('alchemist_broken', 'import alchemist_gone\n')):
+            os.mkdir(os.path.join(directory, name))
+            open(os.path.join(directory, name, '__init__.py'), 'w').close()
+            if models is not None:
+                with open(os.path.join(
+                        directory, name, 'models.py'), 'w') as stream:
+                    stream.write(models)
+
+        sys.path.insert(0, directory)
+        try:
+            target = Loader()
+            target.defer(['alchemist_bare', 'alchemist_broken'])
+            for worker in target.warm():
+                worker.join()
+
+            # Raised by the import of the models; not taken for the models
+            # being missing (as those of the bare component are).
+            for _ in range(2):
+                with raises(ImportError):
+                    target.load()
+
+            assert target.pending == ['alchemist_broken']
+            assert 'alchemist_bare' in sys.modules
+
+        finally:
+            sys.path.remove(directory)
+            shutil.rmtree(directory)
+            for name in ('alchemist_bare', 'alchemist_broken',
+                         'alchemist_broken.models'):
+                sys.modules.pop(name, None)
+
+
+class Queries(object):
 
     def setup(self):
         utils.unload_modules('alchemist')
@@ -189,6 +2061,9 @@ class TestQuery:
     def teardown(self):
         self.context.pop()
 
+
+class TestQuery(Queries):
+
     def test_query(self):
         from alchemist import db
         from .a.models import Entity
@@ -196,6 +2071,332 @@ class TestQuery:
         assert isinstance(db.session.query(Entity), db.Query)
         assert isinstance(Entity.query, db.Query)
 
+    def test_prototype(self):
+        from alchemist import db
+        from .a.models import Entity
+
+        first = Entity.query.filter_by(id=1)
+        second = Entity.query
+
+        assert second is not first
+        assert second._criterion is None
+        assert second.session is db.session._get_current_object()
+        assert str(second.statement) == str(
+            db.Query([Entity], db.session).statement)
+
+    def test_query_class(self):
+        from alchemist import db
+        from .a.models import Entity
+
+        class Query(db.Query):
+            pass
+
+        with mock.patch.object(Entity, '__query__', Query, create=True):
+            from alchemist.db import query
+            query._prototypes.clear()
+
+            assert type(Entity.query) is Query
+            assert type(db.session.query(Entity)) is Query
+
+        query._prototypes.clear()
+        assert type(Entity.query) is db.Query
+
+    def test_reused(self):
+        from alchemist import db
+        from alchemist.db import query
+        from .a.models import Entity
+        from sqlalchemy import orm
+
+        Entity.query
+        prototype = query._prototypes[Entity.__mapper__]
+
+        allocated = []
+        new = query.Query.__new__
+
+        def spy(cls, *args, **kwargs):
+            allocated.append(args)
+            return new(cls, *args, **kwargs)
+
+        # Cloned from the prototype; neither the query class is looked up
+        # nor are the entities set up again.
+        with mock.patch.object(query.Query, '__new__', staticmethod(spy)), \
+                mock.patch.object(
+                    orm.Query, '_set_entities', side_effect=AssertionError):
+            first = Entity.query
+            second = db.session.query(Entity)
+
+        assert allocated == [(), ()]
+        assert query._prototypes[Entity.__mapper__] is prototype
+        assert first is not prototype and second is not first
+        assert first._entities is prototype._entities
+        assert second._entities is prototype._entities
+
+
+@mark.skipif(not os.environ.get('ALCHEMIST_BENCHMARK'),
+             reason='set ALCHEMIST_BENCHMARK to run benchmarks')
+class TestQueryBenchmark(Queries):
+    """
+    Measures the cost of making a query over a model (and checks it beats
+    building one anew); run with `-s` to see the timings.
+    """
+
+    def test_overhead(self):
+        from alchemist import db
+        from .a.models import Entity
+        from sqlalchemy import orm
+        import timeit
+
+        def best(function):
+            return min(timeit.repeat(function, number=500, repeat=5)) / 500
+
+        Entity.query
+
+        # Built anew each time through the session proxy, as before.
+        built = best(lambda: orm.Session.query(db.session, Entity))
+        cloned = best(lambda: Entity.query)
+        proxied = best(lambda: db.session.query(Entity))
+
+        print('\nquery over a model')
+        print('  built:          %8.1f us' % (built * 1e6))
+        print('  Model.query:    %8.1f us' % (cloned * 1e6))
+        print('  session.query:  %8.1f us' % (proxied * 1e6))
+
+        # Loose; cloning the prototype must stay cheaper than building.
+        assert cloned < built
+        assert proxied < built
+
+
+class TestCache:
+
+    def setup(self):
+        utils.unload_modules('alchemist')
+
+        self.app = Flask('alchemist.tests.a')
+        self.context = self.app.app_context()
+        self.context.push()
+
+        alchemist.configure(self.app)
+
+        from alchemist import db
+        from alchemist.db import cache
+        import sqlalchemy as sa
+
+        db.metadata.create_all(db.engine['default'])
+        cache.backend().clear()
+
+        self.statements = []
+        sa.event.listen(
+            db.engine['default'], 'before_cursor_execute', self._executed)
+
+    def teardown(self):
+        from alchemist import db
+
+        db.session.close()
+        self.context.pop()
+
+    def _executed(self, conn, cursor, statement, parameters, context, many):
+        if statement.startswith('SELECT'):
+            self.statements.append(statement)
+
+    def _populate(self, count=2):
+        from alchemist import db
+        from .a.models import Entity
+
+        for _ in range(count):
+            db.session.add(Entity())
+
+        db.session.commit()
+
+    def test_cache(self):
+        from alchemist import db
+        from .a.models import Entity
+
+        self._populate()
+
+        first = Entity.query.cache().order_by(Entity.id).all()
+        db.session.expunge_all()
+        second = Entity.query.cache().order_by(Entity.id).all()
+
+        assert [e.id for e in first] == [e.id for e in second] == [1, 2]
+        assert all(e in db.session for e in second)
+        assert len(self.statements) == 1
+
+        Entity.query.cache().filter_by(id=1).all()
+        Entity.query.cache().filter_by(id=2).all()
+        Entity.query.cache().filter_by(id=2).all()
+
+        assert len(self.statements) == 3
+
+    def test_invalidate(self):
+        from alchemist import db
+        from .a.models import Entity
+
+        self._populate()
+
+        assert Entity.query.cache().count() == 2
+
+        # The transaction wrote the table; it reads through the cache.
+        db.session.add(Entity())
+        assert Entity.query.cache().count() == 3
+        db.session.rollback()
+
+        assert Entity.query.cache().count() == 2
+
+        self._populate()
+        assert Entity.query.cache().count() == 4
+
+        Entity.query.filter_by(id=1).delete()
+        db.session.commit()
+        assert Entity.query.cache().count() == 3
+
+        assert len(self.statements) == 5
+
+    def test_ttl(self):
+        from .a.models import Entity
+        import time
+
+        self._populate()
+
+        Entity.query.cache(ttl=0.05).all()
+        Entity.query.cache(ttl=0.05).all()
+        time.sleep(0.1)
+        Entity.query.cache(ttl=0.05).all()
+
+        assert len(self.statements) == 2
+
+    def test_key(self):
+        from .a.models import Entity
+
+        self._populate()
+
+        assert len(Entity.query.cache(key='all').all()) == 2
+        assert len(Entity.query.filter_by(id=1).cache(key='all').all()) == 2
+
+    def test_file(self):
+        from alchemist.db.cache import FileCache
+        from .a.models import Entity
+
+        directory = tempfile.mkdtemp()
+        try:
+            with settings(self.app, DATABASE_CACHE=FileCache(directory)):
+                self._populate()
+
+                assert len(Entity.query.cache().all()) == 2
+                assert len(Entity.query.cache().all()) == 2
+                assert len(self.statements) == 1
+
+                target = FileCache(directory)
+                target.set('a', b'value', ttl=-1)
+                assert target.get('a') is None
+                assert target.get('missing') is None
+
+        finally:
+            shutil.rmtree(directory)
+
+    def test_memory(self):
+        from alchemist.db.cache import MemoryCache
+
+        target = MemoryCache(size=10)
+        target.set('a', b'aaaa')
+        target.set('b', b'bbbb')
+        assert target.get('a') == b'aaaa'
+
+        # The least recently used is evicted.
+        target.set('c', b'cccc')
+        assert target.get('b') is None
+        assert target.get('a') == b'aaaa'
+        assert target.used == 8
+
+        target.set('d', b'd' * 11)
+        assert target.get('d') is None
+
+
+class TestRoutes:
+
+    def setup(self):
+        from alchemist.db._engine import clear_cache
+
+        clear_cache()
+
+        self.app = Flask('alchemist.tests.a')
+        self.context = self.app.app_context()
+        self.context.push()
+
+        alchemist.configure(self.app)
+
+        uri = 'sqlite:///:memory:'
+        self.settings = settings(
+            self.app, DATABASES={'default': uri, 'other': uri},
+            DATABASE_ROUTES={
+                'alchemist.tests.a:Box': 'other',
+                'alchemist.tests.a.b': 'other',
+            })
+
+        self.settings.__enter__()
+
+    def teardown(self):
+        from alchemist import db
+        from alchemist.db._engine import clear_cache
+
+        db.clear()
+
+        self.settings.__exit__(None, None, None)
+        self.context.pop()
+        clear_cache()
+
+    def test_route(self):
+        from alchemist.db._engine import route
+        from .a.models import Entity, Box
+        from .a.b import models
+
+        assert route(Entity) == 'default'
+        assert route(Box) == 'other'
+        assert route(models.Box) == 'other'
+
+    def test_init(self):
+        from alchemist import db
+
+        db.init(names=['alchemist.tests.a:Entity', 'alchemist.tests.a:Box',
+                       'alchemist.tests.a.b:Box'])
+
+        default, other = db.engine['default'], db.engine['other']
+
+        assert default.has_table('alchemist_tests_a_entity')
+        assert not default.has_table('alchemist_tests_a_box')
+        assert other.has_table('alchemist_tests_a_box')
+        assert other.has_table('alchemist_tests_a_b_box')
+        assert not other.has_table('alchemist_tests_a_entity')
+
+    def test_session(self):
+        from alchemist import db
+        from .a.models import Entity, Box
+
+        db.init(names=['alchemist.tests.a:Entity', 'alchemist.tests.a:Box'])
+
+        db.session.add(Box())
+        db.session.add(Entity())
+        db.session.commit()
+
+        assert Box.query.count() == 1
+        assert Entity.query.count() == 1
+        assert db.session.execute(Box.__table__.select()).first()
+
+        rows = db.engine['other'].execute(Box.__table__.select())
+        assert len(rows.fetchall()) == 1
+
+    def test_verbose(self):
+        from alchemist import db
+
+        capture = py.io.StdCapture(out=True, in_=False)
+        db.init(verbose=True, names=['alchemist.tests.a:Entity',
+                                     'alchemist.tests.a:Box'])
+        out, err = capture.done()
+
+        text = err.read()
+
+        assert 'default' in text
+        assert 'other' in text
+
 
 class TestInitializeOperation:
 
@@ -319,6 +2520,8 @@ class TestClearOperation:
         self.context = self.app.app_context()
         self.context.push()
 
+        alchemist.configure(self.app)
+
         db.init()
 
     def teardown(self):
@@ -412,6 +2615,8 @@ class TestFlushOperation:
         self.context = self.app.app_context()
         self.context.push()
 
+        alchemist.configure(self.app)
+
         db.init()
 
         from .a.models import Entity
@@ -513,8 +2718,8 @@ class TestShellOperation:
 
     @staticmethod
     def _clear_cache():
-        from alchemist.db._engine import Engine
-        Engine.__getitem__._cache.clear()
+        from alchemist.db._engine import clear_cache
+        clear_cache()
 
     def setup(self):
         self._clear_cache()
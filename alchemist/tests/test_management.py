@@ -2,6 +2,7 @@
 from __future__ import unicode_literals, absolute_import, division
 from alchemist import management
 from flask import Flask
+import sys
 
 
 class TestManager:
@@ -17,3 +18,31 @@ class TestManager:
         manager = management.Manager(self.app)
 
         assert 'run' in manager._commands
+
+    def test_lazy_commands(self):
+        """Should not import a command until it is invoked.
+        """
+
+        from . import utils
+
+        utils.unload_modules('alchemist.commands')
+
+        manager = management.Manager(self.app)
+
+        assert isinstance(manager._commands['test'], management.LazyCommand)
+        assert 'alchemist.commands.test' not in sys.modules
+        assert 'init' in manager._commands['db']._commands
+
+        manager._load(['db', 'init'])
+
+        assert 'alchemist.commands.db' in sys.modules
+        assert 'alchemist.commands.test' not in sys.modules
+
+    def test_lazy_command_help(self):
+        """Should describe a command without importing it.
+        """
+
+        manager = management.Manager(self.app)
+        command = manager._commands['load']
+
+        assert command.help == 'Loads the passed named fixture or file.'
@@ -40,6 +40,29 @@ def memoize(obj):
     return memoizer
 
 
+def pin(obj):
+    """
+    Memoize the result once it is found; unlike `memoize` a result of
+    None is not remembered and the call is retried the next time.
+    """
+
+    cache = obj._cache = {}
+
+    @functools.wraps(obj)
+    def pinner(*args, **kwargs):
+        try:
+            return cache[args]
+
+        except KeyError:
+            value = obj(*args, **kwargs)
+            if value is not None:
+                cache[args] = value
+
+            return value
+
+    return pinner
+
+
 def print_(indicator, name, target='', extra=''):
     six.print_(
         colored(' ' + indicator, 'white', attrs=['dark']),
@@ -56,7 +56,7 @@ setup(
         'blinker >= 1.3',
         'flask-components >= 0.1',
         'flask-script >= 0.6.6',
-        'sqlalchemy >= 0.8',
+        'sqlalchemy >= 0.9.3',
         'sqlalchemy-utils >= 0.21',
         'alembic >= 0.6, < 0.7',
         'pygments',